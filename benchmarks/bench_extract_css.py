@@ -0,0 +1,116 @@
+#
+# bench_extract_css.py
+#
+# Copyright (C) 2015 Uli Fouquet
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Benchmark CSS extraction.
+
+Compares :func:`ulif.openoffice.helpers.extract_css` with the
+implementation used before, which ran several regular expressions
+over the whole document and parsed it with BeautifulSoup. Run it like
+this::
+
+  $ python benchmarks/bench_extract_css.py
+
+The samples mimic HTML exports of LibreOffice spreadsheets with lots
+of inline style rules.
+"""
+import os
+import re
+import timeit
+from bs4 import BeautifulSoup
+from ulif.openoffice.helpers import extract_css
+
+RE_CSS_TAG = re.compile(r'(.+?)(\.?\s*){')
+RE_CSS_STMT_START = re.compile(r'\s*(.*?{.*?)')
+RE_CURLY_OPEN = re.compile(r'{([^ ])')
+RE_CURLY_CLOSE = re.compile(r'([^ ])}')
+RE_EMPTY_COMMENTS = re.compile(r'/\*\s*\*/')
+RE_CDATA_MASSAGE = r'(((/\*)?<!\[CDATA\[(\*/)?)((.*?)<!--)?'
+RE_CDATA_MASSAGE += r'(.*?)(-->(.*?))?((/\*)?]]>(\*/)?))'
+CDATA_MASSAGE = [
+    (re.compile(r'(<[^<>]*)/>'), lambda x: x.group(1) + ' />'),
+    (re.compile(r'<!\s+([^<>]*)>'), lambda x: '<!' + x.group(1) + '>'),
+    (re.compile(RE_CDATA_MASSAGE, re.M + re.S), lambda x: x.group(7)),
+    ]
+
+
+def extract_css_old(html_input, basename='sample.html'):
+    """The implementation used up to 1.1.1 (w/o prettifying).
+    """
+    for fix, m in CDATA_MASSAGE:
+        html_input = fix.sub(m, html_input)
+    soup = BeautifulSoup(html_input, 'html.parser')
+    css = '\n'.join([style.text for style in soup.find_all('style')])
+    if '<style>' in css:
+        css = css.replace('<style>', '\n')
+    css = re.sub(
+        RE_CSS_TAG,
+        lambda match: match.group(1).lower() + match.group(2) + '{', css)
+    css = re.sub(RE_CSS_STMT_START, lambda match: '\n' + match.group(1), css)
+    css = re.sub(RE_CURLY_OPEN, lambda match: '{ ' + match.group(1), css)
+    css = re.sub(RE_CURLY_CLOSE, lambda match: match.group(1) + ' }', css)
+    css_name = os.path.splitext(basename)[0] + '.css'
+    css = re.sub(RE_EMPTY_COMMENTS, lambda match: '', css)
+    if css.startswith('\n'):
+        css = css[1:]
+    for num, style in enumerate(soup.find_all('style')):
+        if num == 0 and css != '':
+            new_tag = soup.new_tag(
+                'link', rel='stylesheet', type='text/css', href=css_name)
+            style.replace_with(new_tag)
+        else:
+            style.extract()
+    if css == '':
+        css = None
+    return str(soup), css
+
+
+def make_spreadsheet_export(num_rules, num_rows):
+    """Create HTML resembling a LibreOffice Calc export.
+    """
+    rules = '\n'.join([
+        '\tTD.ce%s { color:#000000; font-family:"Liberation Sans" }' % x
+        for x in range(num_rules)])
+    rows = '\n'.join([
+        '<tr><td class="ce%s" align="left">Cell %s</td></tr>' % (
+            x % num_rules, x) for x in range(num_rows)])
+    return (
+        '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.0 Transitional//EN">\n'
+        '<html><head><meta http-equiv="content-type" '
+        'content="text/html; charset=utf-8"/>\n'
+        '<style type="text/css"><!--\n%s\n--></style>\n'
+        '</head><body><table>\n%s\n</table></body></html>\n') % (
+            rules, rows)
+
+
+SAMPLES = [
+    ('100 rules, 1000 rows', make_spreadsheet_export(100, 1000), 10),
+    ('5000 rules, 20000 rows', make_spreadsheet_export(5000, 20000), 2),
+    ]
+
+
+def main():
+    for title, html_input, number in SAMPLES:
+        for func in (extract_css_old, extract_css):
+            seconds = timeit.timeit(
+                lambda: func(html_input), number=number) / number
+            print("%-24s %-16s %10.6f s" % (title, func.__name__, seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#
+# bench_headnums.py
+#
+# Copyright (C) 2015 Uli Fouquet
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Benchmark heading number fixes.
+
+Compares :func:`ulif.openoffice.helpers.fix_heading_numbers` with the
+regular expression used before. Run it like this::
+
+  $ python benchmarks/bench_headnums.py
+
+The old regular expression backtracks exponentially on runs of digits
+at end of input. We therefore limit these runs for the old
+implementation.
+"""
+import re
+import timeit
+from ulif.openoffice.helpers import fix_heading_numbers
+
+#: The regular expression used up to 1.1.1.
+RE_HEAD_NUM = re.compile(r'(<h[1-6][^>]*>\s*)(([\d\.]+)+)([^\d])',
+                         re.M + re.S)
+
+
+def fix_heading_numbers_regex(html_input):
+    return re.sub(
+        RE_HEAD_NUM,
+        lambda match: ''.join([
+            match.group(1),
+            '<span class="u-o-headnum">',
+            match.group(3),
+            '</span>',
+            match.group(4)]),
+        html_input)
+
+
+def make_toc(num):
+    return '<body>%s</body>' % ''.join([
+        '<h2>%s.%s.Heading</h2><p>Some text</p>' % (x, x)
+        for x in range(num)])
+
+
+SAMPLES = [
+    ('regular document, 10000 headings', make_toc(10000), 10),
+    ('adversarial, 18 digits at end', '<h1>' + '1' * 18, 1),
+    ('adversarial, 22 digits at end', '<h1>' + '1' * 22, 1),
+    ]
+
+
+def main():
+    for title, html_input, number in SAMPLES:
+        assert fix_heading_numbers(html_input) == fix_heading_numbers_regex(
+            html_input)
+        for func in (fix_heading_numbers_regex, fix_heading_numbers):
+            seconds = timeit.timeit(
+                lambda: func(html_input), number=number) / number
+            print("%-36s %-28s %10.6f s" % (title, func.__name__, seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#
+# bench_transport.py
+#
+# Copyright (C) 2015 Uli Fouquet
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Benchmark connecting to office servers via TCP and via pipe.
+
+Needs an office instance started by ``oooctl`` (which listens on port
+and pipe). Run it like this::
+
+  $ oooctl start
+  $ python benchmarks/bench_transport.py [PORT]
+
+Measures the time to connect and receive the first message block of
+the UNO remote protocol, then the time of whole conversions of a
+small text document with both connection strings.
+"""
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import timeit
+from ulif.openoffice.convert import convert, get_pipe_path, PIPE_PREFIX
+
+
+def greet(family, address):
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    data = b''
+    while len(data) < 8:
+        chunk = sock.recv(8 - len(data))
+        if not chunk:
+            break
+        data += chunk
+    sock.close()
+
+
+def convert_with(url, path):
+    status, result_dir = convert(url=url, out_format='pdf', path=path)
+    shutil.rmtree(result_dir)
+
+
+def main(port=2002):
+    pipe_name = '%s%s' % (PIPE_PREFIX, port)
+    pipe_path = get_pipe_path(pipe_name)
+    if pipe_path is None:
+        print("No pipe %s found. Is oooctl running?" % pipe_name)
+        return
+    urls = [
+        ('tcp', 'socket,host=localhost,port=%d;urp;'
+         'StarOffice.ComponentContext' % port),
+        ('pipe', 'pipe,name=%s;urp;StarOffice.ComponentContext' % (
+            pipe_name)),
+        ]
+    greetings = [
+        ('tcp', lambda: greet(socket.AF_INET, ('127.0.0.1', port))),
+        ('pipe', lambda: greet(socket.AF_UNIX, pipe_path)),
+        ]
+    for title, func in greetings:
+        seconds = timeit.timeit(func, number=100) / 100
+        print("connect %-22s %10.6f s" % (title, seconds))
+    work_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(work_dir, 'sample.txt')
+        with open(path, 'w') as fd:
+            fd.write('Hi there!\n')
+        for title, url in urls:
+            seconds = timeit.timeit(
+                lambda: convert_with(url, path), number=5) / 5
+            print("convert %-22s %10.6f s" % (title, seconds))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,85 @@
+#
+# bench_zip.py
+#
+# Copyright (C) 2015 Uli Fouquet
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Benchmark zipping of image-heavy HTML exports.
+
+Compares :func:`ulif.openoffice.helpers.zip` with different settings
+with plain :mod:`zipfile` deflating everything, as done up to
+1.1.1. Run it like this::
+
+  $ python benchmarks/bench_zip.py
+
+Images are simulated by random data with a JPEG header.
+"""
+import os
+import shutil
+import tempfile
+import timeit
+import zipfile
+from ulif.openoffice.helpers import zip
+
+
+def zip_deflate_all(path):
+    new_dir = tempfile.mkdtemp()
+    new_path = os.path.join(new_dir, 'out.zip')
+    zout = zipfile.ZipFile(new_path, 'w', zipfile.ZIP_DEFLATED)
+    for name in sorted(os.listdir(path)):
+        zout.write(os.path.join(path, name), name)
+    zout.close()
+    return new_path
+
+
+def make_export(num_images, image_size):
+    path = tempfile.mkdtemp()
+    with open(os.path.join(path, 'sample.html'), 'w') as fd:
+        fd.write('<html><body>%s</body></html>' % ''.join([
+            '<p>Some text</p><img src="img%s.jpg" />' % x
+            for x in range(num_images)]) * 10)
+    for x in range(num_images):
+        with open(os.path.join(path, 'img%s.jpg' % x), 'wb') as fd:
+            fd.write(b'\xff\xd8\xff\xe0' + os.urandom(image_size))
+    return path
+
+
+FUNCS = [
+    ('deflate all (old)', zip_deflate_all),
+    ('zip()', lambda path: zip(path)),
+    ('zip(threads=4)', lambda path: zip(path, threads=4)),
+    ('zip(store_compressed=False)',
+     lambda path: zip(path, store_compressed=False)),
+    ]
+
+
+def main():
+    path = make_export(50, 400 * 1024)
+    try:
+        for title, func in FUNCS:
+            results = []
+            seconds = timeit.timeit(
+                lambda: results.append(func(path)), number=3) / 3
+            size = os.path.getsize(results[0])
+            for result in results:
+                shutil.rmtree(os.path.dirname(result))
+            print("%-30s %10.6f s %12d bytes" % (title, seconds, size))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -85,6 +85,7 @@ setup(
     [console_scripts]
     oooctl = ulif.openoffice.oooctl:main
     oooclient = ulif.openoffice.client:main
+    oooworker = ulif.openoffice.jobs:main
     [ulif.openoffice.processors]
     meta = ulif.openoffice.processor:MetaProcessor
     oocp = ulif.openoffice.processor:OOConvProcessor
@@ -94,6 +95,7 @@ setup(
     css_cleaner = ulif.openoffice.processor:CSSCleaner
     html_cleaner = ulif.openoffice.processor:HTMLCleaner
     error = ulif.openoffice.processor:Error
+    probe = ulif.openoffice.processor:ProbeProcessor
     [paste.app_factory]
     docconverter = ulif.openoffice.wsgi:make_docconverter_app
     xmlrpcapp = ulif.openoffice.xmlrpc:make_xmlrpc_app
@@ -0,0 +1,291 @@
+#
+# admission.py
+#
+# Copyright (C) 2015 Uli Fouquet
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Limit and schedule conversions done at the same time.
+
+Requests exceeding the limits of an :class:`AdmissionControl` are
+rejected early with :exc:`Overloaded` instead of waiting until some
+proxy times out.
+
+Waiting requests are not served in arrival order. Cheap and urgent
+conversions go first, see :func:`schedule_key`.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+#: Seconds a conversion is assumed to take before we measured any.
+DEFAULT_SERVICE_TIME = 5.0
+
+#: Weight of the latest measured conversion time in the average.
+SMOOTHING = 0.2
+
+#: Urgency of requests not telling otherwise. Urgencies range from
+#: ``0`` (most urgent) to ``7``, like in the HTTP ``Priority`` header
+#: (RFC 9218).
+DEFAULT_URGENCY = 3
+
+#: Urgency of background work, like asynchronous jobs.
+LOWEST_URGENCY = 7
+
+#: Cost of conversions we know nothing about.
+#: See :func:`ulif.openoffice.probe.estimate_cost`.
+DEFAULT_COST = 1.0
+
+#: Cost units a waiting conversion gains per second waited.
+AGING_RATE = 0.1
+
+
+class Overloaded(Exception):
+    """Too many conversions requested.
+
+    Clients should try again after `retry_after` seconds.
+    """
+    def __init__(self, retry_after, reason='too many conversions'):
+        super(Overloaded, self).__init__(reason)
+        self.retry_after = retry_after
+
+
+def _int_or_none(value):
+    # values from paste configs are strings, empty ones mean `None`
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def get_urgency(value, default=DEFAULT_URGENCY):
+    """Get an urgency from `value` (any int-like value).
+
+    Values out of range are moved into it, invalid ones give
+    `default`.
+    """
+    try:
+        return min(max(int(value), 0), LOWEST_URGENCY)
+    except (TypeError, ValueError):
+        return default
+
+
+def schedule_key(cost, urgency, waited):
+    """Get the key to sort waiting conversions by.
+
+    Conversions with lower keys are run first. The key is the
+    expected `cost` (shortest job first), doubled for each level of
+    `urgency` above :data:`DEFAULT_URGENCY` and halved for each level
+    below. Conversions that `waited` (seconds) age with
+    :data:`AGING_RATE`, so even expensive ones are run eventually.
+    """
+    if cost is None:
+        cost = DEFAULT_COST
+    return cost * 2.0 ** (urgency - DEFAULT_URGENCY) - waited * AGING_RATE
+
+
+class _Waiter(object):
+    # a request waiting for admission
+    def __init__(self, cost, urgency, large, limited=True):
+        self.cost = cost
+        self.urgency = urgency
+        self.large = large
+        self.limited = limited
+        self.since = time.time()
+        self.admitted = threading.Event()
+
+    def key(self, now):
+        return schedule_key(self.cost, self.urgency, now - self.since)
+
+
+class AdmissionControl(object):
+    """Admit at most `max_active` conversions at the same time.
+
+    Further requests wait in a queue of at most `max_queue` entries
+    for at most `max_wait` seconds. ``None`` means: no limit (also
+    ``0`` for `max_wait`). With `max_active` set to ``0`` (or
+    ``None``) everything is admitted immediately.
+
+    Waiting requests are admitted in order of :func:`schedule_key`.
+
+    Conversions with an expected cost of `large_cost` or more are
+    large. `reserved` slots are never used by large conversions, so
+    small ones do not have to wait for them. At least one slot must
+    be left for large conversions, otherwise :exc:`ValueError` is
+    raised.
+
+    The time to wait before retrying, as given with :exc:`Overloaded`,
+    is computed from the average time conversions took so far.
+
+    Background work (like asynchronous jobs) is admitted without
+    limits on queue length and waiting time. It waits as long as
+    needed and is not counted for the limits of others.
+    """
+    def __init__(self, max_active=0, max_queue=None, max_wait=None,
+                 reserved=0, large_cost=None):
+        self.max_active = _int_or_none(max_active) or 0
+        self.max_queue = _int_or_none(max_queue)
+        self.max_wait = max_wait not in (None, '') and float(
+            max_wait) or None
+        self.reserved = _int_or_none(reserved) or 0
+        self.large_cost = large_cost not in (None, '') and float(
+            large_cost) or None
+        if self.max_active and self.large_cost is not None and (
+                self.reserved >= self.max_active):
+            raise ValueError(
+                'reserved slots (%s) leave no slot for large conversions '
+                '(max_active: %s)' % (self.reserved, self.max_active))
+        self.active = 0
+        self.active_large = 0
+        self.service_time = None
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self):
+        """Number of requests waiting.
+        """
+        return len(self._waiters)
+
+    @property
+    def queued(self):
+        """Number of requests waiting, except background work.
+        """
+        return len([w for w in self._waiters if w.limited])
+
+    def expected_wait(self, queued=None):
+        """Seconds until `queued` waiting requests will be served.
+
+        If `queued` is ``None``, the number of requests currently
+        waiting (except background work) is used.
+        """
+        if queued is None:
+            queued = self.queued
+        service_time = self.service_time or DEFAULT_SERVICE_TIME
+        return queued * service_time / max(self.max_active, 1)
+
+    def retry_after(self, queued=None):
+        """Seconds clients should wait before trying again (int).
+        """
+        if queued is None:
+            queued = self.queued
+        return max(1, int(math.ceil(self.expected_wait(queued + 1))))
+
+    def check_queue(self, depth):
+        """Raise :exc:`Overloaded` if a queue of `depth` is too long.
+
+        For queues of jobs not run by us, like the job queue.
+        """
+        if self.max_queue is not None and depth >= self.max_queue:
+            raise Overloaded(self.retry_after(depth), 'queue full')
+
+    def is_large(self, cost):
+        """Tell whether a conversion of expected `cost` is large.
+        """
+        return self.large_cost is not None and (
+            cost or DEFAULT_COST) >= self.large_cost
+
+    def _record(self, duration):
+        if self.service_time is None:
+            self.service_time = duration
+        else:
+            self.service_time += SMOOTHING * (duration - self.service_time)
+
+    def _may_run(self, large):
+        if self.active >= self.max_active:
+            return False
+        return not large or (
+            self.active_large < self.max_active - self.reserved)
+
+    def _start(self, large):
+        self.active += 1
+        if large:
+            self.active_large += 1
+
+    def _dispatch(self):
+        # admit waiting requests while we have free slots.
+        now = time.time()
+        while True:
+            waiters = [w for w in self._waiters if self._may_run(w.large)]
+            if not waiters:
+                return
+            waiter = min(waiters, key=lambda w: w.key(now))
+            self._waiters.remove(waiter)
+            self._start(waiter.large)
+            waiter.admitted.set()
+
+    @contextmanager
+    def admit(self, cost=None, urgency=DEFAULT_URGENCY, limited=True):
+        """Context manager running the enclosed code when admitted.
+
+        `cost` is the expected cost of the conversion (see
+        :func:`ulif.openoffice.probe.estimate_cost`), `urgency` its
+        urgency. Both determine the order of waiting requests.
+
+        Raises :exc:`Overloaded` if the queue is full, the expected
+        wait exceeds `max_wait` or we waited longer than `max_wait`.
+        With `limited` set to ``False`` (for background work), we wait
+        as long as needed instead.
+        """
+        if not self.max_active:
+            yield
+            return
+        large = self.is_large(cost)
+        with self._lock:
+            if self._may_run(large):
+                self._start(large)
+                waiter = None
+            else:
+                waiter = self._enqueue(cost, urgency, large, limited)
+        if waiter is not None:
+            self._wait(waiter)
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active -= 1
+                if large:
+                    self.active_large -= 1
+                self._record(time.time() - start)
+                self._dispatch()
+
+    def _enqueue(self, cost, urgency, large, limited=True):
+        # queue a waiter. Caller must hold `self._lock`.
+        if limited and self.max_queue is not None and (
+                self.queued >= self.max_queue):
+            raise Overloaded(self.retry_after(), 'queue full')
+        if limited and self.max_wait is not None and (
+                self.service_time is not None) and (
+                self.expected_wait(self.queued + 1) > self.max_wait):
+            # no chance to get served in time
+            raise Overloaded(self.retry_after(), 'queue wait too long')
+        waiter = _Waiter(cost, get_urgency(urgency), large, limited)
+        self._waiters.append(waiter)
+        return waiter
+
+    def _wait(self, waiter):
+        # wait until `waiter` is admitted or `max_wait` is over.
+        if not waiter.limited:
+            waiter.admitted.wait()
+            return
+        if waiter.admitted.wait(self.max_wait):
+            return
+        with self._lock:
+            if waiter.admitted.is_set():
+                return  # admitted just now
+            self._waiters.remove(waiter)
+            raise Overloaded(self.retry_after(), 'queue wait too long')
@@ -2,6 +2,7 @@ import filecmp
 import glob
 import logging
 import os
+import re
 import shutil
 try:
     import cPickle as pickle  # Python 2.x
@@ -16,6 +17,10 @@ from ulif.openoffice.helpers import (
     filelike_cmp, write_filelike, base64url_encode)
 
 
+#: Regular expression matching valid hash digests.
+RE_HASH_DIGEST = re.compile('^[0-9a-f]{32}$')
+
+
 def get_marker(options=dict()):
     """Compute a unique marker for a set of options.
 
@@ -186,7 +191,8 @@ class Bucket(object):
         an already stored file are equal.
 
         Representations and their respective files are created if they
-        do not exist already or *overwritten* otherwise.
+        do not exist already or *overwritten* otherwise. If
+        `repr_path` is a directory, it is stored with all its contents.
 
         A representation is considered to exist already, if a
         representation with the same `repr_key` as passed in is
@@ -216,7 +222,11 @@ class Bucket(object):
         if os.path.exists(repr_dir):
             shutil.rmtree(repr_dir)  # remove any old representation
         os.makedirs(repr_dir)
-        shutil.copy2(repr_path, repr_dir)
+        if os.path.isdir(repr_path):
+            shutil.copytree(repr_path, os.path.join(
+                repr_dir, os.path.basename(repr_path)))
+        else:
+            shutil.copy2(repr_path, repr_dir)
         return '%s_%s' % (src_num, repr_num)
 
     def get_representation(self, bucket_key):
@@ -395,6 +405,35 @@ class CacheManager(object):
         cache_key = self._compose_cache_key(hash_digest, bucket_key)
         return bucket.get_representation(bucket_key), cache_key
 
+    def get_cached_file_by_digest(self, hash_digest, repr_key=''):
+        """Get the representation stored for a source digest and a key.
+
+        Works like :meth:`get_cached_file_by_source`, but expects the
+        hash digest of a source file (as computed by :meth:`get_hash`)
+        instead of the file itself. So clients can ask for cached
+        documents without sending the source.
+
+        As we cannot compare contents, we give up if different sources
+        with the same digest are stored. Returns ``(None, None)`` then
+        and for invalid digests.
+        """
+        if not RE_HASH_DIGEST.match(hash_digest or ''):
+            return None, None
+        bucket_path = self._get_bucket_path(hash_digest)
+        if not os.path.isdir(bucket_path):
+            return None, None
+        bucket = Bucket(bucket_path)
+        src_names = os.listdir(bucket.srcdir)
+        if len(src_names) != 1:
+            return None, None
+        src_num = int(src_names[0].split('_')[-1])
+        repr_num = bucket.get_stored_repr_num(src_num, repr_key)
+        if repr_num is None:
+            return None, None
+        bucket_key = '%s_%s' % (src_num, repr_num)
+        cache_key = self._compose_cache_key(hash_digest, bucket_key)
+        return bucket.get_representation(bucket_key), cache_key
+
     def register_doc(self, source_path, to_cache, repr_key=''):
         """Store a representation of file found in `source_path` which
         resides in path `to_cache` to a bucket.
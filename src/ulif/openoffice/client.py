@@ -20,15 +20,132 @@
 Client API to access all functionality via programmatic calls.
 """
 import argparse
+import copy
+import errno
 import os
 import shutil
 import sys
 import tempfile
+import threading
+from contextlib import contextmanager
+from hashlib import md5
+try:
+    import fcntl
+except ImportError:                  # pragma: no cover
+    fcntl = None                     # not available on Windows
 from ulif.openoffice.cachemanager import CacheManager, get_marker
+from ulif.openoffice.endpoints import set_state_file
+from ulif.openoffice.helpers import copy_to_secure_location
 from ulif.openoffice.options import Options
 from ulif.openoffice.processor import MetaProcessor
 
 
+class _Flight(object):
+    """A conversion in progress.
+
+    Other threads requesting the same conversion wait for `done` and
+    then take one of the `results` (or raise `error`).
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.results = []
+        self.error = None
+
+
+#: Conversions in progress in this process. Maps ``(<SOURCE_DIGEST>,
+#: <OPTIONS_MARKER>, <CACHE_DIR>)`` to :class:`_Flight` instances.
+_flights = {}
+
+_flights_lock = threading.Lock()
+
+
+def _copy_result(result):
+    # copy a conversion result, so that every caller can remove its
+    # result dir without harming others.
+    result_path, cache_key, metadata = result
+    if result_path is not None:
+        dst = copy_to_secure_location(os.path.dirname(result_path))
+        result_path = os.path.join(dst, os.path.basename(result_path))
+    return result_path, cache_key, copy.deepcopy(metadata)
+
+
+#: Number of lock files in ``<cache_dir>/.locks``. Conversions are
+#: spread over them by digest and options.
+LOCK_SLOTS = 256
+
+
+@contextmanager
+def _conversion_lock(cache_dir, flight_key):
+    """Lock conversions of `flight_key` across processes.
+
+    Yields whether we had to wait for another process. Lock files are
+    kept in the ``.locks`` subdirectory of `cache_dir`, at most
+    :data:`LOCK_SLOTS` of them, so different conversions may share a
+    lock now and then. Without
+    `cache_dir` (or on platforms without :mod:`fcntl`) nothing is
+    locked.
+    """
+    if cache_dir is None or fcntl is None:
+        yield False
+        return
+    lock_dir = os.path.join(cache_dir, '.locks')
+    try:
+        os.makedirs(lock_dir)
+    except OSError:
+        if not os.path.isdir(lock_dir):
+            raise
+    digest = md5(('%s_%s' % flight_key[:2]).encode('utf-8')).hexdigest()
+    name = '%d.lock' % (int(digest, 16) % LOCK_SLOTS)
+    with open(os.path.join(lock_dir, name), 'a') as fd:
+        waited = False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as err:
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            waited = True
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield waited
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def _get_cached_result(src_doc, repr_key, cache_dir):
+    # get a copy of a cached conversion result, or `None`.
+    cached_path, cache_key = CacheManager(
+        cache_dir).get_cached_file_by_source(src_doc, repr_key)
+    if cached_path is None or os.path.isdir(cached_path):
+        return None
+    return _copy_result((cached_path, cache_key, dict(error=False)))
+
+
+def _convert_doc(src_doc, options, cache_dir, repr_key):
+    # do the real conversion and cache the result.
+    result_path = None
+    cache_key = None
+    metadata = dict(error=False)
+
+    # Generate result
+    input_copy_dir = tempfile.mkdtemp()
+    input_copy = os.path.join(input_copy_dir, os.path.basename(src_doc))
+    shutil.copy2(src_doc, input_copy)
+    try:
+        proc = MetaProcessor(options=options)  # Removes original doc
+        result_path, metadata = proc.process(input_copy)
+    except Exception as exc:
+        shutil.rmtree(input_copy_dir)
+        raise exc
+
+    error_state = metadata.get('error', False)
+    if cache_dir and not error_state and result_path is not None:
+        # Cache away generated doc
+        cache_key = CacheManager(cache_dir).register_doc(
+            src_doc, result_path, repr_key)
+    return result_path, cache_key, metadata
+
+
 def convert_doc(src_doc, options, cache_dir):
     """Convert `src_doc` according to the other parameters.
 
@@ -57,29 +174,48 @@ def convert_doc(src_doc, options, cache_dir):
 
     If errors happen or caching is disabled, ``<CACHE_KEY>`` is
     ``None``.
+
+    Identical conversions (same source contents, same `options`)
+    requested while one of them is in progress are run only once.
+    Other threads wait for the running conversion and get a copy of
+    its result. With `cache_dir` set, this also holds for other
+    processes using the same `cache_dir`: they wait for a lock file
+    and then take the result from cache.
     """
-    result_path = None
-    cache_key = None
     repr_key = get_marker(options)  # Create unique marker out of options
-    metadata = dict(error=False)
-
-    # Generate result
-    input_copy_dir = tempfile.mkdtemp()
-    input_copy = os.path.join(input_copy_dir, os.path.basename(src_doc))
-    shutil.copy2(src_doc, input_copy)
+    flight_key = (CacheManager.get_hash(src_doc), repr_key, cache_dir)
+    with _flights_lock:
+        flight = _flights.get(flight_key)
+        is_leader = flight is None
+        if is_leader:
+            flight = _flights[flight_key] = _Flight()
+        else:
+            flight.waiters += 1
+    if not is_leader:
+        # wait for identical conversion running in other thread
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.results.pop()
     try:
-        proc = MetaProcessor(options=options)  # Removes original doc
-        result_path, metadata = proc.process(input_copy)
+        with _conversion_lock(cache_dir, flight_key) as waited:
+            result = None
+            if waited:
+                # another process did the same conversion (probably)
+                result = _get_cached_result(src_doc, repr_key, cache_dir)
+            if result is None:
+                result = _convert_doc(src_doc, options, cache_dir, repr_key)
     except Exception as exc:
-        shutil.rmtree(input_copy_dir)
-        raise exc
-
-    error_state = metadata.get('error', False)
-    if cache_dir and not error_state and result_path is not None:
-        # Cache away generated doc
-        cache_key = CacheManager(cache_dir).register_doc(
-            src_doc, result_path, repr_key)
-    return result_path, cache_key, metadata
+        with _flights_lock:
+            del _flights[flight_key]
+        flight.error = exc
+        flight.done.set()
+        raise
+    with _flights_lock:
+        del _flights[flight_key]
+    flight.results = [_copy_result(result) for num in range(flight.waiters)]
+    flight.done.set()
+    return result
 
 
 class Client(object):
@@ -96,14 +232,25 @@ class Client(object):
 
         Calls :func:`convert_doc` internally and returns the result
         given by this function.
+
+        If a cache dir is set and a result for the same source and
+        `options` is cached already, nothing is converted. We return
+        a copy of the cached doc, its cache key and ``{'error':
+        False}`` as metadata instead.
         """
+        if self.cache_dir is not None:
+            result = _get_cached_result(
+                src_doc_path, get_marker(options), self.cache_dir)
+            if result is not None:
+                return result
         return convert_doc(src_doc_path, options, self.cache_dir)
 
     def get_cached(self, cache_key):
         """Get the document from cache stored under `cache_key`.
 
         Returns ``None`` if no such file can be found or no cache dir
-        was set at all.
+        was set at all. Also unzipped results cached by the WSGI app
+        with `stream_zip` enabled (directories) are not returned.
 
         .. warning:: The returned path (if any) is part of cache! Do
                      not remove or change the file. Copy it to another
@@ -113,7 +260,9 @@ class Client(object):
 
         """
         if self.cache_manager is not None:
-            return self.cache_manager.get_cached_file(cache_key)
+            path = self.cache_manager.get_cached_file(cache_key)
+            if path is not None and os.path.isfile(path):
+                return path
         return None
 
     def get_cached_by_source(self, src_doc_path, options={}):
@@ -156,12 +305,17 @@ def main(args=None):
                         help='The office document to be converted')
     parser.add_argument('--cachedir',
                         help='Path to a cache directory')
+    parser.add_argument('--statefile',
+                        help='Path to the state file of oooctl. Local '
+                        'office servers moved while recycling are '
+                        'followed')
     parser.description = "A tool to convert office documents."
     parser = Options().get_arg_parser(parser)
     options = vars(parser.parse_args(args))
     cache_dir = options['cachedir']
     src = options['src']
+    set_state_file(options['statefile'])
     options = Options(val_dict=options)
-    result_path, cache_key, metadata = convert_doc(
-        src, options, cache_dir=cache_dir)
+    result_path, cache_key, metadata = Client(cache_dir=cache_dir).convert(
+        src, options)
     print("RESULT in " + result_path)
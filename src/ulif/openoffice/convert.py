@@ -20,13 +20,81 @@
 A convert office docs.
 """
 import logging
+import os
 import shlex
+import socket
 import tempfile
 from multiprocessing import Lock
 from subprocess import Popen
 
 mutex = Lock()
 
+#: Prefix of pipe names. Office instances run by ``oooctl`` listen on
+#: pipe ``<PIPE_PREFIX><PORT>`` besides their TCP port.
+PIPE_PREFIX = 'ulif_openoffice_'
+
+#: Directories office servers create their pipes in.
+PIPE_DIRS = ('/tmp', '/var/tmp')
+
+#: Names of the local host.
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1', socket.gethostname())
+
+#: Seconds to wait when checking whether office pipes accept
+#: connections.
+PIPE_TIMEOUT = 0.5
+
+
+def pipe_alive(path, timeout=PIPE_TIMEOUT):
+    """Tell whether the socket in `path` accepts connections.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except (socket.error, socket.timeout):
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def get_pipe_path(name, connect=False):
+    """Get the path of the socket of office pipe `name`.
+
+    Office servers accepting connections on pipe `name` create a Unix
+    domain socket ``/tmp/OSL_PIPE_<UID>_<NAME>``, only usable by the
+    same user. Returns ``None`` if there is none.
+
+    Crashed office servers leave their sockets behind. If `connect`
+    is set, only sockets accepting connections are returned.
+    """
+    getuid = getattr(os, 'getuid', None)
+    if getuid is None:                                  # pragma: no cover
+        return None                                     # no Unix
+    for pipe_dir in PIPE_DIRS:
+        path = os.path.join(pipe_dir, 'OSL_PIPE_%s_%s' % (getuid(), name))
+        if not os.path.exists(path):
+            continue
+        if not connect or pipe_alive(path):
+            return path
+    return None
+
+
+def get_url(host='localhost', port=2002):
+    """Get the connection string for an office server at `host`, `port`.
+
+    If the server is local and listens on the pipe of its port (see
+    :data:`PIPE_PREFIX`), a pipe connection is used instead of TCP.
+    We connect to the pipe once to make sure it is not left over from
+    a crashed server.
+    """
+    name = '%s%s' % (PIPE_PREFIX, port)
+    if host in LOCAL_HOSTS and get_pipe_path(
+            name, connect=True) is not None:
+        return 'pipe,name=%s;urp;StarOffice.ComponentContext' % name
+    return 'socket,host=%s,port=%d;urp;StarOffice.ComponentContext' % (
+        host, port)
+
 
 def threadsafe(func):
     """A decorator for functions to run threadsafe.
@@ -42,6 +110,7 @@ def threadsafe(func):
     safe_func.__name__ = func.__name__
     safe_func.__dict__ = func.__dict__
     safe_func.__doc__ = func.__doc__
+    safe_func.__wrapped__ = func
     return safe_func
 
 
@@ -49,7 +118,8 @@ def threadsafe(func):
 def convert(
         url="socket,host=localhost,port=2002;urp;StarOffice.ComponentContext",
         out_format='text', path=None, out_dir=None, filter_props=(),
-        template=None, timeout=5, doctype='document', executable='unoconv'):
+        template=None, timeout=5, doctype='document', executable='unoconv',
+        no_launch=False):
     """Convert some document using `unoconv`.
 
     Converts the document given in `path` to `out_format` and return a
@@ -60,7 +130,9 @@ def convert(
     given and exists). It is the caller's responsibility to remove
     this directory after use.
 
-    `url` - connection string passed as `-c` parameter.
+    `url` - connection string passed as `-c` parameter. TCP
+      (``socket,...``) and pipe (``pipe,name=...``) connections are
+      supported. See :func:`get_url`.
 
     `out_format` - destination format as string. Must be one of the
        formats provided by `unoconv --show`.
@@ -90,6 +162,10 @@ def convert(
 
     `executable` - path to the unoconv executable to use. If none is
       given the executable is looked up in the current system path.
+
+    `no_launch` - if set, `unoconv` fails (with status 113) if it
+      cannot connect to `url` instead of starting an office server
+      itself.
     """
     if not path:
         return None, None
@@ -101,6 +177,8 @@ def convert(
     cmd = '%s -c %s -f %s -o %s' % (
         executable, url, out_format, path)
     cmd += ' -d %s' % (doctype,)
+    if no_launch:
+        cmd += ' --no-launch'
     if template is not None:
         cmd += ' -t %s' % (template,)
     for filter_prop in filter_props:
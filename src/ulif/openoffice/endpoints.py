@@ -0,0 +1,414 @@
+#
+# endpoints.py
+#
+# Copyright (C) 2015 Uli Fouquet
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Distribute conversions over several office servers.
+
+An :class:`EndpointPool` routes each conversion to the least loaded
+healthy office server (local or remote). Servers failing repeatedly
+are taken out of rotation for some time (a circuit breaker). When it
+is over, they are probed before they get conversions again.
+
+Use :func:`set_endpoints` to make the ``oocp`` processor use a pool.
+
+Pools can also follow the instances run by ``oooctl``, as listed in
+its state file. See :mod:`ulif.openoffice.supervisor`. Clients
+without a pool find recycled ``oooctl`` instances with
+:func:`resolve_endpoint`, if a state file was set with
+:func:`set_state_file`.
+"""
+import json
+import os
+import re
+import socket
+import stat
+import struct
+import threading
+import time
+from ulif.openoffice import convert as _convert
+
+
+#: Exit statuses of `unoconv` meaning that no office server could be
+#: reached (113 with ``--no-launch``). Conversions failing like this
+#: are retried elsewhere.
+CONNECTION_ERRORS = (113, 251)
+
+#: Seconds to wait for office servers when probing.
+PROBE_TIMEOUT = 2.0
+
+#: Default port of office servers.
+DEFAULT_PORT = 2002
+
+#: Default path of the state file written by ``oooctl``.
+STATE_FILE = '/tmp/ooodaemon.json'
+
+
+_state_file = None
+
+
+def set_state_file(path=None):
+    """Let :func:`resolve_endpoint` follow the ``oooctl`` state file
+    at `path`.
+
+    If `path` is ``None``, no state file is read and the ``oocp-host``
+    and ``oocp-port`` options are used as they are.
+    """
+    global _state_file
+    _state_file = path
+
+
+def _pid_running(pid):
+    # tell whether a process `pid` of ours exists
+    if not isinstance(pid, int) or pid < 1:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False                            # gone or not ours
+    return True
+
+
+def _trusted(fd):
+    # tell whether the file opened as `fd` is ours and writable by
+    # nobody else. Anyone else could redirect our conversions.
+    info = os.fstat(fd.fileno())
+    return info.st_uid == os.getuid() and not (
+        info.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+
+def resolve_endpoint(host, port, state_file=None):
+    """Get the office server to use for `host` and `port`.
+
+    ``oooctl`` starts replacements of recycled instances on other
+    ports. If `host` is local and the ``oooctl`` writing `state_file`
+    (default: the one set with :func:`set_state_file`) runs instances
+    on `port` (its first port), we get a ready instance of it,
+    preferably the one on `port`. Otherwise, or if no state file is
+    set, `host` and `port` are returned unchanged.
+
+    The state file is used only if it is owned by the current user
+    and not writable by group or others.
+
+    Returns a tuple ``(host, port)``.
+    """
+    state_file = state_file or _state_file
+    if state_file is None or host not in _convert.LOCAL_HOSTS:
+        return host, port
+    try:
+        with open(state_file, 'r') as fd:
+            if not _trusted(fd):
+                return host, port
+            state = json.load(fd)
+    except (IOError, OSError, ValueError):
+        return host, port
+    if not isinstance(state, dict):
+        return host, port
+    if state.get('port') != port or not _pid_running(state.get('pid')):
+        return host, port                       # not ours or stale
+    ready = [(entry['host'], entry['port']) for entry in state.get(
+        'instances', []) if entry.get('state') == 'ready']
+    if not ready or port in [entry[1] for entry in ready]:
+        return host, port
+    return ready[0]
+
+
+class NoEndpointAvailable(Exception):
+    """No healthy office server is available.
+    """
+
+
+def parse_endpoints(value):
+    """Get a list of ``(host, port)`` tuples from string `value`.
+
+    `value` is a list of ``host:port`` entries, separated by commas
+    or whitespace. The port is optional and defaults to
+    :data:`DEFAULT_PORT`.
+    """
+    result = []
+    for entry in re.split(r'[\s,]+', value.strip()):
+        if not entry:
+            continue
+        host, sep, port = entry.rpartition(':')
+        if not sep:
+            host, port = port, DEFAULT_PORT
+        result.append((host, int(port)))
+    return result
+
+
+def probe_endpoint(host, port, timeout=PROBE_TIMEOUT):
+    """Tell whether an office server at `host` and `port` is alive.
+
+    An open port is not enough: hanging office processes still accept
+    connections. Office servers start each connection by sending a
+    message block of the UNO remote protocol (URP), which we wait for
+    at most `timeout` seconds.
+    """
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    data = b''
+    try:
+        while len(data) < 8:
+            chunk = sock.recv(8 - len(data))
+            if not chunk:
+                return False
+            data += chunk
+    except (socket.error, socket.timeout):
+        return False
+    finally:
+        sock.close()
+    # message block header: size and number of messages
+    size, count = struct.unpack('>II', data)
+    return size > 0 and count > 0
+
+
+class Endpoint(object):
+    """An office server at `host` and `port`.
+
+    `active` is the number of conversions running (or waiting for
+    `lock`) there. If `open_until` is set, the server is out of
+    rotation until then.
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        self.active = 0
+        self.failures = 0
+        self.backoff = 0
+        self.open_until = None
+
+    @property
+    def url(self):
+        """The connection string to pass to `unoconv`.
+
+        Local servers are connected by pipe, if possible. See
+        :func:`ulif.openoffice.convert.get_url`.
+        """
+        return _convert.get_url(self.host, self.port)
+
+    def __repr__(self):
+        return '<Endpoint %s:%s>' % (self.host, self.port)
+
+
+class EndpointPool(object):
+    """A pool of office servers.
+
+    `endpoints` is a list of ``(host, port)`` tuples or a string as
+    accepted by :func:`parse_endpoints`. A string starting with a
+    slash is the path of an ``oooctl`` state file instead. Then the
+    endpoints are the instances ready according to this file, which
+    is read again whenever it changes.
+
+    After `failure_threshold` failed conversions in a row a server is
+    out of rotation for `backoff` seconds. This time doubles each time
+    the server fails again after that, up to `max_backoff`
+    seconds. `probe` is the function to check the health of servers
+    with, see :func:`probe_endpoint`.
+
+    If `check_interval` is set, all servers in rotation are probed
+    that often (seconds) in background.
+    """
+    def __init__(self, endpoints, failure_threshold=3, backoff=1.0,
+                 max_backoff=300.0, probe=probe_endpoint,
+                 check_interval=None):
+        self.state_file = None
+        self._state_id = None
+        if not isinstance(endpoints, (list, tuple)):
+            if endpoints.startswith('/'):
+                self.state_file = endpoints
+                endpoints = []
+            else:
+                endpoints = parse_endpoints(endpoints)
+        if not endpoints and self.state_file is None:
+            raise ValueError('no endpoints given')
+        self.endpoints = [Endpoint(host, port) for host, port in endpoints]
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.probe = probe
+        self._lock = threading.Lock()
+        if check_interval:
+            thread = threading.Thread(
+                target=self._check_periodically, args=(check_interval, ))
+            thread.daemon = True
+            thread.start()
+
+    def _reload(self):
+        # update endpoints from state file, if it changed.
+        if self.state_file is None:
+            return
+        try:
+            stat = os.stat(self.state_file)
+            state_id = (stat.st_ino, stat.st_mtime)
+        except OSError:
+            state_id = None                 # oooctl not running
+        if state_id == self._state_id:
+            return
+        instances = []
+        if state_id is not None:
+            try:
+                with open(self.state_file, 'r') as fd:
+                    instances = json.load(fd)['instances']
+            except (IOError, OSError, ValueError, KeyError):
+                return                          # try again later
+        with self._lock:
+            old = dict(
+                ((ep.host, ep.port), ep) for ep in self.endpoints)
+            self.endpoints = [
+                old.get((x['host'], x['port'])) or Endpoint(
+                    x['host'], x['port'])
+                for x in instances if x['state'] == 'ready']
+            self._state_id = state_id
+
+    def _trip(self, endpoint):
+        # take `endpoint` out of rotation. Caller must hold the lock.
+        endpoint.backoff = min(
+            max(endpoint.backoff * 2, self.backoff), self.max_backoff)
+        endpoint.open_until = time.time() + endpoint.backoff
+
+    def acquire(self, exclude=()):
+        """Get the least loaded healthy endpoint.
+
+        Endpoints in `exclude` are not considered. Endpoints whose
+        time out of rotation is over are probed first.
+
+        Raises :exc:`NoEndpointAvailable` if there is none. Call
+        :meth:`release` when done.
+        """
+        self._reload()
+        now = time.time()
+        with self._lock:
+            candidates = [ep for ep in self.endpoints if ep not in exclude]
+            ready = [ep for ep in candidates if ep.open_until is None]
+            expired = [ep for ep in candidates if (
+                ep.open_until is not None and ep.open_until <= now)]
+            for endpoint in expired:
+                # keep others from probing at the same time
+                endpoint.open_until = now + endpoint.backoff
+        for endpoint in expired:
+            healthy = self.probe(endpoint.host, endpoint.port)
+            with self._lock:
+                if not healthy:
+                    self._trip(endpoint)
+                    continue
+                # on probation: the next failure trips again
+                endpoint.open_until = None
+                endpoint.failures = self.failure_threshold - 1
+                ready.append(endpoint)
+        with self._lock:
+            ready = [ep for ep in ready if ep.open_until is None]
+            if not ready:
+                raise NoEndpointAvailable('no office server available')
+            endpoint = min(ready, key=lambda ep: ep.active)
+            endpoint.active += 1
+        return endpoint
+
+    def release(self, endpoint, ok=True):
+        """Tell that a conversion at `endpoint` is over.
+
+        `ok` tells whether the server could be reached.
+        """
+        with self._lock:
+            endpoint.active -= 1
+            if ok:
+                endpoint.failures = 0
+                endpoint.backoff = 0
+                return
+            endpoint.failures += 1
+            if endpoint.failures >= self.failure_threshold:
+                self._trip(endpoint)
+
+    def check(self):
+        """Probe all endpoints in rotation.
+
+        Unhealthy ones are taken out of rotation.
+        """
+        self._reload()
+        with self._lock:
+            endpoints = [ep for ep in self.endpoints if ep.open_until is None]
+        for endpoint in endpoints:
+            if not self.probe(endpoint.host, endpoint.port):
+                with self._lock:
+                    self._trip(endpoint)
+
+    def _check_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            self.check()
+
+    def convert(self, **kw):
+        """Convert a document at the least loaded healthy endpoint.
+
+        Keywords are passed to :func:`ulif.openoffice.convert.convert`
+        (except `url` and `no_launch`). Conversions failing because
+        the server cannot be reached are retried at other endpoints.
+        `unoconv` is told not to start an office server of its own
+        then.
+
+        Each server does one conversion at a time, but different
+        servers work in parallel.
+
+        Returns the result of :func:`ulif.openoffice.convert.convert`
+        or raises :exc:`NoEndpointAvailable`.
+        """
+        # we lock per endpoint, not globally
+        func = getattr(_convert.convert, '__wrapped__', _convert.convert)
+        tried = []
+        result = None
+        while True:
+            try:
+                endpoint = self.acquire(exclude=tried)
+            except NoEndpointAvailable:
+                if result is None:
+                    raise
+                return result  # all failed
+            ok = False
+            try:
+                with endpoint.lock:
+                    result = func(url=endpoint.url, no_launch=True, **kw)
+                ok = result[0] not in CONNECTION_ERRORS
+            finally:
+                self.release(endpoint, ok)
+            if ok:
+                return result
+            tried.append(endpoint)
+
+
+_pool = None
+
+
+def set_endpoints(endpoints=None, **kw):
+    """Let the ``oocp`` processor use office servers at `endpoints`.
+
+    `endpoints` and keywords are passed to :class:`EndpointPool`. If
+    `endpoints` is empty, the pool is removed and the
+    ``oocp-host`` and ``oocp-port`` options are used again.
+
+    Returns the new pool (or ``None``).
+    """
+    global _pool
+    _pool = endpoints and EndpointPool(endpoints, **kw) or None
+    return _pool
+
+
+def get_endpoint_pool():
+    """Get the pool set by :func:`set_endpoints`, if any.
+    """
+    return _pool
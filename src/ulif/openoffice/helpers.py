@@ -20,24 +20,32 @@
 Helpers for trivial jobs.
 """
 import base64
-import cssutils
+import json
 import logging
 import os
 import re
 import shutil
 import tempfile
+import threading
 import zipfile
-from bs4 import BeautifulSoup, UnicodeDammit
+import zlib
+from collections import OrderedDict, deque
+from hashlib import md5
 try:
     from cStringIO import StringIO  # Python 2.x
 except ImportError:                 # pragma: no cover
     from io import StringIO         # Python 3.x
-from pkg_resources import iter_entry_points
+try:
+    from importlib.metadata import entry_points   # Python >= 3.8
+except ImportError:                               # pragma: no cover
+    entry_points = None                           # use pkg_resources
 try:
     from urlparse import urlparse         # Python 2.x
 except ImportError:                       # pragma: no cover
     from urllib.parse import urlparse     # Python 3.x
+from multiprocessing.pool import ThreadPool
 from six import string_types
+from six.moves import zip as izip
 
 
 try:
@@ -146,6 +154,58 @@ def copy_to_secure_location(src):
     return dst
 
 
+#: Process-wide registry of entry points. Maps group names to dicts
+#: ``{<NAME>: <ENTRY_POINT>}``. Entry points are not loaded here.
+_entry_point_registry = {}
+
+#: Plugins already loaded. Maps ``(<GROUP>, <NAME>)`` to plugins.
+_loaded_plugins = {}
+
+_registry_lock = threading.Lock()
+
+
+def _iter_entry_points(group):
+    """Iterate over all entry points registered for `group`.
+
+    We use :mod:`importlib.metadata` if available and fall back to
+    `pkg_resources` (which is expensive to import) otherwise.
+    """
+    if entry_points is None:                    # pragma: no cover
+        from pkg_resources import iter_entry_points
+        return iter_entry_points(group=group)
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return eps.select(group=group)
+    return eps.get(group, [])                   # pragma: no cover
+
+
+def _get_registered_entry_points(group):
+    """Get a dict of (unloaded) entry points registered for `group`.
+
+    The installed distributions are scanned only once per `group` and
+    process.
+    """
+    result = _entry_point_registry.get(group, None)
+    if result is not None:
+        return result
+    with _registry_lock:
+        if group not in _entry_point_registry:
+            found = {}
+            for entry_point in _iter_entry_points(group):
+                found.setdefault(entry_point.name, entry_point)
+            _entry_point_registry[group] = found
+    return _entry_point_registry[group]
+
+
+def get_entry_point_names(group):
+    """Get a sorted list of names of entry points registered for `group`.
+
+    Different to :func:`get_entry_points` the registered plugins are
+    not imported.
+    """
+    return sorted(_get_registered_entry_points(group).keys())
+
+
 def get_entry_points(group):
     """Get all entry point plugins registered for group `group`.
 
@@ -153,38 +213,288 @@ def get_entry_points(group):
     key and ``<PLUGIN>`` as value where ``<NAME>`` is the name under
     which the respective plugin was registered with setuptools and
     ``<PLUGIN>`` is the registered component itself.
+
+    Entry points are looked up and loaded only once per process. Use
+    :func:`clear_entry_point_cache` if plugins are installed at
+    runtime.
+    """
+    result = dict()
+    for name, entry_point in _get_registered_entry_points(group).items():
+        key = (group, name)
+        if key not in _loaded_plugins:
+            _loaded_plugins[key] = entry_point.load()
+        result[name] = _loaded_plugins[key]
+    return result
+
+
+def clear_entry_point_cache():
+    """Forget about all entry points looked up so far.
+    """
+    with _registry_lock:
+        _entry_point_registry.clear()
+        _loaded_plugins.clear()
+
+
+#: Size of chunks read when extracting ZIP files.
+UNZIP_CHUNK_SIZE = 64 * 1024
+
+
+class ZipLimitError(ValueError):
+    """A ZIP archive exceeds some limit set for extraction.
     """
-    return dict(
-        [(x.name, x.load())
-         for x in iter_entry_points(group=group)])
 
 
-def unzip(path, dst_dir):
+def check_zip_limits(infos, max_size=None, max_ratio=None,
+                     max_members=None):
+    """Check ZIP members `infos` against limits.
+
+    `infos` is a list of :class:`zipfile.ZipInfo` instances as
+    retrieved from the central directory of a ZIP file.
+
+    `max_size` is the maximum total number of uncompressed bytes,
+    `max_ratio` the maximum ratio of uncompressed to compressed bytes
+    and `max_members` the maximum number of entries. Limits set to
+    ``None`` are not checked.
+
+    Raises :exc:`ZipLimitError` if a limit is exceeded.
+    """
+    if max_members is not None and len(infos) > max_members:
+        raise ZipLimitError(
+            'too many members in ZIP file: %s (max: %s)' % (
+                len(infos), max_members))
+    total_size = sum([info.file_size for info in infos])
+    if max_size is not None and total_size > max_size:
+        raise ZipLimitError(
+            'uncompressed ZIP content too big: %s bytes (max: %s)' % (
+                total_size, max_size))
+    compressed_size = sum([info.compress_size for info in infos])
+    if max_ratio is not None and total_size > max_ratio * max(
+            compressed_size, 1):
+        raise ZipLimitError(
+            'compression ratio of ZIP file too high (max: %s)' % max_ratio)
+
+
+def unzip(path, dst_dir, max_size=None, max_ratio=None, max_members=None):
     """Unzip the files stored in zipfile `path` in `dst_dir`.
 
     `dst_dir` is the directory where all contents of the ZIP file is
     stored into.
+
+    Members are written in chunks of :data:`UNZIP_CHUNK_SIZE` bytes,
+    so they are never held in memory completely.
+
+    `max_size`, `max_ratio`, and `max_members` limit the total
+    number of uncompressed bytes, the compression ratio and the
+    number of entries respectively. See :func:`check_zip_limits`. If
+    a limit is exceeded, :exc:`ZipLimitError` is raised. Limits are
+    checked before anything is extracted, the number of bytes written
+    is checked again while extracting.
     """
-    zf = zipfile.ZipFile(path)
-    # Create all dirs
-    dirs = sorted([name for name in zf.namelist() if name.endswith('/')])
-    for dir in dirs:
-        new_dir = os.path.join(dst_dir, dir)
-        if not os.path.exists(new_dir):
-            os.mkdir(new_dir)
-    # Create all files
-    for name in zf.namelist():
-        if name.endswith('/'):
-            continue
-        outfile = open(os.path.join(dst_dir, name), 'wb')
-        outfile.write(zf.read(name))
-        outfile.flush()
-        outfile.close()
-    zf.close()
+    with zipfile.ZipFile(path) as zf:
+        infos = zf.infolist()
+        check_zip_limits(infos, max_size, max_ratio, max_members)
+        # Create all dirs
+        dirs = sorted([info.filename for info in infos
+                       if info.filename.endswith('/')])
+        for dir in dirs:
+            new_dir = os.path.join(dst_dir, dir)
+            if not os.path.exists(new_dir):
+                os.mkdir(new_dir)
+        # Create all files
+        written = 0
+        for info in infos:
+            if info.filename.endswith('/'):
+                continue
+            src = zf.open(info)
+            with open(os.path.join(dst_dir, info.filename), 'wb') as outfile:
+                while True:
+                    chunk = src.read(UNZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    written += len(chunk)
+                    if max_size is not None and written > max_size:
+                        raise ZipLimitError(
+                            'uncompressed ZIP content too big '
+                            '(max: %s)' % max_size)
+                    outfile.write(chunk)
+            src.close()
     return
 
 
-def zip(path):
+#: Timestamp set for all entries of ZIP files we create.
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+#: Filename extensions of files that are already compressed.
+COMPRESSED_EXTENSIONS = set([
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.zip', '.gz', '.tgz',
+    '.bz2', '.xz', '.7z', '.odt', '.ods', '.odp', '.odg', '.docx',
+    '.xlsx', '.pptx', '.epub', '.jar', '.mp3', '.mp4', '.ogg'])
+
+#: Leading bytes of files that are already compressed.
+COMPRESSED_MAGIC = (
+    b'\xff\xd8\xff',         # JPEG
+    b'\x89PNG\r\n\x1a\n',    # PNG
+    b'GIF8',                 # GIF
+    b'PK\x03\x04',           # ZIP and friends
+    b'\x1f\x8b',             # gzip
+    b'BZh',                  # bzip2
+    b'\xfd7zXZ\x00',         # xz
+    b"7z\xbc\xaf'\x1c",       # 7-zip
+    )
+
+
+def is_compressed(path):
+    """Tell whether file in `path` is compressed already.
+
+    We look at the filename extension and the first bytes of the
+    file. WebP images are detected by extension only.
+    """
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return True
+    with open(path, 'rb') as fd:
+        head = fd.read(8)
+    return head.startswith(COMPRESSED_MAGIC)
+
+
+def _compress_member(file_path, level, store_compressed):
+    """Compress file in `file_path` to be stored in a ZIP file.
+
+    Returns a tuple ``(<COMPRESS_TYPE>, <CRC>, <SIZE>, <COMPRESS_SIZE>,
+    <FILE>)`` with ``<FILE>`` being a file opened for reading, that
+    contains the data to store, already at position zero. For stored
+    members this is the file in `file_path` itself, otherwise a
+    temporary file.
+    """
+    compress_type = zipfile.ZIP_DEFLATED
+    if level == 0 or (store_compressed and is_compressed(file_path)):
+        compress_type = zipfile.ZIP_STORED
+    compressor, out = None, None
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        out = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    crc, size, compress_size = 0, 0, 0
+    with open(file_path, 'rb') as src:
+        while True:
+            chunk = src.read(UNZIP_CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+                out.write(chunk)
+            compress_size += len(chunk)
+    if compressor is None:
+        out = open(file_path, 'rb')
+    else:
+        chunk = compressor.flush()
+        compress_size += len(chunk)
+        out.write(chunk)
+        out.seek(0)
+    return compress_type, crc & 0xffffffff, size, compress_size, out
+
+
+def _zip_members(path):
+    """Get a list of members to put into a ZIP file created from `path`.
+
+    Returns a list of tuples ``(<ARC_NAME>, <PATH>)`` in the order they
+    should be stored. ``<PATH>`` is ``None`` for directories. See
+    :func:`zip` for details.
+    """
+    if os.path.isfile(path):
+        return [(os.path.basename(path), path)]
+    members = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for dir in dirs:
+            # XXX: Maybe the wrong way to store directories?
+            dir_path = os.path.join(root, dir)
+            members.append((dir_path[len(path) + 1:] + '/', None))
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            members.append((file_path[len(path) + 1:], file_path))
+    return members
+
+
+def _iter_raw_write(zout, info, data):
+    """Write member `info` with data from file `data` to `zout`.
+
+    `data` must be compressed already and `info` must have sizes and
+    CRC set. This is a generator that yields ``None`` whenever a chunk
+    of data was written.
+
+    :mod:`zipfile` offers no way to store precompressed data
+    (:meth:`zipfile.ZipFile.open` in write mode compresses itself and
+    cannot do that in parallel or with known sizes on unseekable
+    streams). We therefore use internals of
+    :class:`zipfile.ZipFile` that are the same in all Python versions
+    supported: `fp`, `filelist`, `NameToInfo`, `start_dir` and
+    :meth:`zipfile.ZipInfo.FileHeader`. Tests check the archives we
+    create with :meth:`zipfile.ZipFile.testzip`.
+    """
+    info.header_offset = zout.fp.tell()
+    zout.fp.write(info.FileHeader())
+    with data:
+        for chunk in iter(lambda: data.read(UNZIP_CHUNK_SIZE), b''):
+            zout.fp.write(chunk)
+            yield
+    # register the member like ZipFile.write() does
+    zout.filelist.append(info)
+    zout.NameToInfo[info.filename] = info
+    zout.start_dir = zout.fp.tell()
+
+
+def _iter_zip_writes(zout, members, level, store_compressed, threads):
+    """Write `members` to the :class:`zipfile.ZipFile` `zout`.
+
+    This is a generator that yields ``None`` whenever a chunk of data
+    was written to `zout`. It does not close `zout`.
+
+    With `threads` > 1, members are compressed in a pool of threads,
+    but at most ``threads * 2`` of them ahead of the one written, as
+    each compressed member is held in a temporary file.
+    """
+    def compress(member):
+        if member[1] is None:
+            return None
+        return _compress_member(member[1], level, store_compressed)
+
+    def compress_ahead(pool):
+        pending = deque()
+        for member in members:
+            pending.append(pool.apply_async(compress, (member, )))
+            if len(pending) >= threads * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    pool = None
+    if threads > 1:
+        pool = ThreadPool(threads)
+        results = compress_ahead(pool)
+    else:
+        results = (compress(member) for member in members)
+    try:
+        for (arc_name, file_path), result in izip(members, results):
+            info = zipfile.ZipInfo(arc_name, ZIP_DATE_TIME)
+            if result is None:
+                info.external_attr = 0o40755 << 16 | 0x10
+                zout.writestr(info, '')
+                yield
+                continue
+            (info.compress_type, info.CRC, info.file_size,
+             info.compress_size, data) = result
+            info.external_attr = (
+                os.stat(file_path).st_mode & 0xFFFF) << 16
+            for _ in _iter_raw_write(zout, info, data):
+                yield
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def zip(path, level=None, store_compressed=True, threads=0):
     """Create a ZIP file out of `path`.
 
     If `path` points to a file then a ZIP archive is created with this
@@ -199,35 +509,90 @@ def zip(path):
     that these entries are recovered correctly later on with all tools
     and utilities on all platforms.
 
+    `level` is the compression level (``0`` to ``9``). ``0`` stores
+    all files uncompressed, ``None`` means the :mod:`zlib` default.
+
+    If `store_compressed` is ``True`` (the default), files that are
+    compressed already (see :func:`is_compressed`) are stored
+    uncompressed.
+
+    If `threads` is greater than one, files are compressed in that
+    many threads.
+
+    Entries are added in sorted order and get :data:`ZIP_DATE_TIME`
+    as timestamp, so the same input leads to the same archive.
+
     .. note:: It is the callers responsibility to remove the directory
               the zipfile is created in after usage.
     """
     if not os.path.isdir(path) and not os.path.isfile(path):
         raise ValueError('Must be an existing path or directory: %s' % path)
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
 
     new_dir = tempfile.mkdtemp()
     basename = os.path.basename(path)
     new_path = os.path.join(new_dir, basename) + '.zip'
-    zout = zipfile.ZipFile(new_path, 'w', zipfile.ZIP_DEFLATED)
 
-    if os.path.isfile(path):
-        zout.write(path, basename)
+    zout = zipfile.ZipFile(new_path, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        for _ in _iter_zip_writes(
+                zout, _zip_members(path), level, store_compressed, threads):
+            pass
+    finally:
         zout.close()
-        return new_path
+    return new_path
 
-    for root, dirs, files in os.walk(path):
-        for dir in dirs:
-            # XXX: Maybe the wrong way to store directories?
-            dir_path = os.path.join(root, dir)
-            arc_name = dir_path[len(path) + 1:] + '/'
-            info = zipfile.ZipInfo(arc_name)
-            zout.writestr(info, '')
-        for file in files:
-            file_path = os.path.join(root, file)
-            arc_name = file_path[len(path) + 1:]
-            zout.write(file_path, arc_name)
+
+class _ZipStream(object):
+    """A write-only, non-seekable buffer for :func:`iter_zip`.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, *args):
+        raise IOError('not seekable')
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_zip(path, level=None, store_compressed=True):
+    """Create a ZIP file out of `path` on the fly.
+
+    Returns an iterator over byte strings, that make up a ZIP file
+    with the same entries :func:`zip` would create for the given
+    arguments. The ZIP file is never stored completely, neither on
+    disk nor in memory. Only the compressed form of the current entry
+    is held in a temporary file.
+    """
+    if not os.path.isdir(path) and not os.path.isfile(path):
+        raise ValueError('Must be an existing path or directory: %s' % path)
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    stream = _ZipStream()
+    zout = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+    for _ in _iter_zip_writes(
+            zout, _zip_members(path), level, store_compressed, 0):
+        data = stream.pop()
+        if data:
+            yield data
     zout.close()
-    return new_path
+    yield stream.pop()
 
 
 def remove_file_dir(path):
@@ -247,25 +612,96 @@ def remove_file_dir(path):
     return
 
 
-RE_CSS_TAG = re.compile('(.+?)(\.?\s*){')
-RE_CSS_STMT_START = re.compile('\s*(.*?{.*?)')
-RE_CURLY_OPEN = re.compile('{([^ ])')
-RE_CURLY_CLOSE = re.compile('([^ ])}')
-RE_EMPTY_COMMENTS = re.compile('/\*\s*\*/')
+#: Things we look out for when scanning HTML for styles: comments,
+#: scripts and style tags.
+RE_HTML_STYLE_SCAN = re.compile(r'<(?:!--|(script|/?style)(?=[\s/>]))', re.I)
+
+#: End of a style element.
+RE_STYLE_END = re.compile(r'</\s*style\s*>', re.I)
+
+#: End of a script element.
+RE_SCRIPT_END = re.compile(r'</\s*script\s*>', re.I)
+
+#: CDATA wrappers in styles, maybe with HTML comments inside.
+RE_CDATA_WRAPPED = re.compile(
+    r'(?:/\*)?<!\[CDATA\[(?:\*/)?(?:.*?<!--)?(.*?)(?:-->.*?)?'
+    r'(?:/\*)?\]\]>(?:\*/)?', re.S)
+
+#: Things we look out for when normalizing CSS: comments and braces.
+RE_CSS_SCAN = re.compile(r'/\*.*?\*/|[{}]', re.S)
+
+
+def _strip_style_wrappers(css):
+    """Remove CDATA sections and HTML comment markers from `css`.
+    """
+    if '<![CDATA[' in css:
+        css = RE_CDATA_WRAPPED.sub(lambda match: match.group(1), css)
+    if '<!--' in css or '-->' in css:
+        css = css.replace('<!--', '').replace('-->', '')
+    return css.replace('<style>', '\n')
+
+
+def _last_char(parts):
+    """Get the last char of the concatenated strings in `parts`.
+    """
+    for part in reversed(parts):
+        if part:
+            return part[-1]
+    return ''
+
+
+def _rstrip_parts(parts):
+    """Remove trailing whitespace from list of strings `parts`.
+    """
+    while parts and parts[-1].isspace() or parts and not parts[-1]:
+        parts.pop()
+    if parts:
+        parts[-1] = parts[-1].rstrip()
 
-RE_CDATA_MASSAGE = '(((/\*)?<!\[CDATA\[(\*/)?)((.*?)<!--)?'
-RE_CDATA_MASSAGE += '(.*?)(-->(.*?))?((/\*)?]]>(\*/)?))'
 
-MARKUP_MASSAGE = [
-    (re.compile('(<[^<>]*)/>'), lambda x: x.group(1) + ' />'),
-    (re.compile('<!\s+([^<>]*)>'),
-     lambda x: '<!' + x.group(1) + '>')
-    ]
+def normalize_css(css):
+    """Normalize `css` in a single pass.
 
-CDATA_MASSAGE = MARKUP_MASSAGE
-CDATA_MASSAGE.extend([
-    (re.compile(RE_CDATA_MASSAGE, re.M + re.S),
-     lambda match: match.group(7))])
+    Each rule set is put on a new line with its selector lowercased,
+    curly brackets are surrounded by spaces and empty comments are
+    removed.
+    """
+    parts = []
+    pos = 0             # start of the not yet copied part of `css`
+    sel_start = 0       # where the next selector might start
+    for match in RE_CSS_SCAN.finditer(css):
+        start, end = match.span()
+        token = match.group(0)
+        if token == '{':
+            # Put selector on a new line and lowercase it
+            semicolon = css.rfind(';', sel_start, start)
+            if semicolon != -1:
+                parts.append(css[pos:semicolon + 1])
+                pos = sel_start = semicolon + 1
+            parts.append(css[pos:sel_start])
+            _rstrip_parts(parts)
+            parts.extend(['\n', css[sel_start:start].lstrip().lower(), '{'])
+            if end < len(css) and not css[end].isspace():
+                parts.append(' ')
+            pos = sel_start = end
+        elif token == '}':
+            parts.append(css[pos:start])
+            if _last_char(parts) not in ('', ' '):
+                parts.append(' ')
+            parts.append('}')
+            pos = sel_start = end
+        elif not token[2:-2].strip():
+            # An empty comment
+            parts.append(css[pos:start])
+            pos = end
+            sel_start = max(sel_start, end)
+        else:
+            sel_start = end
+    parts.append(css[pos:])
+    css = ''.join(parts)
+    if css.startswith('\n'):
+        css = css[1:]
+    return css
 
 
 def extract_css(html_input, basename='sample.html', prettify_html=False):
@@ -275,66 +711,156 @@ def extract_css(html_input, basename='sample.html', prettify_html=False):
     Returns tuple ``<MODIFIED_HTML>, <CSS-CODE>``.
 
     If the `html_input` contains any ``<style>`` tags, their content
-    is aggregated and returned in ``<CSS-CODE``.
+    is aggregated and returned in ``<CSS-CODE``. CDATA and comment
+    wrappers are removed from styles and the result is normalized by
+    :func:`normalize_css`.
 
     The tags are all stripped from `html` input and replaced by a link
     to a stylesheet file named ``<basename>.css``. Any extension in
     `basename` is stripped. So ``sample.html`` as `basename` will
     result in a link to ``sample.css``. The same applies for a
     `basename` ``sample.css`` or ``sample``. The modified HTML code is
-    returned as first item of the result tuple.
+    returned as first item of the result tuple. Apart from styles the
+    HTML code is left untouched.
+
+    `html_input` is scanned only once. Styles in comments and scripts
+    are ignored.
 
     If `pretify_html` is True, the generated HTML code is prettified
     by BeautifulSoup. This might result in unexpected, visible gaps in
     rendered output.
     """
-    # create HTML massage that removes CDATA and HTML comments in styles
-    for fix, m in CDATA_MASSAGE:
-        html_input = fix.sub(m, html_input)
-    soup = BeautifulSoup(html_input, 'html.parser')
-    css = '\n'.join([style.text for style in soup.findAll('style')])
-    if '<style>' in css:
-        css = css.replace('<style>', '\n')
-
-    # lowercase leading tag names
-    css = re.sub(
-        RE_CSS_TAG,
-        lambda match:
-        match.group(1).lower() + match.group(2) + '{', css)
-
-    # set indent of all CSS statement lines to nil.
-    css = re.sub(RE_CSS_STMT_START,
-                 lambda match: '\n' + match.group(1), css)
-
-    # insert spaces after and before curly brackets.
-    css = re.sub(RE_CURLY_OPEN, lambda match: '{ ' + match.group(1), css)
-    css = re.sub(RE_CURLY_CLOSE, lambda match: match.group(1) + ' }', css)
-    css_name = os.path.splitext(basename)[0] + '.css'
-
-    # Remove empty style comments
-    css = re.sub(RE_EMPTY_COMMENTS, lambda match: '', css)
-
-    if css.startswith('\n'):
-        css = css[1:]
-
-    for num, style in enumerate(soup.findAll('style')):
-        if num == 0 and css != '':
-            # replace first style with link to stylesheet
-            # if there are any styles contained
-            new_tag = soup.new_tag(
-                'link', rel='stylesheet', type='text/css', href=css_name)
-            style.replace_with(new_tag)
+    parts = []          # HTML parts w/o styles
+    styles = []         # contents of style tags
+    link_index = None   # index of first style in `parts`
+    pos = 0             # start of the not yet copied part of input
+    search = 0
+    while True:
+        match = RE_HTML_STYLE_SCAN.search(html_input, search)
+        if match is None:
+            break
+        start, search = match.span()
+        tag = (match.group(1) or '').lower()
+        if not tag:
+            # a comment
+            end = html_input.find('-->', search)
+            if end == -1:
+                break
+            search = end + 3
+            continue
+        if tag == 'script':
+            end = RE_SCRIPT_END.search(html_input, search)
+            if end is None:
+                break
+            search = end.end()
+            continue
+        tag_end = html_input.find('>', search)
+        if tag_end == -1:
+            break
+        parts.append(html_input[pos:start])
+        pos = search = tag_end + 1
+        if tag == '/style' or html_input[tag_end - 1] == '/':
+            # stray end tag or empty style
+            continue
+        end = RE_STYLE_END.search(html_input, search)
+        if end is None:
+            styles.append(html_input[search:])
+            pos = search = len(html_input)
         else:
-            style.extract()
+            styles.append(html_input[search:end.start()])
+            pos = search = end.end()
+        if link_index is None:
+            link_index = len(parts)
+            parts.append('')
+    parts.append(html_input[pos:])
+
+    css = normalize_css(
+        '\n'.join([_strip_style_wrappers(style) for style in styles]))
+    css_name = os.path.splitext(basename)[0] + '.css'
     if css == '':
         css = None
+    elif link_index is not None:
+        parts[link_index] = (
+            '<link href="%s" rel="stylesheet" type="text/css"/>' % css_name)
+    html = ''.join(parts)
     if prettify_html:
-        return soup.prettify(), css
-    return UnicodeDammit(str(soup)).markup, css
+        from bs4 import BeautifulSoup
+        return BeautifulSoup(html, 'html.parser').prettify(), css
+    return html, css
+
+
+#: Start of a heading tag.
+RE_HEADING_START = re.compile('<h[1-6]')
+
+#: A heading number: digits and dots, maybe preceded by whitespace.
+#: No nested quantifiers here, to match in linear time.
+RE_HEADING_NUMBER = re.compile(r'\s*([\d\.]*)')
 
 
-RE_HEAD_NUM = re.compile('(<h[1-6][^>]*>\s*)(([\d\.]+)+)([^\d])',
-                         re.M + re.S)
+def _find_heading_number(html_input, gt):
+    """Find a heading number after the closing bracket at pos `gt`.
+
+    Returns a tuple ``(<RUN_START>, <RUN_END>)`` of the heading number
+    position in `html_input` or ``None`` if there is no number.
+
+    A heading number is a run of digits and dots, maybe preceded by
+    whitespace, that is followed by some non-digit char. At end of
+    input the run is cut at its last dot (which then is the
+    terminator) if possible.
+    """
+    match = RE_HEADING_NUMBER.match(html_input, gt + 1)
+    run_start, run_end = match.span(1)
+    if run_end == run_start:
+        return None
+    if run_end == len(html_input):
+        # No terminator. Use the last dot, if it is not the first char.
+        run_end = html_input.rfind('.', run_start + 1, run_end)
+        if run_end == -1:
+            return None
+    return run_start, run_end
+
+
+def fix_heading_numbers(html_input):
+    """Wrap leading numbers of headings in ``<span>`` tags.
+
+    We look for heading contents of style ``1.1Heading`` where the
+    number is not separated from the real heading text. In that case
+    we wrap the heading number in a ``<span class="u-o-headnum">``
+    tag:
+
+      >>> fix_heading_numbers('<h1>1.1Heading</h1>')
+      '<h1><span class="u-o-headnum">1.1</span>Heading</h1>'
+
+    `html_input` is scanned once, so runtime is linear to its length,
+    regardless of the numbers contained.
+    """
+    result = []
+    pos = 0         # start of the not yet copied part of input
+    search = 0      # where to look for the next heading tag
+    gt = -1         # position of the last closing bracket found
+    runs = {}       # heading numbers found, by closing bracket position
+    while True:
+        match = RE_HEADING_START.search(html_input, search)
+        if match is None:
+            break
+        start = match.start()
+        search = start + 1
+        if gt < start + 3:
+            gt = html_input.find('>', start + 3)
+            if gt == -1:
+                break
+        if gt not in runs:
+            runs[gt] = _find_heading_number(html_input, gt)
+        if runs[gt] is None:
+            continue
+        run_start, run_end = runs[gt]
+        result.extend([
+            html_input[pos:run_start], '<span class="u-o-headnum">',
+            html_input[run_start:run_end], '</span>',
+            html_input[run_end]])
+        pos = search = run_end + 1
+    result.append(html_input[pos:])
+    return ''.join(result)
 
 
 def cleanup_html(html_input, basename,
@@ -344,7 +870,8 @@ def cleanup_html(html_input, basename,
     If `fix_head_nums` is ``True``, we look for heading contents of
     style ``1.1Heading`` where the number is not separated from the
     real heading text. In that case we wrap the heading number in a
-    ``<span class="u-o-headnum"> tag.
+    ``<span class="u-o-headnum"> tag. See
+    :func:`fix_heading_numbers` for details.
 
     If `fix_img_links` is ``True`` we run
     :func:`rename_html_img_links` over the result.
@@ -365,18 +892,196 @@ def cleanup_html(html_input, basename,
     if fix_head_nums is not True:
         return html_input, img_name_map
     # Wrap leading num-dots in headings in own span-tag.
-    html_input = re.sub(
-        RE_HEAD_NUM,
-        lambda match: ''.join([
-            match.group(1),
-            '<span class="u-o-headnum">',
-            match.group(3),
-            '</span>',
-            match.group(4)]),
-        html_input)
+    html_input = fix_heading_numbers(html_input)
     return html_input, img_name_map
 
 
+class ThreadLocalStreamHandler(logging.Handler):
+    """A logging handler that writes to a stream set per thread.
+
+    Records emitted in threads, that set no stream, are dropped.
+    """
+    def __init__(self, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self._local = threading.local()
+
+    def set_stream(self, stream):
+        self._local.stream = stream
+
+    def emit(self, record):
+        stream = getattr(self._local, 'stream', None)
+        if stream is None:
+            return
+        stream.write(self.format(record) + '\n')
+
+
+#: `cssutils` related objects, created once. See :func:`_setup_cssutils`.
+_cssutils_env = {}
+_cssutils_lock = threading.Lock()
+
+
+def _setup_cssutils():
+    """Set up logging and serializers for `cssutils`.
+
+    This is done only once per process. Returns a dict with the
+    logging handler, the serializers and a lock to hold while
+    serializing.
+    """
+    if _cssutils_env:
+        return _cssutils_env
+    with _cssutils_lock:
+        if _cssutils_env:
+            return _cssutils_env
+        import cssutils
+        handler = ThreadLocalStreamHandler(logging.WARNING)
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        logger = logging.getLogger('ulif.openoffice.cssutils')
+        logger.propagate = False
+        logger.addHandler(handler)
+        cssutils.log.setLog(logger)
+        serializers = {}
+        for minified in (True, False):
+            serializer = cssutils.CSSSerializer()
+            if minified:
+                serializer.prefs.useMinified()
+            serializers[minified] = serializer
+        _cssutils_env.update(
+            cssutils=cssutils, handler=handler, serializers=serializers,
+            lock=threading.Lock())
+    return _cssutils_env
+
+
+class CSSCache(object):
+    """A bounded LRU cache for results of :func:`cleanup_css`.
+
+    Maps ``(<CSS_DIGEST>, <MINIFIED>)`` to ``(<CSS>, <ERRORS>)``. At
+    most `maxsize` entries are kept in memory.
+
+    If `path` is set, entries are additionally stored as JSON files
+    in this directory and can be shared by processes or survive
+    restarts. The directory is created if it does not exist. At most
+    `maxfiles` entries are kept there, the least recently used ones
+    are removed. When pruning, a tenth of them is removed in one go,
+    so the directory is not listed on each new entry. Files are
+    counted once and then tracked in memory. Entries written by other
+    processes are therefore noticed only when pruning.
+    """
+    def __init__(self, maxsize=256, path=None, maxfiles=4096):
+        self.maxsize = maxsize
+        self.maxfiles = maxfiles
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.set_path(path)
+
+    def set_path(self, path):
+        """Set the directory to store entries in.
+
+        `path` can be ``None`` to store entries in memory only.
+        """
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self._files = None                      # not counted yet
+
+    def get_key(self, css_input, minified):
+        """Get the key under which results for `css_input` are stored.
+        """
+        digest = md5(css_input.encode('utf-8')).hexdigest()
+        return '%s-%s' % (digest, minified and 'min' or 'full')
+
+    def get(self, css_input, minified):
+        """Get the results stored for `css_input` and `minified`.
+
+        Returns ``None`` if there are no such results.
+        """
+        key = self.get_key(css_input, minified)
+        with self._lock:
+            if key in self._entries:
+                value = self._entries.pop(key)
+                self._entries[key] = value
+                return value
+        if self.path is None:
+            return None
+        path = os.path.join(self.path, key + '.json')
+        try:
+            with open(path, 'r') as fd:
+                value = json.load(fd)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        if not (isinstance(value, list) and len(value) == 2 and all(
+                isinstance(x, string_types) for x in value)):
+            return None
+        value = tuple(value)
+        self._remember(key, value)
+        return value
+
+    def set(self, css_input, minified, value):
+        """Store `value` for `css_input` and `minified`.
+        """
+        key = self.get_key(css_input, minified)
+        self._remember(key, value)
+        if self.path is None:
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.')
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(list(value), tmp_file)
+            os.rename(tmp_path, os.path.join(self.path, key + '.json'))
+            with self._lock:
+                if self._files is None:
+                    self._files = len(os.listdir(self.path))
+                else:
+                    self._files += 1            # or replaced one
+                full = self._files > self.maxfiles
+            if full:
+                self._prune()
+        except (IOError, OSError):
+            # storing on disk is optional; the result is in memory.
+            pass
+
+    def _prune(self):
+        # remove least recently used files if there are too many
+        names = os.listdir(self.path)
+        keep = self.maxfiles - self.maxfiles // 10
+        with self._lock:
+            self._files = len(names)
+            if len(names) > self.maxfiles:
+                self._files = keep
+        if len(names) <= self.maxfiles:
+            return
+        entries = []
+        for name in names:
+            path = os.path.join(self.path, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                continue                        # removed meanwhile
+        entries.sort()
+        for mtime, path in entries[:len(entries) - keep]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries kept in memory.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+#: The cache used by :func:`cleanup_css`.
+css_cache = CSSCache()
+
+
 def cleanup_css(css_input, minified=True):
     """Cleanup CSS code delivered in `css_input`, a string.
 
@@ -389,28 +1094,29 @@ def cleanup_css(css_input, minified=True):
     load, etc. If you want pretty non-minified output, set `minified`
     to ``False``.
 
+    Results are cached in :data:`css_cache`, so the same CSS code is
+    parsed only once.
+
     We expect and return texts, not bytestreams.
     """
-    # Set up a local logger for warnings and errors
+    minified = minified is True
+    result = css_cache.get(css_input, minified)
+    if result is not None:
+        return result
+    env = _setup_cssutils()
     local_log = StringIO()
-    handler = logging.StreamHandler(local_log)
-    handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
-    handler.propagate = False
-    handler.setLevel(logging.WARNING)
-    logger = logging.getLogger()
-    logger.addHandler(handler)
-
-    cssutils.log.setLog(logger)
-    cssutils.ser.prefs.useDefaults()
-    if minified is True:
-        cssutils.ser.prefs.useMinified()
-
-    sheet = cssutils.parseString(css_input)
-
-    local_log.flush()
+    env['handler'].set_stream(local_log)
+    try:
+        sheet = env['cssutils'].parseString(css_input)
+        with env['lock']:
+            env['cssutils'].setSerializer(env['serializers'][minified])
+            css_bytes = sheet.cssText
+    finally:
+        env['handler'].set_stream(None)
     encoding = sheet.encoding or 'utf-8'
-    css_text = sheet.cssText.decode(encoding)
-    return css_text, local_log.getvalue()
+    result = (css_bytes.decode(encoding), local_log.getvalue())
+    css_cache.set(css_input, minified, result)
+    return result
 
 
 def rename_html_img_links(html_input, basename):
@@ -444,6 +1150,7 @@ def rename_html_img_links(html_input, basename):
     I.e. you will get unicode snippets under Python 2.x and text
     (or `str`) under Python 3.x.
     """
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(html_input, 'html.parser')
     img_tags = soup.findAll('img')
     img_map = {}
@@ -0,0 +1,747 @@
+#
+# jobs.py
+#
+# Copyright (C) 2015 Uli Fouquet
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Run conversions in background.
+
+A :class:`JobManager` accepts conversion jobs and runs them in a
+bounded pool of worker threads. Results are stored in cache and can
+be retrieved by the cache key of a finished job.
+
+Jobs are stored in a :class:`SpoolQueue` on disk, so they survive
+restarts and can be processed by several processes. If the spool
+directory is shared between machines, conversions can be done by
+``oooworker`` processes (see :func:`main`) on other hosts.
+"""
+import argparse
+import errno
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from ulif.openoffice.admission import (
+    DEFAULT_URGENCY, LOWEST_URGENCY, get_urgency, schedule_key)
+from ulif.openoffice.cachemanager import CacheManager, get_marker
+from ulif.openoffice.client import convert_doc
+from ulif.openoffice.endpoints import set_endpoints
+from ulif.openoffice.helpers import copy_to_secure_location
+from ulif.openoffice.probe import probe_document
+
+
+#: Job states.
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+#: States of jobs that will not change any more.
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+#: All job states. Each has its own directory in a spool dir.
+STATES = (QUEUED, RUNNING) + FINISHED_STATES
+
+#: Regular expression matching valid job ids.
+RE_JOB_ID = re.compile('^[0-9a-f]{32}$')
+
+
+class Job(object):
+    """A conversion job.
+
+    `src_path` is the path of the document to convert. `options` are
+    the conversion options as accepted by
+    :func:`ulif.openoffice.client.convert_doc`. `urgency` and `cost`
+    (the expected cost of the conversion) determine when the job is
+    run, see :func:`ulif.openoffice.admission.schedule_key`.
+
+    Jobs done by workers keeping their results in the spool (see
+    :class:`JobManager`) have `result` (the filename of the converted
+    doc) and `metadata` set.
+    """
+    def __init__(self, src_path, options, job_id=None,
+                 urgency=DEFAULT_URGENCY, cost=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.src_path = src_path
+        self.options = options
+        self.urgency = urgency
+        self.cost = cost
+        self.state = QUEUED
+        self.cache_key = None
+        self.error = None
+        self.created = time.time()
+        self.attempts = 0
+        self.result = None
+        self.metadata = None
+
+    @property
+    def result_path(self):
+        """Path of the converted doc kept in the spool or ``None``.
+        """
+        if self.result is None:
+            return None
+        return os.path.join(
+            os.path.dirname(self.src_path), 'result', self.result)
+
+    def as_dict(self):
+        """Get job data as dict, suitable for JSON serialization.
+        """
+        return dict(
+            id=self.id, state=self.state, cache_key=self.cache_key,
+            error=self.error, created=self.created)
+
+    def dump(self):
+        """Get all job data (including options) as dict.
+        """
+        data = self.as_dict()
+        data.update(
+            options=self.options, attempts=self.attempts,
+            filename=os.path.basename(self.src_path), result=self.result,
+            metadata=self.metadata, urgency=self.urgency, cost=self.cost)
+        return data
+
+    @classmethod
+    def load(cls, data, src_path):
+        """Create a job from `data` as created by :meth:`dump`.
+        """
+        job = cls(src_path, data['options'], job_id=data['id'])
+        for name in ('state', 'cache_key', 'error', 'created', 'attempts'):
+            setattr(job, name, data[name])
+        job.result = data.get('result')
+        job.metadata = data.get('metadata')
+        job.urgency = data.get('urgency', DEFAULT_URGENCY)
+        job.cost = data.get('cost')
+        return job
+
+
+def _write_json(path, data):
+    # write `data` to `path` atomically
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as tmp_file:
+        json.dump(data, tmp_file)
+    os.rename(tmp_path, path)
+
+
+def _read_json(path):
+    with open(path, 'r') as fd:
+        return json.load(fd)
+
+
+def _rename(src, dst):
+    # rename `src` to `dst`. Return ``False`` if `src` vanished.
+    try:
+        os.rename(src, dst)
+    except OSError as err:
+        if err.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+            raise
+        return False
+    return True
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+class SpoolQueue(object):
+    """A persistent queue of conversion jobs in directory `path`.
+
+    Each job is a directory containing the source doc and a
+    ``job.json`` file with options and state. The directory is moved
+    between subdirectories ``queued/``, ``running/``, ``done/``,
+    ``failed/`` and ``cancelled/`` of `path` by atomic renames. This
+    way several processes (on several machines, if `path` is on a
+    shared filesystem) can use the same queue.
+
+    Jobs are claimed by workers with a lease of `lease_time`
+    seconds. Leases not renewed in time are considered as crashed
+    workers and their jobs are queued again, at most `max_attempts`
+    times. Of finished jobs only the last `max_finished` are kept.
+
+    New and requeued jobs are prepared in ``incoming/``. Jobs left
+    there for more than `lease_time` seconds by crashed processes are
+    queued (or removed, if incomplete) by :meth:`requeue_expired`.
+    """
+    def __init__(self, path, lease_time=600, max_attempts=3,
+                 max_finished=1000):
+        self.path = path
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.max_finished = max_finished
+        self._index = {}    # job id -> scheduling data of queued jobs
+        self._lock = threading.Lock()
+        for name in STATES + ('incoming', ):
+            try:
+                os.makedirs(os.path.join(path, name))
+            except OSError:
+                if not os.path.isdir(os.path.join(path, name)):
+                    raise
+
+    def _job_dir(self, state, job_id):
+        return os.path.join(self.path, state, job_id)
+
+    def _load(self, state, job_id):
+        # load job `job_id` stored in state dir `state` or ``None``
+        job_dir = self._job_dir(state, job_id)
+        try:
+            data = _read_json(os.path.join(job_dir, 'job.json'))
+        except (IOError, OSError, ValueError):
+            return None
+        job = Job.load(data, os.path.join(job_dir, data['filename']))
+        if state != 'incoming':
+            job.state = state
+        return job
+
+    def put(self, src_path, options, move=True, urgency=DEFAULT_URGENCY):
+        """Queue a job converting `src_path` with `options`.
+
+        The document in `src_path` is moved into the queue (or copied,
+        if `move` is false). The cost of the job is estimated by
+        probing the document. Returns the new :class:`Job`.
+        """
+        job = Job(src_path, options, urgency=get_urgency(urgency),
+                  cost=probe_document(src_path)['cost'])
+        tmp_dir = self._job_dir('incoming', job.id)
+        os.mkdir(tmp_dir)
+        dst_path = os.path.join(tmp_dir, os.path.basename(src_path))
+        if move:
+            shutil.move(src_path, dst_path)
+        else:
+            shutil.copy2(src_path, dst_path)
+        _write_json(os.path.join(tmp_dir, 'job.json'), job.dump())
+        os.rename(tmp_dir, self._job_dir(QUEUED, job.id))
+        job.src_path = os.path.join(
+            self._job_dir(QUEUED, job.id), os.path.basename(src_path))
+        return job
+
+    def get(self, job_id):
+        """Get job with id `job_id` or ``None``.
+        """
+        if not RE_JOB_ID.match(job_id or ''):
+            return None
+        for attempt in range(2):
+            # jobs moved while we look might be missed once
+            for state in STATES + ('incoming', ):
+                job = self._load(state, job_id)
+                if job is not None:
+                    return job
+        return None
+
+    def count(self, state=QUEUED):
+        """Get number of jobs in `state`.
+        """
+        return len(os.listdir(os.path.join(self.path, state)))
+
+    def _queued(self):
+        # ids and costs of queued jobs in the order they should be
+        # processed. Scheduling data does not change while jobs are
+        # queued, so we read the job.json of each job only once.
+        job_ids = os.listdir(os.path.join(self.path, QUEUED))
+        with self._lock:
+            index = dict([(job_id, self._index[job_id])
+                          for job_id in job_ids if job_id in self._index])
+        for job_id in job_ids:
+            if job_id in index:
+                continue
+            job = self._load(QUEUED, job_id)
+            if job is not None:
+                index[job_id] = (job.cost, job.urgency, job.created)
+        with self._lock:
+            self._index = index
+        now = time.time()
+        return [(job_id, index[job_id][0]) for job_id in sorted(
+            index, key=lambda job_id: (
+                schedule_key(index[job_id][0], index[job_id][1],
+                             now - index[job_id][2]), index[job_id][2]))]
+
+    def pending(self, max_cost=None):
+        """Get number of queued jobs expected to cost less than
+        `max_cost` (if set).
+        """
+        return len([job_id for job_id, cost in self._queued()
+                    if max_cost is None or (cost or 0) < max_cost])
+
+    def claim(self, owner, max_cost=None):
+        """Claim next queued job for `owner`.
+
+        Jobs are claimed in order of
+        :func:`ulif.openoffice.admission.schedule_key`. If `max_cost`
+        is set, only jobs expected to cost less are claimed.
+
+        Returns the claimed :class:`Job` (now running) or ``None`` if
+        no job is queued.
+        """
+        for job_id, cost in self._queued():
+            if max_cost is not None and (cost or 0) >= max_cost:
+                continue
+            queued_dir = self._job_dir(QUEUED, job_id)
+            try:
+                # running jobs must always have a lease
+                self._write_lease(queued_dir, owner)
+            except (IOError, OSError):
+                continue  # claimed or cancelled meanwhile
+            if not _rename(queued_dir, self._job_dir(RUNNING, job_id)):
+                continue  # claimed by someone else
+            self.renew(job_id, owner)
+            return self._load(RUNNING, job_id)
+        return None
+
+    def _write_lease(self, job_dir, owner):
+        _write_json(os.path.join(job_dir, 'lease'), dict(
+            owner=owner, expires=time.time() + self.lease_time))
+
+    def renew(self, job_id, owner):
+        """Renew lease of running job `job_id` for `owner`.
+        """
+        try:
+            self._write_lease(self._job_dir(RUNNING, job_id), owner)
+        except (IOError, OSError):
+            pass  # job not running any more
+
+    def requeue_expired(self):
+        """Queue running jobs with expired leases again.
+
+        Leases of dead processes on this host expire immediately.
+        Jobs exceeding `max_attempts` fail. Jobs left in ``incoming/``
+        are recovered, see :meth:`_recover_incoming`.
+        """
+        self._recover_incoming()
+        hostname = socket.gethostname()
+        for job_id in os.listdir(os.path.join(self.path, RUNNING)):
+            job_dir = self._job_dir(RUNNING, job_id)
+            try:
+                lease = _read_json(os.path.join(job_dir, 'lease'))
+            except (IOError, OSError, ValueError):
+                continue  # finished meanwhile
+            host, pid = lease['owner'].split(':')[:2]
+            if lease['expires'] > time.time() and (
+                    host != hostname or _pid_alive(int(pid))):
+                continue
+            job = self._load(RUNNING, job_id)
+            if job is None:
+                continue
+            if os.path.exists(os.path.join(job_dir, 'cancel')):
+                self.finish(job)  # no need to run it again
+                continue
+            job.attempts += 1
+            if job.attempts >= self.max_attempts:
+                self.finish(job, error='too many attempts')
+                continue
+            # move out of the way first, so only one process requeues
+            tmp_dir = self._job_dir('incoming', job_id)
+            if not _rename(job_dir, tmp_dir):
+                continue
+            os.utime(tmp_dir, None)  # not stale
+            _write_json(os.path.join(tmp_dir, 'job.json'), job.dump())
+            os.unlink(os.path.join(tmp_dir, 'lease'))
+            os.rename(tmp_dir, self._job_dir(QUEUED, job_id))
+
+    def _recover_incoming(self):
+        # queue jobs left in incoming/ by crashed processes. Jobs
+        # without job data were not put completely and are removed.
+        incoming = os.path.join(self.path, 'incoming')
+        for job_id in os.listdir(incoming):
+            tmp_dir = self._job_dir('incoming', job_id)
+            try:
+                if os.path.getmtime(tmp_dir) + self.lease_time > time.time():
+                    continue  # still being prepared
+                names = os.listdir(tmp_dir)
+            except OSError:
+                continue  # moved on meanwhile
+            if 'job.json' not in names or len(names) < 2:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                continue
+            if 'lease' in names:
+                try:
+                    os.unlink(os.path.join(tmp_dir, 'lease'))
+                except OSError:
+                    continue  # recovered by someone else
+            _rename(tmp_dir, self._job_dir(QUEUED, job_id))
+
+    def finish(self, job, cache_key=None, error=None, result_path=None,
+               metadata=None):
+        """Mark running `job` as done (or failed, if `error` is set).
+
+        If `result_path` is given, the directory containing it is
+        moved into the job directory and kept there together with the
+        source doc. `metadata` (the conversion metadata) is stored
+        with the job.
+
+        Jobs cancelled meanwhile are marked as cancelled. Returns the
+        new state or ``None`` if the job is not running any more
+        (because its lease expired, for instance). The result is not
+        moved then.
+        """
+        job_dir = self._job_dir(RUNNING, job.id)
+        state = error is None and DONE or FAILED
+        if os.path.exists(os.path.join(job_dir, 'cancel')):
+            state, cache_key, error = CANCELLED, None, None
+        job.state, job.cache_key, job.error = state, cache_key, error
+        job.metadata = metadata
+        keep = ('job.json', )
+        if result_path is not None and state == DONE:
+            try:
+                shutil.move(os.path.dirname(result_path),
+                            os.path.join(job_dir, 'result'))
+            except (IOError, OSError, shutil.Error):
+                return None
+            job.result = os.path.basename(result_path)
+            keep += ('result', os.path.basename(job.src_path))
+        try:
+            _write_json(os.path.join(job_dir, 'job.json'), job.dump())
+        except (IOError, OSError):
+            return None
+        if not _rename(job_dir, self._job_dir(state, job.id)):
+            return None
+        self._remove_source(state, job.id, keep)
+        self._purge()
+        return state
+
+    def update(self, job):
+        """Store data of finished `job`.
+        """
+        try:
+            _write_json(os.path.join(
+                self._job_dir(job.state, job.id), 'job.json'), job.dump())
+        except (IOError, OSError):
+            pass  # forgotten meanwhile
+
+    def cancel(self, job_id):
+        """Cancel job `job_id`.
+
+        Queued jobs will not be run. Running jobs cannot be
+        interrupted, but their result is discarded. Finished jobs are
+        forgotten.
+
+        Returns ``False`` if no such job exists, ``True`` else.
+        """
+        job = self.get(job_id)
+        if job is None:
+            return False
+        if job.state in FINISHED_STATES:
+            shutil.rmtree(
+                self._job_dir(job.state, job_id), ignore_errors=True)
+        elif job.state == QUEUED and _rename(
+                self._job_dir(QUEUED, job_id),
+                self._job_dir(CANCELLED, job_id)):
+            job.state = CANCELLED
+            _write_json(os.path.join(
+                self._job_dir(CANCELLED, job_id), 'job.json'), job.dump())
+            self._remove_source(CANCELLED, job_id)
+        else:
+            # running (or just claimed)
+            try:
+                open(os.path.join(
+                    self._job_dir(RUNNING, job_id), 'cancel'), 'w').close()
+            except IOError:
+                return self.cancel(job_id)  # state changed meanwhile
+        return True
+
+    def _remove_source(self, state, job_id, keep=('job.json', )):
+        # remove anything but job data of a finished job
+        job_dir = self._job_dir(state, job_id)
+        for name in os.listdir(job_dir):
+            if name in keep:
+                continue
+            path = os.path.join(job_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+
+    def _purge(self):
+        # forget oldest finished jobs if there are too many
+        finished = []
+        for state in FINISHED_STATES:
+            finished.extend([
+                self._job_dir(state, job_id) for job_id in os.listdir(
+                    os.path.join(self.path, state))])
+        if len(finished) <= self.max_finished:
+            return
+        finished.sort(key=lambda path: os.path.getmtime(path))
+        for path in finished[:len(finished) - self.max_finished]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class JobManager(object):
+    """Run conversion jobs in a pool of `workers` threads.
+
+    As results are retrieved from cache, a `cache_dir` is required.
+    Jobs are stored in a :class:`SpoolQueue` in the ``.jobs``
+    subdirectory of `cache_dir` or in `spool_dir`, if given. Jobs
+    queued before a restart are run when the job manager is
+    created. See :class:`SpoolQueue` for `max_finished` and
+    `lease_time`.
+
+    Workers look for jobs queued by other processes every
+    `poll_interval` seconds.
+
+    With `keep_results` set, workers do not need a `cache_dir`. They
+    keep results in the spool instead, where job managers of other
+    processes (maybe with `workers` set to zero) can pick them up.
+
+    With `max_cost` set, our workers run only jobs expected to cost
+    less. This way some workers can be reserved for small docs.
+
+    If `admission` (an
+    :class:`ulif.openoffice.admission.AdmissionControl`) is given,
+    our workers run conversions only when admitted there, as
+    background work with the lowest urgency. This way jobs share the
+    limits of interactive conversions and do not get in their way.
+    """
+    def __init__(self, cache_dir, workers=2, max_finished=1000,
+                 lease_time=600, poll_interval=1.0, spool_dir=None,
+                 keep_results=False, max_cost=None, admission=None):
+        if cache_dir is None and spool_dir is None:
+            raise ValueError('jobs need a cache_dir or spool_dir')
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.keep_results = keep_results
+        self.max_cost = max_cost
+        self.admission = admission
+        self.queue = SpoolQueue(
+            spool_dir or os.path.join(cache_dir, '.jobs'),
+            lease_time=lease_time, max_finished=max_finished)
+        self.owner = '%s:%s:%s' % (
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._running = set()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads = []
+        if self.queue.count(QUEUED) or self.queue.count(RUNNING):
+            self.start()
+
+    def start(self):
+        """Start workers (if not running already).
+        """
+        with self._cond:
+            if self._threads or self._stopping or not self.workers:
+                return
+            targets = [self._work] * self.workers + [self._heartbeat]
+            for target in targets:
+                thread = threading.Thread(target=target)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, src_path, options, urgency=DEFAULT_URGENCY):
+        """Queue conversion of `src_path` with `options`.
+
+        The document in `src_path` is moved into the queue and the
+        directory containing it removed. Returns the new :class:`Job`.
+        """
+        job = self.queue.put(src_path, options, urgency=urgency)
+        shutil.rmtree(os.path.dirname(src_path), ignore_errors=True)
+        self.start()
+        with self._cond:
+            self._cond.notify()
+        return job
+
+    def get(self, job_id):
+        """Get the job with id `job_id` or ``None``.
+
+        Results of done jobs kept in the spool are stored in cache
+        (if we have a `cache_dir`) and the job gets a cache key.
+        """
+        job = self.queue.get(job_id)
+        if (job is not None and job.state == DONE and
+                job.cache_key is None and job.result is not None and
+                self.cache_dir is not None):
+            job.cache_key = CacheManager(self.cache_dir).register_doc(
+                job.src_path, job.result_path, get_marker(job.options))
+            self.queue.update(job)
+        return job
+
+    def cancel(self, job_id):
+        """Cancel job with id `job_id`. See :meth:`SpoolQueue.cancel`.
+        """
+        return self.queue.cancel(job_id)
+
+    def convert(self, src_doc, options, cache_dir, timeout=None,
+                urgency=DEFAULT_URGENCY):
+        """Convert `src_doc` by some worker and wait for the result.
+
+        Works like :func:`ulif.openoffice.client.convert_doc`, but
+        the conversion is queued and done by any worker serving our
+        spool. These workers must keep their results in the spool. The
+        result is stored in `cache_dir` (if not ``None``).
+
+        If the job is not finished after `timeout` seconds, it is
+        cancelled and an error is returned.
+        """
+        job = self.queue.put(src_doc, options, move=False, urgency=urgency)
+        self.start()
+        with self._cond:
+            self._cond.notify()
+        deadline = timeout and time.time() + timeout
+        interval = 0.05
+        while job is not None and job.state not in FINISHED_STATES:
+            if deadline and time.time() > deadline:
+                self.queue.cancel(job.id)
+                return None, None, {
+                    'error': True, 'error-descr': 'conversion timed out'}
+            time.sleep(interval)
+            interval = min(interval * 2, self.poll_interval)
+            job = self.queue.get(job.id)
+        if job is None or job.result is None:
+            error = job and (job.error or 'conversion %s' % job.state)
+            return None, None, (job and job.metadata) or {
+                'error': True, 'error-descr': error or 'job vanished'}
+        result_dir = copy_to_secure_location(
+            os.path.dirname(job.result_path))
+        result_path = os.path.join(result_dir, job.result)
+        self.queue.cancel(job.id)  # forget it
+        cache_key = None
+        if cache_dir is not None:
+            cache_key = CacheManager(cache_dir).register_doc(
+                src_doc, result_path, get_marker(options))
+        return result_path, cache_key, job.metadata
+
+    def _work(self):
+        while not self._stopping:
+            self.queue.requeue_expired()
+            job = self.queue.claim(self.owner, max_cost=self.max_cost)
+            if job is None:
+                with self._cond:
+                    if not self._stopping:
+                        self._cond.wait(self.poll_interval)
+                continue
+            self._running.add(job.id)
+            try:
+                self._run(job)
+            finally:
+                self._running.discard(job.id)
+
+    def _heartbeat(self):
+        # renew leases of running jobs
+        while not self._stopping:
+            for job_id in list(self._running):
+                self.queue.renew(job_id, self.owner)
+            with self._cond:
+                if not self._stopping:
+                    self._cond.wait(self.queue.lease_time / 3.0)
+
+    def _run(self, job):
+        result_path, cache_key, metadata, error = None, None, None, None
+        try:
+            result_path, cache_key, metadata = self._convert(job)
+            result = self.keep_results and result_path or cache_key
+            if result is None or metadata.get('error', False):
+                error = metadata.get('error-descr', 'conversion failed')
+        except Exception as exc:
+            logging.getLogger('ulif.openoffice.jobs').exception(
+                'job %s failed' % job.id)
+            error = str(exc) or exc.__class__.__name__
+        if not self.keep_results:
+            if result_path is not None:
+                shutil.rmtree(
+                    os.path.dirname(result_path), ignore_errors=True)
+            self.queue.finish(job, cache_key=cache_key, error=error)
+            return
+        # our cache keys are of no use for others
+        self.queue.finish(
+            job, error=error, result_path=result_path, metadata=metadata)
+        if result_path is not None and os.path.exists(result_path):
+            # not moved into spool
+            shutil.rmtree(os.path.dirname(result_path), ignore_errors=True)
+
+    def _convert(self, job):
+        # convert the source of `job`, when admitted
+        if self.admission is None:
+            return convert_doc(job.src_path, job.options, self.cache_dir)
+        with self.admission.admit(job.cost, LOWEST_URGENCY, limited=False):
+            return convert_doc(job.src_path, job.options, self.cache_dir)
+
+    def shutdown(self):
+        """Stop all workers after their current job.
+
+        Jobs still queued stay in the queue.
+        """
+        with self._cond:
+            self._stopping = True
+            threads, self._threads = self._threads, []
+            self._cond.notify_all()
+        for thread in threads:
+            thread.join()
+
+
+def main(args=None):
+    """Serve a spool directory: the ``oooworker`` script.
+
+    Runs queued jobs until we get ``SIGTERM`` or ``SIGINT``. Results
+    are kept in the spool.
+    """
+    parser = argparse.ArgumentParser()
+    if args is None:                                    # pragma: no cover
+        args = sys.argv[1:]
+    else:
+        parser.prog = 'oooworker'
+    parser.description = (
+        "Convert office documents queued in a spool directory.")
+    parser.add_argument('spool_dir', metavar='SPOOLDIR',
+                        help='Path to the (shared) spool directory')
+    parser.add_argument('--cachedir',
+                        help='Path to a local cache directory')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of conversions run at the same time')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='Seconds between looking for new jobs')
+    parser.add_argument('--lease-time', type=int, default=600,
+                        help='Seconds after which jobs of silent workers '
+                        'are queued again')
+    parser.add_argument('--max-cost', type=float,
+                        help='Convert only docs expected to cost less')
+    parser.add_argument('--endpoints',
+                        help='Office servers to use, as list of host:port')
+    parser.add_argument('--burst', action='store_true',
+                        help='Exit when no more jobs are queued')
+    options = parser.parse_args(args)
+    if options.endpoints:
+        set_endpoints(options.endpoints)
+    manager = JobManager(
+        options.cachedir, workers=options.workers,
+        lease_time=options.lease_time, poll_interval=options.poll_interval,
+        spool_dir=options.spool_dir, keep_results=True,
+        max_cost=options.max_cost)
+    stop = threading.Event()
+    handlers = dict([
+        (signum, signal.signal(signum, lambda *args: stop.set()))
+        for signum in (signal.SIGTERM, signal.SIGINT)])
+    manager.start()
+    try:
+        while not stop.is_set():
+            if options.burst and not (
+                    manager.queue.pending(manager.max_cost) or
+                    manager._running):
+                break
+            stop.wait(options.poll_interval)
+    finally:
+        manager.shutdown()
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
@@ -19,26 +19,40 @@
 """
 Start/stop a locally installed OpenOffice.org server instance.
 
-It runs `unoconv -l` and monitors status.
+It runs office instances (``soffice``, or `unoconv -l` if no office
+binary can be found) and restarts them as soon as they die.
+Instances are supervised and recycled by a
+:class:`ulif.openoffice.supervisor.Supervisor`.
 
 This script is installed as executable script ``oooctl``.
 """
+import json
+import logging
 import os
 import signal
 import socket
-import subprocess
 import sys
 import time
 from optparse import OptionParser
 from signal import SIGTERM
+from ulif.openoffice.endpoints import STATE_FILE
+from ulif.openoffice.supervisor import (
+    RecyclePolicy, Supervisor, parse_warmup, WARMUP_CONVERSIONS)
 
 DEFAULT_BIN_PATHS = (
     '/usr/sbin/unoconv',
     '/usr/local/bin/unoconv',
     '/usr/bin/unoconv',
     )
+DEFAULT_OFFICE_PATHS = (
+    '/usr/lib/libreoffice/program/soffice',
+    '/opt/libreoffice/program/soffice',
+    '/usr/bin/soffice',
+    '/usr/local/bin/soffice',
+    )
 PIDFILE = '/tmp/ooodaemon.pid'
-child_pid = None
+STATEFILE = STATE_FILE
+PROFILEDIR = '/tmp/ooodaemon-profiles'
 
 
 def daemonize(stdout='/dev/null', stderr=None,
@@ -46,7 +60,6 @@ def daemonize(stdout='/dev/null', stderr=None,
               startmsg='started with pid %s'):       # pragma: no cover
     """Fork and daemonize a running process.
     """
-    global child_pid
     try:
         pid = os.fork()
         if pid > 0:
@@ -90,10 +103,35 @@ def daemonize(stdout='/dev/null', stderr=None,
     os.dup2(se.fileno(), sys.stderr.fileno())
 
 
+def get_status(statefile):
+    """Get the states of instances listed in `statefile`.
+
+    Returns a list of lines, one per instance, telling whether it is
+    ready to take conversions.
+    """
+    try:
+        with open(statefile, 'r') as fd:
+            state = json.load(fd)
+    except (IOError, OSError, ValueError):
+        return []
+    result = []
+    for instance in state.get('instances', []):
+        line = '%s:%s %s (PID %s, %s conversions)' % (
+            instance['host'], instance['port'], instance['state'],
+            instance.get('pid'), instance.get('conversions', 0))
+        if instance.get('pipe'):
+            line += ', pipe %s' % instance['pipe']
+        result.append(line)
+    return result
+
+
 def startstop(stdout='/dev/null', stderr=None, stdin='/dev/null',
               pidfile='pid.txt', startmsg='started with pid %s',
-              action='start'):                        # pragma: no cover
+              action='start', statefile=None):        # pragma: no cover
     """Start/stop a process.
+
+    If `statefile` is given, ``status`` also lists the office
+    instances found there.
     """
     if action:
         try:
@@ -152,28 +190,12 @@ def startstop(stdout='/dev/null', stderr=None, stdin='/dev/null',
                 sys.stderr.write('Status: Not running\n')
             else:
                 sys.stderr.write('Status: Running (PID %s) \n' % pid)
+                if statefile is not None:
+                    for line in get_status(statefile):
+                        sys.stderr.write('  %s\n' % line)
             sys.exit(0)
 
 
-def start(binarypath, foreground=False):               # pragma: no cover
-    """Start an instance of OpenOffice.org server on port 2002.
-    """
-    cmd = "%s -l" % (binarypath,)
-    if not foreground:
-        result = os.system(cmd)
-        return result
-
-    proc = subprocess.Popen(
-        ['sh %s' % cmd],
-        shell=True,
-        close_fds=True,
-        preexec_fn=os.setsid,
-    )
-    global child_pid
-    child_pid = proc.pid
-    return child_pid
-
-
 def get_options(argv=sys.argv):
     usage = "usage: %prog [options] start|fg|stop|restart|status"
     allowed_args = ['start', 'stop', 'restart', 'status', 'fg']
@@ -187,6 +209,14 @@ def get_options(argv=sys.argv):
         (', '.join(DEFAULT_BIN_PATHS)),
         )
 
+    parser.add_option(
+        "-o", "--officepath",
+        help="absolute path to the office executable (soffice). If "
+             "it cannot be found, instances are started with unoconv. "
+             "Default paths looked up: %s" %
+        (', '.join(DEFAULT_OFFICE_PATHS)),
+        )
+
     parser.add_option(
         "-p", "--pidfile",
         help="absolute path of PID file. Default: %s" % PIDFILE,
@@ -214,6 +244,58 @@ def get_options(argv=sys.argv):
         default='/dev/null',
         )
 
+    parser.add_option(
+        "--port", type="int",
+        help="port of the (first) office instance. Default: 2002",
+        default=2002,
+        )
+
+    parser.add_option(
+        "--instances", type="int",
+        help="number of office instances to run. They listen on "
+             "PORT and the following ports. Default: 1",
+        default=1,
+        )
+
+    parser.add_option(
+        "--max-conversions", type="int", metavar="NUM",
+        help="recycle instances after NUM conversions.",
+        )
+
+    parser.add_option(
+        "--max-rss", type="int", metavar="MB",
+        help="recycle instances using more than MB megabytes of memory.",
+        )
+
+    parser.add_option(
+        "--max-age", type="int", metavar="SECONDS",
+        help="recycle instances running longer than SECONDS.",
+        )
+
+    parser.add_option(
+        "--statefile", metavar='FILE',
+        help="file where running instances are listed (as JSON). "
+             "Default: %s" % STATEFILE,
+        default=STATEFILE,
+        )
+
+    parser.add_option(
+        "--profiledir", metavar='DIR',
+        help="directory where office user profiles are kept. A profile "
+             "template is built there once, each instance gets a copy. "
+             "Default: %s" % PROFILEDIR,
+        default=PROFILEDIR,
+        )
+
+    parser.add_option(
+        "--warmup", metavar='LIST',
+        help="warm-up conversions run by new instances before they "
+             "take conversions. Comma separated FAMILY:FORMAT pairs, "
+             "FAMILY being one of 'writer', 'calc', 'impress'. Use an "
+             "empty string to disable. Default: %s" % WARMUP_CONVERSIONS,
+        default=WARMUP_CONVERSIONS,
+        )
+
     (options, args) = parser.parse_args(args=argv[1:])
 
     if len(args) > 1:
@@ -230,6 +312,19 @@ def get_options(argv=sys.argv):
     if not os.path.isfile(options.binarypath):
         parser.error("no such file: %s. Use -b to set the binary path. "
                      "Use -h to see all options." % options.binarypath)
+    if options.officepath is None:
+        for path in DEFAULT_OFFICE_PATHS:
+            if os.path.isfile(path):
+                options.officepath = path
+                break
+    elif not os.path.isfile(options.officepath):
+        parser.error("no such file: %s. Use -o to set the office path. "
+                     "Use -h to see all options." % options.officepath)
+
+    try:
+        options.warmup = parse_warmup(options.warmup)
+    except ValueError as err:
+        parser.error("%s. Use -h to see all options." % err)
 
     cmd = None
     if len(args) == 1:
@@ -240,14 +335,11 @@ def get_options(argv=sys.argv):
     return (cmd, options)
 
 
-def signal_handler(signal, frame):                      # pragma: no cover
-    print("Received SIGINT.")
+def signal_handler(signum, frame):                      # pragma: no cover
+    print("Received signal %s." % signum)
     print("Stopping OpenOffice.org server.")
-    global child_pid
-    if child_pid is not None:
-        os.killpg(child_pid, SIGTERM)
-        time.sleep(1)
-    sys.exit(0)
+    signal.signal(SIGTERM, signal.SIG_IGN)   # `stop` sends it repeatedly
+    sys.exit(0)     # the supervisor stops all instances on exit
 
 
 def check_port(host, port):
@@ -264,10 +356,18 @@ def check_port(host, port):
     return False                                        # pragma: no cover
 
 
-def wait_for_startup(host, port):                       # pragma: no cover
-    while not check_port(host, port):
-        time.sleep(1)
-    return
+def get_supervisor(options):
+    """Get a supervisor for the instances requested in `options`.
+    """
+    policy = RecyclePolicy(
+        max_conversions=options.max_conversions,
+        max_rss=options.max_rss and options.max_rss * 1024,
+        max_age=options.max_age)
+    return Supervisor(
+        options.binarypath, size=options.instances, port=options.port,
+        policy=policy, state_file=options.statefile,
+        officepath=options.officepath, profile_dir=options.profiledir,
+        warmup=options.warmup)
 
 
 def main(argv=sys.argv):                                # pragma: no cover
@@ -286,7 +386,7 @@ def main(argv=sys.argv):                                # pragma: no cover
         sys.stdout.flush()
 
     if cmd == 'fg':
-        if check_port('localhost', 2002):
+        if check_port('localhost', options.port):
             mess = "start aborted!\n"
             mess += "Start aborted since the server seems to be running.\n"
             sys.stderr.write(mess)
@@ -295,24 +395,19 @@ def main(argv=sys.argv):                                # pragma: no cover
     # startstop() returns only in case of 'start', 'fg', or 'restart' cmd...
     startstop(stderr=options.stderr, stdout=options.stdout,
               stdin=options.stdin,
-              pidfile=options.pidfile, action=cmd)
+              pidfile=options.pidfile, action=cmd,
+              statefile=options.statefile)
 
+    signal.signal(SIGTERM, signal_handler)
     if cmd == 'fg':
         signal.signal(signal.SIGINT, signal_handler)
         print("Installed signal handler for SIGINT (CTRL-C)")
 
-    start(options.binarypath, foreground=(cmd == 'fg'))
-
-    wait_for_startup('localhost', 2002)
-    while True:
-        # Check for running server and restart when it is down...
-        if not check_port('localhost', 2002):
-            print("openoffice.org/libreoffice server seems to be down.")
-            print("restarting...")
-            start(options.binarypath)
-            wait_for_startup('localhost', 2002)
-            print("restarted.")
-        time.sleep(1)
+    logging.basicConfig(
+        stream=sys.stdout, level=logging.INFO,
+        format='%(asctime)s %(message)s')
+    # Restarts instances when they are down and recycles them...
+    get_supervisor(options).run()
 
 
 if __name__ == '__main__':                              # pragma: no cover
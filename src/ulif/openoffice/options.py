@@ -20,6 +20,7 @@
 Components to configure processors.
 """
 import re
+import threading
 from argparse import ArgumentParser
 from ulif.openoffice.helpers import get_entry_points
 
@@ -94,6 +95,55 @@ class ExceptionalArgumentParser(ArgumentParser):
         raise ArgumentParserError(message)
 
 
+#: Precompiled, shared parser and defaults. See :func:`get_default_parser`.
+_precompiled = {}
+_precompiled_lock = threading.Lock()
+
+
+def populate_parser(parser):
+    """Add the arguments of all registered processors to `parser`.
+
+    Returns the populated `parser`.
+    """
+    procs = get_entry_points('ulif.openoffice.processors')
+    for proc_name, proc in list(procs.items()):
+        for arg in proc.args:
+            parser.add_argument(
+                arg.short_name, arg.long_name, **arg.keywords)
+    return parser
+
+
+def _precompile():
+    """Build the shared parser and the default option values once.
+    """
+    with _precompiled_lock:
+        if 'parser' not in _precompiled:
+            parser = populate_parser(ExceptionalArgumentParser())
+            defaults, trash = parser.parse_known_args([])
+            _precompiled['defaults'] = vars(defaults)
+            _precompiled['parser'] = parser
+    return _precompiled
+
+
+def get_default_parser():
+    """Get a shared parser populated with all processor options.
+
+    The parser is built only once per process. Callers must not modify
+    the returned parser. Use :meth:`Options.get_arg_parser` to get a
+    parser of your own.
+    """
+    return _precompiled.get('parser') or _precompile()['parser']
+
+
+def get_default_values():
+    """Get a dict with default values of all processor options.
+
+    The returned dict is a fresh copy on each call.
+    """
+    defaults = _precompiled.get('defaults') or _precompile()['defaults']
+    return dict(defaults)
+
+
 class Options(dict):
     """Options are dicts that automatically set processor options.
 
@@ -147,15 +197,22 @@ class Options(dict):
 
             >>> Options().string_keys     # doctest: +NORMALIZE_WHITESPACE
             ['css-cleaner-min',
+             'css-cleaner-prettify',
              'html-cleaner-fix-head-nums',
              'html-cleaner-fix-img-links',
              'html-cleaner-fix-sd-fields',
              'meta-procord',
              'oocp-host',
+             'oocp-native-txt',
              'oocp-out-fmt',
              'oocp-pdf-tagged',
              'oocp-pdf-version',
-             'oocp-port']
+             'oocp-port',
+             'unzip-max-ratio',
+             'unzip-max-size',
+             'zip-level',
+             'zip-store-compressed',
+             'zip-threads']
 
         So, you can create an `Options` dict with overridden defaults
         for instance by passing in something like
@@ -168,12 +225,12 @@ class Options(dict):
 
     def __init__(self, val_dict=None, string_dict=None):
         super(Options, self).__init__()
-        args = []
-        if string_dict is not None:
+        if string_dict:
             args = dict_to_argtuple(string_dict)
-        parser = self.get_arg_parser()
-        defaults, trash = parser.parse_known_args(args)
-        self.update(vars(defaults))
+            values, trash = get_default_parser().parse_known_args(args)
+            self.update(vars(values))
+        else:
+            self.update(get_default_values())
         if val_dict is not None:
             self.update(val_dict)
 
@@ -190,9 +247,4 @@ class Options(dict):
         """
         if parser is None:
             parser = ExceptionalArgumentParser()
-        # set defaults
-        for proc_name, proc in list(self.avail_procs.items()):
-            for arg in proc.args:
-                parser.add_argument(
-                    arg.short_name, arg.long_name, **arg.keywords)
-        return parser
+        return populate_parser(parser)
@@ -0,0 +1,325 @@
+#
+# probe.py
+#
+# Copyright (C) 2015 Uli Fouquet
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Get metadata of office docs without LibreOffice.
+
+We read ODF ``meta.xml``, OOXML ``docProps/*.xml`` and PDF trailers
+directly. See :func:`probe_document`.
+"""
+import codecs
+import json
+import mmap
+import os
+import re
+import tempfile
+import zipfile
+from xml.etree.ElementTree import iterparse
+from ulif.openoffice.cachemanager import CacheManager
+
+
+NS_META = 'urn:oasis:names:tc:opendocument:xmlns:meta:1.0'
+NS_TABLE = 'urn:oasis:names:tc:opendocument:xmlns:table:1.0'
+NS_DC = 'http://purl.org/dc/elements/1.1/'
+NS_EP = ('http://schemas.openxmlformats.org/officeDocument/2006/'
+         'extended-properties')
+NS_S = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+
+#: Leading bytes of OLE2 compound files (legacy MS Office docs and
+#: encrypted OOXML docs).
+OLE_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+#: Name of the stream containing encrypted OOXML docs (UTF-16).
+OLE_ENCRYPTED = 'EncryptedPackage'.encode('utf-16-le')
+
+#: Cost units of any conversion. See :func:`estimate_cost`.
+COST_BASE = 1.0
+
+#: Cost units per page.
+COST_PAGE = 0.2
+
+#: Cost units per megabyte of source document.
+COST_MEGABYTE = 1.0
+
+
+def _tag(namespace, name):
+    return '{%s}%s' % (namespace, name)
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _new_result(path):
+    return dict(
+        format='unknown', encrypted=False, title=None, author=None,
+        pages=None, words=None, sheets=None, slides=None,
+        size=os.path.getsize(path))
+
+
+def _probe_odf(zf, result):
+    result['format'] = 'odf'
+    names = zf.namelist()
+    if 'META-INF/manifest.xml' in names:
+        result['encrypted'] = b'encryption-data' in zf.read(
+            'META-INF/manifest.xml')
+    if 'meta.xml' in names:
+        with zf.open('meta.xml') as fd:
+            for event, elem in iterparse(fd):
+                if elem.tag == _tag(NS_DC, 'title'):
+                    result['title'] = elem.text
+                elif elem.tag == _tag(NS_META, 'initial-creator'):
+                    result['author'] = elem.text
+                elif elem.tag == _tag(NS_DC, 'creator'):
+                    result['author'] = result['author'] or elem.text
+                elif elem.tag == _tag(NS_META, 'document-statistic'):
+                    result['pages'] = _int(
+                        elem.get(_tag(NS_META, 'page-count')))
+                    result['words'] = _int(
+                        elem.get(_tag(NS_META, 'word-count')))
+    mimetype = 'mimetype' in names and zf.read('mimetype') or b''
+    if mimetype.endswith(b'spreadsheet') and not result['encrypted']:
+        # sheet names are only available from content
+        sheets = []
+        with zf.open('content.xml') as fd:
+            for event, elem in iterparse(fd, events=('start', 'end')):
+                if event == 'start':
+                    if elem.tag == _tag(NS_TABLE, 'table'):
+                        sheets.append(elem.get(_tag(NS_TABLE, 'name')))
+                elif elem.tag == _tag(NS_TABLE, 'table-row'):
+                    elem.clear()
+        result['sheets'] = sheets
+    elif mimetype.endswith(b'presentation'):
+        result['slides'] = result['pages']
+
+
+def _probe_ooxml(zf, result):
+    result['format'] = 'ooxml'
+    names = zf.namelist()
+    if 'docProps/core.xml' in names:
+        with zf.open('docProps/core.xml') as fd:
+            for event, elem in iterparse(fd):
+                if elem.tag == _tag(NS_DC, 'title'):
+                    result['title'] = elem.text
+                elif elem.tag == _tag(NS_DC, 'creator'):
+                    result['author'] = elem.text
+    if 'docProps/app.xml' in names:
+        with zf.open('docProps/app.xml') as fd:
+            for event, elem in iterparse(fd):
+                if elem.tag == _tag(NS_EP, 'Pages'):
+                    result['pages'] = _int(elem.text)
+                elif elem.tag == _tag(NS_EP, 'Words'):
+                    result['words'] = _int(elem.text)
+                elif elem.tag == _tag(NS_EP, 'Slides'):
+                    result['slides'] = _int(elem.text)
+    if result['slides'] is not None and result['pages'] is None:
+        result['pages'] = result['slides']
+    if 'xl/workbook.xml' in names:
+        with zf.open('xl/workbook.xml') as fd:
+            result['sheets'] = [
+                elem.get('name') for event, elem in iterparse(fd)
+                if elem.tag == _tag(NS_S, 'sheet')]
+
+
+RE_PDF_STARTXREF = re.compile(br'startxref\s+(\d+)')
+RE_PDF_REF = br'\s+(\d+)\s+(\d+)\s+R'
+RE_PDF_COUNT = re.compile(br'/Count\s+(\d+)')
+RE_PDF_STRING = br'\s*(\((?:\\.|[^\\)])*\)|<[0-9A-Fa-f\s]*>)'
+PDF_ESCAPES = {
+    b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f'}
+
+
+def _pdf_ref(name, data):
+    # find reference `/<name> <num> <gen> R` in `data`
+    return re.search(b'/' + name + RE_PDF_REF, data)
+
+
+def _pdf_object(data, ref):
+    """Get the dictionary of the (uncompressed) object `ref` in `data`.
+
+    `ref` is a tuple of object and generation number (as bytes).
+    Returns ``None`` if it cannot be found, for instance because it is
+    stored in a compressed object stream.
+    """
+    match = re.search(
+        br'(?<!\d)' + ref[0] + br'\s+' + ref[1] + br'\s+obj\b', data)
+    if match is None:
+        return None
+    end = data.find(b'endobj', match.end())
+    return data[match.end():end]
+
+
+def _pdf_string(raw):
+    """Decode the PDF string `raw`, including delimiters.
+    """
+    if raw.startswith(b'<'):
+        value = codecs.decode(re.sub(br'\s', b'', raw[1:-1]), 'hex')
+    else:
+        value = re.sub(
+            br'\\([0-7]{1,3}|.)',
+            lambda m: (
+                m.group(1).isdigit() and
+                bytes(bytearray([int(m.group(1), 8) & 0xff])) or
+                PDF_ESCAPES.get(m.group(1), m.group(1))),
+            raw[1:-1], flags=re.S)
+    if value.startswith(codecs.BOM_UTF16_BE):
+        return value[2:].decode('utf-16-be', 'replace')
+    return value.decode('latin-1')
+
+
+def _probe_pdf(path, result):
+    result['format'] = 'pdf'
+    with open(path, 'rb') as fd:
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        tail = data[-2048:]
+        trailer = None
+        pos = tail.rfind(b'trailer')
+        if pos > -1:
+            trailer = tail[pos:]
+        else:
+            # cross-reference stream (PDF >= 1.5)
+            match = RE_PDF_STARTXREF.search(tail)
+            if match is not None:
+                offset = int(match.group(1))
+                trailer = data[offset:offset + 2048]
+        if trailer is None:
+            return
+        result['encrypted'] = b'/Encrypt' in trailer
+        root = _pdf_ref(b'Root', trailer)
+        catalog = root and _pdf_object(data, root.groups())
+        pages_ref = catalog and _pdf_ref(b'Pages', catalog)
+        pages = pages_ref and _pdf_object(data, pages_ref.groups())
+        count = pages and RE_PDF_COUNT.search(pages)
+        if count:
+            result['pages'] = int(count.group(1))
+        info_ref = _pdf_ref(b'Info', trailer)
+        info = info_ref and _pdf_object(data, info_ref.groups())
+        if info and not result['encrypted']:
+            for key, name in (('title', b'Title'), ('author', b'Author')):
+                match = re.search(b'/' + name + RE_PDF_STRING, info)
+                if match is not None:
+                    result[key] = _pdf_string(match.group(1))
+    finally:
+        data.close()
+
+
+def estimate_cost(result):
+    """Estimate the cost of converting a doc, given its probe `result`.
+
+    The returned number is a rough measure in relative units: a
+    conversion of an empty document costs :data:`COST_BASE`. Pages
+    and size add to it. If no page count is known, it is guessed from
+    the size.
+    """
+    megabytes = result['size'] / (1024.0 * 1024.0)
+    pages = result['pages']
+    if pages is None:
+        pages = int(result['size'] / (50 * 1024)) + 1
+    return round(COST_BASE + pages * COST_PAGE + megabytes * COST_MEGABYTE, 2)
+
+
+def probe_document(path):
+    """Get metadata of the document in `path`.
+
+    Returns a dict with keys
+
+    `format`
+      ``odf``, ``ooxml``, ``pdf``, ``ole`` (legacy MS Office) or
+      ``unknown``.
+
+    `encrypted`
+      whether the document is encrypted.
+
+    `title`, `author`, `pages`, `words`
+      as stored in the document (if any).
+
+    `sheets`
+      list of sheet names for spreadsheets.
+
+    `slides`
+      number of slides for presentations.
+
+    `size`
+      size of the document in bytes.
+
+    `cost`
+      the estimated cost of a conversion, see :func:`estimate_cost`.
+
+    Values unknown are ``None``. Nothing is guessed from the contents
+    of documents, we only read the metadata stored. Damaged documents
+    give what was found before the damage.
+    """
+    result = _new_result(path)
+    with open(path, 'rb') as fd:
+        head = fd.read(8)
+    try:
+        if head.startswith(b'%PDF-'):
+            _probe_pdf(path, result)
+        elif head.startswith(b'PK\x03\x04'):
+            with zipfile.ZipFile(path) as zf:
+                names = zf.namelist()
+                if 'mimetype' in names or 'content.xml' in names:
+                    _probe_odf(zf, result)
+                elif '[Content_Types].xml' in names:
+                    _probe_ooxml(zf, result)
+        elif head == OLE_MAGIC:
+            result['format'] = 'ole'
+            with open(path, 'rb') as fd:
+                data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                if data.find(OLE_ENCRYPTED) > -1:
+                    result['format'] = 'ooxml'
+                    result['encrypted'] = True
+                data.close()
+    except Exception:
+        # damaged docs can make zipfile, zlib or the XML parser fail
+        # in many ways. We deliver what we found so far.
+        pass
+    result['cost'] = estimate_cost(result)
+    return result
+
+
+def probe(path, cache_dir=None):
+    """Get metadata of the document in `path`, maybe from cache.
+
+    Works like :func:`probe_document`. If `cache_dir` is given,
+    results are stored in the ``.probe`` subdirectory of it and
+    retrieved by the MD5 digest of the document.
+    """
+    if cache_dir is None:
+        return probe_document(path)
+    probe_dir = os.path.join(cache_dir, '.probe')
+    cache_path = os.path.join(
+        probe_dir, CacheManager.get_hash(path) + '.json')
+    if os.path.isfile(cache_path):
+        with open(cache_path, 'r') as fd:
+            return json.load(fd)
+    result = probe_document(path)
+    try:
+        os.makedirs(probe_dir)
+    except OSError:
+        if not os.path.isdir(probe_dir):
+            raise
+    fd, tmp_path = tempfile.mkstemp(dir=probe_dir)
+    with os.fdopen(fd, 'w') as tmp_file:
+        json.dump(result, tmp_file)
+    os.rename(tmp_path, cache_path)
+    return result
@@ -37,16 +37,26 @@ more accurate: the processor with `prefix` ``oocp`` (which happens to
 be the :class:`OOConvProcessor`, see below).
 """
 import codecs
+import multiprocessing
 import os
 import shutil
 import tempfile
-from ulif.openoffice.convert import convert
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from ulif.openoffice.convert import convert, get_url
+from ulif.openoffice.endpoints import (
+    get_endpoint_pool, resolve_endpoint, NoEndpointAvailable)
 from ulif.openoffice.helpers import (
-    copy_to_secure_location, get_entry_points, zip, unzip, remove_file_dir,
-    extract_css, cleanup_html, cleanup_css, rename_sdfield_tags,
-    string_to_stringtuple)
+    copy_to_secure_location, get_entry_points, get_entry_point_names, zip,
+    unzip, remove_file_dir, extract_css, cleanup_html, cleanup_css,
+    rename_sdfield_tags, string_to_stringtuple, ZipLimitError)
 from ulif.openoffice.helpers import strict_string_to_bool as boolean
 from ulif.openoffice.options import Argument, Options
+from ulif.openoffice.probe import probe_document
+from ulif.openoffice.textextract import extract_text, TextExtractionError
 
 
 #: The default order, processors are run.
@@ -55,19 +65,162 @@ DEFAULT_PROCORDER = 'unzip,oocp,tidy,html_cleaner,css_cleaner,zip'
 
 def processor_order(string):
     proc_tuple = string_to_stringtuple(string)
-    proc_names = list(get_entry_points('ulif.openoffice.processors').keys())
+    proc_names = get_entry_point_names('ulif.openoffice.processors')
     for name in proc_tuple:
         if name not in proc_names:
             raise ValueError('Only values in %r are allowed.' % proc_names)
     return proc_tuple
 
 
+#: Seconds to wait for a task of a :class:`PostprocPool`.
+POSTPROC_TIMEOUT = 300
+
+
+def _get_mp_context():
+    # workers must not be forked from our (threaded) process: locks
+    # held by other threads at fork time would never be released.
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')     # pragma: no cover
+
+
+class PostprocPool(object):
+    """A pool of `size` worker processes running CPU-bound processors.
+
+    The workers are replaced by fresh ones after they handled
+    `max_tasks` tasks each (on average). This way memory hogged while
+    handling huge documents is given back to the system. If
+    `max_tasks` is ``None`` workers live as long as the pool.
+
+    If a worker dies (killed by the OOM killer, for instance), the
+    task fails with :exc:`BrokenProcessPool` and the next task gets
+    fresh workers. Tasks not done after `timeout` seconds fail with
+    :exc:`concurrent.futures.TimeoutError` and their workers are
+    killed. Callers never wait forever.
+
+    Workers are started by a fork server (or spawned), so they do not
+    inherit locks held by other threads of the calling process.
+    """
+    def __init__(self, size, max_tasks=None, timeout=POSTPROC_TIMEOUT):
+        self.size = size
+        self.max_tasks = max_tasks
+        self.timeout = timeout
+        self._executor = None
+        self._tasks = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # get the current executor, replace it if it is used up.
+        # Must be called with the lock held.
+        used_up = self.max_tasks and (
+            self._tasks >= self.size * self.max_tasks)
+        if self._executor is None or used_up:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)  # tasks finish
+            self._executor = ProcessPoolExecutor(
+                self.size, mp_context=_get_mp_context())
+            self._tasks = 0
+        self._tasks += 1
+        return self._executor
+
+    def _drop(self, executor, kill=False):
+        # renew `executor` on next run, kill its workers if requested
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+        if kill:
+            # there is no public API to stop hanging workers
+            for process in list(
+                    (getattr(executor, '_processes', None) or {}).values()):
+                process.terminate()
+
+    def run(self, func, *args):
+        """Run `func` with `args` in a worker process and get the result.
+        """
+        with self._lock:
+            # submit before anybody can shut down the executor
+            executor = self._get_executor()
+            future = executor.submit(func, *args)
+        try:
+            return future.result(self.timeout)
+        except BrokenProcessPool:
+            self._drop(executor)
+            raise
+        except FutureTimeoutError:
+            self._drop(executor, kill=True)
+            raise
+
+    def shutdown(self):
+        """Stop all workers once running tasks are done.
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+#: The process pool used for CPU-bound processors, if any.
+_postproc_pool = None
+_postproc_pool_lock = threading.Lock()
+
+
+def set_postproc_pool(size=0, max_tasks=None, replace=True):
+    """Set up a process pool to run CPU-bound processors in.
+
+    Processors that do pure-Python work (i.e. those with a true
+    `cpu_bound` attribute) are then run in one of `size` worker
+    processes instead of the calling thread. Other processors, like
+    the LibreOffice converter, are still run in the calling thread.
+    See :class:`PostprocPool` for `max_tasks`.
+
+    The pool is shared by all users in a process. If `replace` is
+    false, an existing pool with at least `size` workers is kept, so
+    several apps in one process do not replace each others pools.
+    Tasks running in a replaced pool are finished.
+
+    A `size` of zero (the default) disables any running pool (only if
+    `replace` is true).
+
+    Returns the pool now in use or ``None``.
+    """
+    global _postproc_pool
+    with _postproc_pool_lock:
+        if _postproc_pool is not None:
+            if not replace and _postproc_pool.size >= size:
+                return _postproc_pool
+            _postproc_pool.shutdown()
+            _postproc_pool = None
+        if size:
+            _postproc_pool = PostprocPool(size, max_tasks)
+    return _postproc_pool
+
+
+def get_postproc_pool():
+    """Get the process pool set by :func:`set_postproc_pool`, if any.
+    """
+    return _postproc_pool
+
+
+def run_processor(proc_class, options, input, metadata):
+    """Create a `proc_class` instance and let it process `input`.
+
+    Used to run processors in worker processes.
+    """
+    return proc_class(options).process(input, metadata)
+
+
 class BaseProcessor(object):
     """A base for self-built document processors.
     """
     #: The name under which this processor is known. A simple string.
     prefix = 'base'
 
+    #: Whether this processor does pure-Python, CPU-bound work only.
+    #: Such processors can be run in a process pool.
+    #: See :func:`set_postproc_pool`.
+    cpu_bound = False
+
     metadata = {}
 
     #: The argparser args acceptable by this processor.
@@ -184,16 +337,39 @@ class MetaProcessor(BaseProcessor):
         the :class:`OOConvProcessor`, registered under ``oocp`` in
         `setup.py`) is called two times.
 
+        If a process pool was set up with :func:`set_postproc_pool`,
+        CPU-bound processors are run in this pool. If the worker dies
+        or times out, processing fails with an error.
+
         .. note:: after each processing, the (then old) input is
                   removed.
         """
         metadata = metadata.copy()
         pipeline = self._build_pipeline()
         output = None
+        pool = get_postproc_pool()
 
         for processor in pipeline:
-            proc_instance = processor(self.all_options)
-            output, metadata = proc_instance.process(input, metadata)
+            if pool is not None and processor.cpu_bound:
+                try:
+                    output, metadata = pool.run(
+                        run_processor, processor, self.all_options, input,
+                        metadata)
+                except BrokenProcessPool:
+                    output = None
+                    metadata['error'] = True
+                    metadata['error-descr'] = (
+                        'worker process died while processing %s' % (
+                            processor.prefix))
+                except FutureTimeoutError:
+                    output = None
+                    metadata['error'] = True
+                    metadata['error-descr'] = (
+                        'worker process timed out while processing %s' % (
+                            processor.prefix))
+            else:
+                proc_instance = processor(self.all_options)
+                output, metadata = proc_instance.process(input, metadata)
             if metadata['error'] is True:
                 metadata = self._handle_error(
                     processor, input, output, metadata)
@@ -239,6 +415,23 @@ class OOConvProcessor(BaseProcessor):
                 PDF_export#How_to_use_it_from_OOo_Basic
 
          only for a list of PDF export options.
+
+    Text (``txt``) from OpenDocument and Office Open XML documents is
+    extracted without LibreOffice by default. See
+    :mod:`ulif.openoffice.textextract`. Other documents, or documents
+    we cannot handle there, are converted by LibreOffice.
+
+    If a pool of office servers was set with
+    :func:`ulif.openoffice.endpoints.set_endpoints`, conversions are
+    done there and the ``oocp-host`` and ``oocp-port`` options are
+    ignored.
+
+    Local office servers run by ``oooctl`` are connected by pipe
+    instead of TCP. See :func:`ulif.openoffice.convert.get_url`. If
+    ``oooctl`` moved the instance off ``oocp-port`` while recycling,
+    we follow it, if its state file was set with
+    :func:`ulif.openoffice.endpoints.set_state_file` (see
+    :func:`ulif.openoffice.endpoints.resolve_endpoint`).
     """
     prefix = 'oocp'
 
@@ -274,6 +467,11 @@ class OOConvProcessor(BaseProcessor):
                  help='Port of host to contact for LibreOffice document '
                  'conversion. Default: 2002',
                  ),
+        Argument('-oocp-native-txt', '--oocp-native-text',
+                 type=boolean, default=True, metavar='YES|NO',
+                 help='Extract text from ODF/OOXML docs without '
+                 'LibreOffice when creating txt. Default: yes',
+                 ),
         ]
 
     def _get_filter_props(self):
@@ -293,22 +491,40 @@ class OOConvProcessor(BaseProcessor):
             path = os.path.dirname(path)
         shutil.rmtree(path)
         extension = self.options['oocp_output_format']
+        if extension == 'txt' and self.options['oocp_native_text']:
+            result_path = '%s.txt' % os.path.splitext(src)[0]
+            try:
+                extract_text(src, result_path)
+            except TextExtractionError:
+                pass
+            else:
+                metadata['oocp_status'] = 0
+                if os.path.basename(result_path) != basename:
+                    os.unlink(src)
+                return result_path, metadata
         filter_name = self.formats[extension]
-        url = 'socket,host=%s,port=%d;urp;StarOffice.ComponentContext' % (
-            self.options['oocp_hostname'], self.options['oocp_port'])
-
         filter_props = self._get_filter_props()
-        status, result_path = convert(
-            url=url,
+        kw = dict(
             out_format=filter_name,
             filter_props=filter_props,
             path=src,
             out_dir=os.path.dirname(src) + '/',
             )
+        pool = get_endpoint_pool()
+        descr = 'conversion problem'
+        if pool is None:
+            url = get_url(*resolve_endpoint(
+                self.options['oocp_hostname'], self.options['oocp_port']))
+            status, result_path = convert(url=url, **kw)
+        else:
+            try:
+                status, result_path = pool.convert(**kw)
+            except NoEndpointAvailable as err:
+                status, descr = None, str(err)
         metadata['oocp_status'] = status
         if status != 0:
             metadata['error'] = True
-            metadata['error-descr'] = 'conversion problem'
+            metadata['error-descr'] = descr
             if os.path.isfile(src):
                 src = os.path.dirname(src)
             shutil.rmtree(src)
@@ -327,27 +543,59 @@ class OOConvProcessor(BaseProcessor):
 class UnzipProcessor(BaseProcessor):
     """A processor that unzips delivered files if applicable.
 
-    The .zip file might contain only exactly one file.
+    The .zip file might contain only exactly one file. This is checked
+    before anything is extracted.
+
+    Extraction is streamed and limited to a maximum of uncompressed
+    bytes and a maximum compression ratio. Archives exceeding these
+    limits are rejected.
     """
     prefix = 'unzip'
 
+    args = [
+        Argument('-unzip-max-size', '--unzip-max-size',
+                 type=int, default=512, metavar='MEGABYTES',
+                 help='Maximum size of unzipped content in megabytes. '
+                 '0 means no limit. Default: 512',
+                 ),
+        Argument('-unzip-max-ratio', '--unzip-max-ratio',
+                 type=int, default=100, metavar='RATIO',
+                 help='Maximum ratio of unzipped size to zipped size. '
+                 '0 means no limit. Default: 100',
+                 ),
+    ]
+
     supported_extensions = ['.zip', ]
 
+    def _error(self, metadata, descr):
+        metadata['error'] = True
+        metadata['error-descr'] = descr
+        return None, metadata
+
     def process(self, path, metadata):
         ext = os.path.splitext(path)[1]
         if ext not in self.supported_extensions:
             return path, metadata
         if ext == '.zip':
+            try:
+                with zipfile.ZipFile(path) as zf:
+                    names = zf.namelist()
+            except zipfile.BadZipfile:
+                return self._error(metadata, 'not a valid ZIP file')
+            if len(names) != 1 or '/' in names[0]:
+                return self._error(
+                    metadata, 'ambiguity problem: several files')
+            max_size = self.options['unzip_max_size'] or None
+            if max_size is not None:
+                max_size = max_size * 1024 * 1024
             dst = tempfile.mkdtemp()
-            unzip(path, dst)
-            dirlist = os.listdir(dst)
-            if len(dirlist) != 1 or os.path.isdir(
-                    os.path.join(dst, dirlist[0])):
-                metadata['error'] = True
-                metadata['error-descr'] = 'ambiguity problem: several files'
+            try:
+                unzip(path, dst, max_size=max_size,
+                      max_ratio=self.options['unzip_max_ratio'] or None)
+            except ZipLimitError as err:
                 shutil.rmtree(dst)
-                return None, metadata
-            path = os.path.join(dst, dirlist[0])
+                return self._error(metadata, str(err))
+            path = os.path.join(dst, names[0])
         return path, metadata
 
 
@@ -355,14 +603,38 @@ class ZipProcessor(BaseProcessor):
     """A processor that zips the directory delivered.
 
     `path` must be `str` type.
+
+    Files that are compressed already (like JPEG or PNG images) are
+    stored uncompressed by default.
     """
     prefix = 'zip'
 
+    args = [
+        Argument('-zip-level', '--zip-compression-level',
+                 type=int, default=6, choices=range(10), metavar='0-9',
+                 help='Compression level. 0 means no compression. '
+                 'Default: 6',
+                 ),
+        Argument('-zip-store-compressed', '--zip-store-compressed',
+                 type=boolean, default=True, metavar='YES|NO',
+                 help='Store already compressed files (images, etc.) '
+                 'without compressing them again. Default: yes',
+                 ),
+        Argument('-zip-threads', '--zip-threads',
+                 type=int, default=0, metavar='NUM',
+                 help='Number of threads to compress files in. '
+                 'Default: 0 (no extra threads)',
+                 ),
+    ]
+
     def process(self, path, metadata):
+        basename = os.path.basename(path)
         if os.path.isfile(path):
-            basename = os.path.basename(path)
-        path = os.path.dirname(path)
-        zip_file = list(zip(path))
+            path = os.path.dirname(path)
+        zip_file = zip(
+            path, level=self.options['zip_compression_level'],
+            store_compressed=self.options['zip_store_compressed'],
+            threads=self.options['zip_threads'])
         shutil.rmtree(path)
         result_path = os.path.join(
             os.path.dirname(zip_file), basename + '.zip')
@@ -416,6 +688,8 @@ class CSSCleaner(BaseProcessor):
     """
     prefix = 'css_cleaner'
 
+    cpu_bound = True
+
     args = [
         Argument('-css-cleaner-min', '--css-cleaner-minified',
                  type=boolean, default=True,
@@ -467,6 +741,8 @@ class HTMLCleaner(BaseProcessor):
     """
     prefix = 'html_cleaner'
 
+    cpu_bound = True
+
     args = [
         Argument('-html-cleaner-fix-head-nums',
                  '--html-cleaner-fix-heading-numbers',
@@ -530,6 +806,20 @@ class HTMLCleaner(BaseProcessor):
         return
 
 
+class ProbeProcessor(BaseProcessor):
+    """A processor that gets metadata of the passed document.
+
+    The result of :func:`ulif.openoffice.probe.probe_document` is
+    stored as `probe` in metadata. The document itself is passed
+    unchanged. No office instance is needed for that.
+    """
+    prefix = 'probe'
+
+    def process(self, path, metadata):
+        metadata['probe'] = probe_document(path)
+        return path, metadata
+
+
 class Error(BaseProcessor):
     """A processor that returns an error message.
 
@@ -0,0 +1,940 @@
+#
+# supervisor.py
+#
+# Copyright (C) 2015 Uli Fouquet
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Supervise local office server instances.
+
+A :class:`Supervisor` keeps office instances running and restarts
+them when they die. This is what ``oooctl`` runs.
+
+Instances are child processes of the supervisor. When one dies, we
+learn it from ``SIGCHLD`` at once, and not with the next check of
+its port. Instances crashing again and again are restarted with
+growing delays.
+
+Office instances started directly listen on a pipe besides their
+TCP port. Local clients use it automatically, see
+:func:`ulif.openoffice.convert.get_url`.
+
+The first conversions of a fresh instance are slow, as filters,
+fonts and libraries are loaded lazily. Instances can therefore run
+some warm-up conversions (see :func:`warm_up`) before they get into
+rotation.
+
+Creating an office user profile takes seconds. Therefore a profile
+template is built once (see :func:`build_profile`) and each instance
+starts with a fresh copy of it.
+
+Long running office instances grow and get slower. Instances are
+therefore recycled according to a :class:`RecyclePolicy`. This does
+not drop any conversions: a replacement instance is started first
+and only when it is ready, the old one is drained (taken out of
+rotation) and stopped as soon as no connections are open any more.
+
+Clients learn about the instances currently in rotation from the
+state file written by the supervisor. See
+:mod:`ulif.openoffice.endpoints`.
+"""
+import fcntl
+import json
+import logging
+import os
+import select
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from hashlib import md5
+from ulif.openoffice import convert as _convert
+from ulif.openoffice.convert import PIPE_PREFIX, get_pipe_path
+from ulif.openoffice.endpoints import probe_endpoint
+from ulif.openoffice.helpers import copytree
+
+
+#: States of office instances.
+STARTING = 'starting'
+WARMING = 'warming'
+READY = 'ready'
+DRAINING = 'draining'
+STOPPING = 'stopping'
+
+#: State of established connections in ``/proc/net/tcp``.
+TCP_ESTABLISHED = '01'
+
+#: State of connected sockets in ``/proc/net/unix``.
+UNIX_CONNECTED = '03'
+
+#: Seconds to wait for an instance to stop before killing it.
+STOP_TIMEOUT = 5.0
+
+#: Seconds a draining instance may keep connections open.
+DRAIN_TIMEOUT = 300.0
+
+#: Seconds between checks whether ready instances still answer.
+CHECK_INTERVAL = 1.0
+
+#: Seconds between measurements of the memory used by instances.
+RSS_INTERVAL = 5.0
+
+#: Seconds between checks whether starting instances are ready.
+READY_INTERVAL = 0.05
+
+#: Seconds an instance may take to get ready.
+START_TIMEOUT = 60.0
+
+#: Seconds warm-up conversions of an instance may take.
+WARMUP_TIMEOUT = 120.0
+
+#: Directory of documents used for warm-up conversions.
+WARMUP_DIR = os.path.join(os.path.dirname(__file__), 'warmup')
+
+#: Documents (and their unoconv doctypes) used for warm-up conversions
+#: by filter family.
+WARMUP_DOCS = {
+    'writer': ('warmup.fodt', 'document'),
+    'calc': ('warmup.fods', 'spreadsheet'),
+    'impress': ('warmup.fodp', 'presentation'),
+    }
+
+#: Default warm-up conversions as ``FAMILY:FORMAT`` pairs.
+WARMUP_CONVERSIONS = (
+    'writer:html,writer:pdf,writer:txt,calc:html,calc:pdf,'
+    'impress:html,impress:pdf')
+
+#: Instances running this long are stable. If they die, they are
+#: restarted at once.
+STABLE_TIME = 30.0
+
+#: Seconds to wait before restarting instances that were not stable.
+#: Doubled for each further crash, up to :data:`MAX_RESTART_DELAY`.
+RESTART_DELAY = 0.1
+
+#: Maximum seconds to wait before restarting instances.
+MAX_RESTART_DELAY = 30.0
+
+#: Arguments to start office instances with.
+OFFICE_ARGS = [
+    '--headless', '--invisible', '--nocrashreport', '--nodefault',
+    '--nofirststartwizard', '--nologo', '--norestore']
+
+#: Seconds building a profile template may take.
+PROFILE_TIMEOUT = 120.0
+
+#: Settings added to profile templates. No wizards, no tips, no
+#: recovery data, no autosave.
+PROFILE_SETTINGS = [
+    ('/org.openoffice.Setup/Office', 'ooSetupInstCompleted', 'true'),
+    ('/org.openoffice.Setup/Office', 'FirstStartWizardCompleted', 'true'),
+    ('/org.openoffice.Office.Common/Misc', 'FirstRun', 'false'),
+    ('/org.openoffice.Office.Common/Misc', 'ShowTipOfTheDay', 'false'),
+    ('/org.openoffice.Office.Common/Save/Document', 'AutoSave', 'false'),
+    ('/org.openoffice.Office.Recovery/RecoveryInfo', 'Enabled', 'false'),
+    ]
+
+REGISTRY_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<oor:items xmlns:oor="http://openoffice.org/2001/registry" '
+    'xmlns:xs="http://www.w3.org/2001/XMLSchema" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n')
+REGISTRY_TAIL = '</oor:items>\n'
+REGISTRY_ITEM = (
+    '<item oor:path="%s"><prop oor:name="%s" oor:op="fuse">'
+    '<value>%s</value></prop></item>\n')
+
+logger = logging.getLogger('ulif.openoffice.supervisor')
+
+
+def _read_rss(path):
+    # get the ``VmRSS`` value in kilobytes from a ``status`` file.
+    try:
+        with open(path, 'r') as fd:
+            for line in fd:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_children(proc='/proc'):
+    """Get the children of all processes.
+
+    Returns a dict mapping process ids to lists of the ids of their
+    children, as found in ``/proc/<pid>/stat`` (Linux only), or
+    ``None`` if `proc` cannot be read.
+    """
+    children = {}
+    try:
+        names = os.listdir(proc)
+    except OSError:
+        return None
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join(proc, name, 'stat'), 'r') as fd:
+                stat = fd.read()
+            # the command name in parentheses may contain spaces
+            ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        except (IOError, OSError, ValueError, IndexError):
+            continue                        # process gone meanwhile
+        children.setdefault(ppid, []).append(int(name))
+    return children
+
+
+def get_rss(pid, proc='/proc', children=None):
+    """Get the memory used by process `pid` and its descendants.
+
+    The resident set sizes are read from ``/proc/<pid>/status``
+    (Linux only) and returned in kilobytes. Office instances consist
+    of several processes (wrapper scripts, ``soffice.bin``), so
+    descendants count as well. They are looked up in `children` (as
+    returned by :func:`get_children`), which is read from `proc` if
+    not given.
+
+    Returns ``None`` if the size cannot be determined.
+    """
+    if children is None:
+        children = get_children(proc)
+        if children is None:
+            return None
+    result = None
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        pids.extend(children.get(current, []))
+        rss = _read_rss(os.path.join(proc, str(current), 'status'))
+        if rss is not None:
+            result = (result or 0) + rss
+    return result
+
+
+def get_connections(proc='/proc'):
+    """Get the established connections of this host.
+
+    Returns a dict mapping local ports to sets of remote addresses,
+    as found in ``/proc/net/tcp`` and ``/proc/net/tcp6``, and paths
+    of Unix domain sockets to sets of socket inodes, as found in
+    ``/proc/net/unix`` (Linux only).
+    """
+    result = {}
+    try:
+        with open(os.path.join(proc, 'net', 'unix'), 'r') as fd:
+            lines = fd.readlines()[1:]
+    except (IOError, OSError):
+        lines = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 8 or fields[5] != UNIX_CONNECTED:
+            continue
+        result.setdefault(fields[7], set()).add(fields[6])
+    for name in ('tcp', 'tcp6'):
+        try:
+            with open(os.path.join(proc, 'net', name), 'r') as fd:
+                lines = fd.readlines()[1:]
+        except (IOError, OSError):
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 4 or fields[3] != TCP_ESTABLISHED:
+                continue
+            port = int(fields[1].rsplit(':', 1)[1], 16)
+            result.setdefault(port, set()).add(fields[2])
+    return result
+
+
+def parse_warmup(text):
+    """Parse warm-up conversions given as ``FAMILY:FORMAT`` pairs.
+
+    Pairs are separated by commas. Families are the keys of
+    :data:`WARMUP_DOCS`. Returns a list of tuples ``(FAMILY,
+    FORMAT)``. Raises :exc:`ValueError` for invalid pairs.
+    """
+    result = []
+    for pair in text.replace(',', ' ').split():
+        family, _, out_format = pair.partition(':')
+        if family not in WARMUP_DOCS or not out_format:
+            raise ValueError('invalid warm-up conversion: %s' % pair)
+        result.append((family, out_format))
+    return result
+
+
+def warm_up(url, conversions, executable='unoconv'):
+    """Run warm-up `conversions` with the office server at `url`.
+
+    `conversions` is a list of ``(FAMILY, FORMAT)`` tuples as returned
+    by :func:`parse_warmup`. Each converts the tiny document bundled
+    for `FAMILY` to `FORMAT`, using the `unoconv` at `executable`.
+    Results are thrown away. `unoconv` must not start an office server
+    of its own if the one at `url` is gone.
+
+    Returns the number of failed conversions.
+    """
+    failed = 0
+    for family, out_format in conversions:
+        name, doctype = WARMUP_DOCS[family]
+        work_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(work_dir, name)
+            shutil.copy(os.path.join(WARMUP_DIR, name), path)
+            status, result_dir = _convert.convert(
+                url=url, out_format=out_format, path=path,
+                out_dir=work_dir, doctype=doctype, executable=executable,
+                no_launch=True)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if status != 0:
+            logger.warning(
+                'warm-up %s:%s failed (%s)', family, out_format, status)
+            failed += 1
+    return failed
+
+
+def profile_url(path):
+    """Get the ``UserInstallation`` URL of the profile in `path`.
+    """
+    return 'file://' + os.path.abspath(path)
+
+
+def build_profile(officepath, path, timeout=PROFILE_TIMEOUT):
+    """Build an office user profile in `path`.
+
+    The office at `officepath` is started once to create the profile
+    (and populate its caches). Afterwards first start wizards and
+    the like are disabled (see :data:`PROFILE_SETTINGS`).
+
+    `path` must not exist. The profile is built in a temporary
+    directory and moved there when complete.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix='.tmp-profile-')
+    try:
+        process = subprocess.Popen(
+            [officepath] + OFFICE_ARGS + [
+                '--terminate_after_init',
+                '-env:UserInstallation=%s' % profile_url(tmp_path)],
+            close_fds=True, preexec_fn=os.setsid)
+        deadline = time.time() + timeout
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if process.poll() is None:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            raise RuntimeError('building office profile timed out')
+        if process.returncode != 0:
+            raise RuntimeError(
+                'building office profile failed (%s)' % process.returncode)
+        registry = os.path.join(tmp_path, 'user', 'registrymodifications.xcu')
+        content = REGISTRY_HEAD + REGISTRY_TAIL
+        if os.path.isfile(registry):
+            with open(registry, 'r') as fd:
+                content = fd.read()
+        else:
+            os.makedirs(os.path.dirname(registry))
+        items = ''.join(REGISTRY_ITEM % item for item in PROFILE_SETTINGS)
+        content = content.replace(REGISTRY_TAIL.strip(), items + REGISTRY_TAIL)
+        with open(registry, 'w') as fd:
+            fd.write(content)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+            shutil.rmtree(tmp_path)     # built by someone else meanwhile
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def copy_profile(src, dst):
+    """Copy the profile in `src` to `dst` (an empty dir, maybe).
+
+    Files are copied as reflinks (sharing data until changed) where
+    the filesystem supports this.
+    """
+    if os.path.isdir(dst):
+        os.rmdir(dst)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                ['cp', '-a', '--reflink=auto', src, dst],
+                stdout=devnull, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        # no GNU cp
+        shutil.rmtree(dst, ignore_errors=True)
+        copytree(src, dst, symlinks=True)
+
+
+class RecyclePolicy(object):
+    """When to recycle office instances.
+
+    Instances are recycled after `max_conversions` conversions, when
+    they use more than `max_rss` kilobytes of memory or when they are
+    older than `max_age` seconds. ``None`` means: no limit.
+
+    Conversions are counted by connections to an instance, as seen
+    by the supervisor every few tenths of a second. The count is
+    therefore approximate: conversions shorter than that may be
+    missed and health checks of clients (see
+    :mod:`ulif.openoffice.endpoints`) and
+    :func:`ulif.openoffice.convert.get_url` may count as well.
+
+    The memory used is measured by the supervisor every
+    :data:`RSS_INTERVAL` seconds (see :attr:`Instance.rss`).
+    """
+    def __init__(self, max_conversions=None, max_rss=None, max_age=None):
+        self.max_conversions = max_conversions
+        self.max_rss = max_rss
+        self.max_age = max_age
+
+    def reason(self, instance, now=None):
+        """Tell why `instance` should be recycled.
+
+        Returns a message or ``None`` if the instance may keep
+        running.
+        """
+        now = now or time.time()
+        if self.max_conversions is not None and (
+                instance.conversions >= self.max_conversions):
+            return '%s conversions done' % instance.conversions
+        if self.max_age is not None and (
+                now - instance.started >= self.max_age):
+            return 'running for %d seconds' % (now - instance.started)
+        if self.max_rss is not None and instance.rss is not None and (
+                instance.rss > self.max_rss):
+            return 'using %s kB of memory' % instance.rss
+        return None
+
+
+class Instance(object):
+    """An office instance listening at `host` and `port`.
+
+    `command` is the command (a list) to start the instance with.
+    """
+    def __init__(self, command, port, host='localhost', pipe=None):
+        self.command = command
+        self.port = port
+        self.host = host
+        self.pipe = pipe
+        self.process = None
+        self.profile = None
+        self.state = None
+        self.started = None
+        self.checked = None
+        self.stopped = None
+        self.drained = None
+        self.replaces = None
+        self.warmup = None
+        self.warmed = None
+        self.prober = None
+        self.alive = None
+        self.recycle_at = 0
+        self.conversions = 0
+        self.connections = set()
+        #: Kilobytes of memory used, as last measured (see
+        #: :func:`get_rss`).
+        self.rss = None
+
+    def __repr__(self):
+        return '<Instance %s:%s (%s)>' % (self.host, self.port, self.state)
+
+    @property
+    def pid(self):
+        """The process id of the instance or ``None``.
+        """
+        return self.process is not None and self.process.pid or None
+
+    def start(self):
+        """Start the instance in a new process group.
+        """
+        self.process = subprocess.Popen(
+            self.command, close_fds=True, preexec_fn=os.setsid)
+        self.state = STARTING
+        self.started = self.checked = time.time()
+        self.conversions = 0
+        self.connections = set()
+        self.rss = None
+
+    def probe(self):
+        """Probe the instance without blocking.
+
+        Starts a thread running
+        :func:`ulif.openoffice.endpoints.probe_endpoint`, if none is
+        running. Returns the result once the probe is done and
+        ``None`` while probing.
+        """
+        if self.prober is None:
+            self.prober = threading.Thread(target=self._probe)
+            self.prober.daemon = True
+            self.prober.start()
+            return None
+        if self.prober.is_alive():
+            return None
+        self.prober = None
+        return self.alive
+
+    def _probe(self):
+        self.alive = probe_endpoint(self.host, self.port)
+
+    def running(self):
+        """Tell whether the instance process is still running.
+        """
+        return self.process is not None and self.process.poll() is None
+
+    def signal(self, signum):
+        """Send `signum` to all processes of the instance.
+        """
+        try:
+            os.killpg(self.process.pid, signum)
+        except OSError:
+            pass                                # gone already
+
+    def terminate(self):
+        """Ask the instance to stop. See :meth:`running`.
+        """
+        self.state = STOPPING
+        self.stopped = time.time()
+        self.signal(signal.SIGTERM)
+
+    def as_dict(self):
+        """Get the instance data stored in state files.
+        """
+        return dict(
+            host=self.host, port=self.port, pipe=self.pipe, pid=self.pid,
+            state=self.state, started=self.started,
+            conversions=self.conversions)
+
+
+class Supervisor(object):
+    """Keep `size` office instances running.
+
+    `officepath` is the path to the office executable (``soffice``)
+    used to start instances. If it is not given, `binarypath`, the
+    path to the `unoconv` executable, is used to start instances with
+    ``unoconv --listener``. Instances listen on `port` or the ports
+    above.
+
+    Instances are recycled according to `policy`, a
+    :class:`RecyclePolicy`. Draining instances are stopped after
+    `drain_timeout` seconds, even with connections open.
+
+    If `state_file` is given, the current instances are written
+    there as JSON whenever they change.
+
+    Office instances started with `officepath` get their own user
+    profile in `profile_dir`, copied from a template built there
+    first. Without `profile_dir` each of them gets an empty temporary
+    profile, which the office populates on start.
+
+    Instances failing to start (because the office binary is missing
+    or the profile template cannot be built, for instance) are
+    started again later, with delays growing like those of crashing
+    instances.
+
+    New instances run the warm-up conversions in `warmup` (see
+    :func:`parse_warmup`) before they get ready.
+
+    Connections to instances are counted every `interval` seconds.
+    The memory they use is measured every :data:`RSS_INTERVAL`
+    seconds.
+    """
+    def __init__(self, binarypath, size=1, port=2002, policy=None,
+                 state_file=None, drain_timeout=DRAIN_TIMEOUT,
+                 interval=0.1, officepath=None, profile_dir=None,
+                 warmup=()):
+        self.binarypath = binarypath
+        self.warmup = list(warmup)
+        self.officepath = officepath
+        self.profile_dir = profile_dir
+        self.size = size
+        self.port = port
+        self.policy = policy or RecyclePolicy()
+        self.state_file = state_file
+        self.drain_timeout = drain_timeout
+        self.interval = interval
+        self.instances = []
+        self.restarts = []
+        self.crashes = 0
+        self.stopping = False
+        self.rss_checked = 0
+
+    def command(self, port, profile=None):
+        """Get the command starting an instance on `port`.
+
+        `profile` is the path of the user profile to use, if any.
+        """
+        if self.officepath is None:
+            return [self.binarypath, '--listener', '--server=localhost',
+                    '--port=%d' % port]
+        command = [self.officepath] + OFFICE_ARGS + [
+            '--accept=socket,host=localhost,port=%d;urp;'
+            'StarOffice.ComponentContext' % port,
+            '--accept=pipe,name=%s%d;urp;'
+            'StarOffice.ComponentContext' % (PIPE_PREFIX, port)]
+        if profile is not None:
+            command.append('-env:UserInstallation=%s' % profile_url(profile))
+        return command
+
+    def profile_template(self):
+        """Get the path of the profile template, build it if needed.
+
+        Templates depend on the office binary. When it changes, a new
+        template is built.
+        """
+        stamp = '%s %s' % (
+            os.path.realpath(self.officepath),
+            os.path.getmtime(self.officepath))
+        path = os.path.join(self.profile_dir, 'template-%s' % md5(
+            stamp.encode('utf-8')).hexdigest()[:8])
+        if not os.path.isdir(path):
+            logger.info('building profile template %s', path)
+            build_profile(self.officepath, path)
+        return path
+
+    def _new_profile(self, port):
+        # get a fresh copy of the profile template, if we use profiles
+        if self.officepath is None:
+            return None
+        if self.profile_dir is None:
+            # instances must not share profiles
+            return tempfile.mkdtemp(prefix='ooodaemon-profile-%d-' % port)
+        template = self.profile_template()
+        path = tempfile.mkdtemp(
+            dir=self.profile_dir, prefix='instance-%d-' % port)
+        try:
+            copy_profile(template, path)
+        except Exception:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        return path
+
+    def _remove(self, instance):
+        # remove `instance` from our list, it is gone
+        self.instances.remove(instance)
+        if instance.profile is not None:
+            shutil.rmtree(instance.profile, ignore_errors=True)
+        pipe_path = instance.pipe and get_pipe_path(instance.pipe)
+        if pipe_path is not None:
+            try:
+                os.unlink(pipe_path)     # left behind by crashed office
+            except OSError:
+                pass
+
+    def _free_port(self):
+        used = [instance.port for instance in self.instances]
+        port = self.port
+        while port in used:
+            port += 1
+        return port
+
+    def spawn(self, replaces=None):
+        """Start a new instance, maybe as replacement for `replaces`.
+        """
+        port = self._free_port()
+        profile = self._new_profile(port)
+        pipe = None
+        if self.officepath is not None:
+            pipe = '%s%d' % (PIPE_PREFIX, port)
+        instance = Instance(self.command(port, profile), port, pipe=pipe)
+        instance.profile = profile
+        instance.replaces = replaces
+        try:
+            instance.start()
+        except OSError:
+            if profile is not None:
+                shutil.rmtree(profile, ignore_errors=True)
+            raise
+        self.instances.append(instance)
+        logger.info('started %r (pid %s)', instance, instance.pid)
+        return instance
+
+    def start(self):
+        """Start all instances.
+        """
+        now = time.time()
+        for num in range(self.size):
+            self._spawn(now)
+        self.write_state()
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """Stop all instances and wait for them.
+        """
+        for instance in self.instances:
+            if instance.running():
+                instance.terminate()
+        deadline = time.time() + timeout
+        for instance in self.instances:
+            while instance.running() and time.time() < deadline:
+                time.sleep(0.05)
+            if instance.running():
+                instance.signal(signal.SIGKILL)
+                instance.process.wait()
+        for instance in list(self.instances):
+            self._remove(instance)
+        if self.state_file is not None and os.path.exists(self.state_file):
+            os.unlink(self.state_file)
+
+    def write_state(self):
+        """Write current instances to the state file, if any.
+        """
+        if self.state_file is None:
+            return
+        state = dict(pid=os.getpid(), port=self.port, instances=[
+            instance.as_dict() for instance in self.instances])
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.state_file)))
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(state, tmp_file)
+        os.rename(tmp_path, self.state_file)
+
+    def _replacement(self, instance):
+        for other in self.instances:
+            if other.replaces is instance:
+                return other
+        return None
+
+    def _lost(self, instance, now):
+        # `instance` died or hangs. Start another one, if needed.
+        if instance.state == DRAINING:
+            return
+        replacement = self._replacement(instance)
+        if replacement is not None:
+            replacement.replaces = None   # already on its way
+            return
+        delay = self._delay(instance, now)
+        old = instance.replaces
+        if old in self.instances and old.state not in (DRAINING, STOPPING):
+            # the recycle check of `old` starts another replacement
+            old.recycle_at = now + delay
+            return
+        if delay:
+            logger.info('restarting in %.1f seconds', delay)
+        self.restarts.append(now + delay)
+
+    def _delay(self, instance, now):
+        # seconds to wait before replacing `instance`
+        if now - instance.started >= STABLE_TIME:
+            self.crashes = 0
+            return 0
+        return self._backoff()
+
+    def _backoff(self):
+        # count a crash, get the seconds to wait before the next start
+        self.crashes += 1
+        return min(RESTART_DELAY * 2 ** (self.crashes - 1),
+                   MAX_RESTART_DELAY)
+
+    def _spawn(self, now, replaces=None):
+        # spawn an instance. If that fails, try again later.
+        try:
+            return self.spawn(replaces=replaces)
+        except (OSError, RuntimeError, shutil.Error):
+            delay = self._backoff()
+            logger.exception(
+                'cannot start instance, retrying in %.1f seconds', delay)
+        if replaces is not None:
+            replaces.recycle_at = now + delay
+        else:
+            self.restarts.append(now + delay)
+        return None
+
+    def _shrink(self, now):
+        # stop instances beyond `size`. Returns whether any were found.
+        active = [x for x in self.instances if (
+            x.state in (STARTING, WARMING, READY) and x.replaces is None)]
+        excess = len(active) + len(self.restarts) - self.size
+        if excess <= 0:
+            return False
+        # keep ready instances on low ports
+        active.sort(key=lambda x: (x.state == READY, -x.port))
+        for instance in active[:excess]:
+            if instance.state == READY:
+                logger.info('draining %r, too many instances', instance)
+                instance.state = DRAINING
+                instance.drained = now
+            else:
+                logger.info('stopping %r, too many instances', instance)
+                instance.terminate()
+        return True
+
+    def tick(self, now=None):
+        """Check all instances once.
+
+        Restarts dead instances, counts conversions, recycles
+        instances, stops instances beyond :attr:`size` and updates
+        the state file if anything changed.
+        """
+        now = now or time.time()
+        connections = get_connections()
+        self._measure(now)
+        changed = False
+        for when in [x for x in self.restarts if x <= now]:
+            self.restarts.remove(when)
+            self._spawn(now)
+            changed = True
+        for instance in list(self.instances):
+            if instance.state == STOPPING:
+                if not instance.running():
+                    self._remove(instance)
+                    changed = True
+                elif now - instance.stopped > STOP_TIMEOUT:
+                    instance.signal(signal.SIGKILL)
+                continue
+            if not instance.running():
+                logger.warning('%r died, restarting', instance)
+                instance.signal(signal.SIGKILL)     # orphans, if any
+                self._remove(instance)
+                self._lost(instance, now)
+                changed = True
+                continue
+            current = connections.get(instance.port, set())
+            pipe_path = instance.pipe and get_pipe_path(instance.pipe)
+            if pipe_path is not None:
+                current = current | connections.get(pipe_path, set())
+            instance.conversions += len(current - instance.connections)
+            instance.connections = current
+            changed = self._check(instance, now) or changed
+        changed = self._shrink(now) or changed
+        if changed:
+            self.write_state()
+
+    def _measure(self, now):
+        # measure the memory used by ready instances, if due
+        if self.policy.max_rss is None or (
+                now - self.rss_checked < RSS_INTERVAL):
+            return
+        self.rss_checked = now
+        children = get_children()
+        if children is None:
+            return
+        for instance in self.instances:
+            if instance.state == READY:
+                instance.rss = get_rss(instance.pid, children=children)
+
+    def _check(self, instance, now):
+        # check a running `instance`. Returns whether its state changed.
+        if instance.state == STARTING:
+            # probes must not block the checks of other instances
+            if not instance.probe():
+                if now - instance.started < START_TIMEOUT:
+                    return False
+                logger.warning('%r did not start, restarting', instance)
+                self._lost(instance, now)
+                instance.terminate()     # listed until it is gone
+                return True
+            if not self.warmup:
+                self._ready(instance, now)
+                return True
+            logger.info('warming up %r', instance)
+            instance.state = WARMING
+            instance.warmup = threading.Thread(
+                target=warm_up, args=(
+                    _convert.get_url(instance.host, instance.port),
+                    self.warmup, self.binarypath))
+            instance.warmup.daemon = True
+            instance.warmed = now
+            instance.warmup.start()
+            return True
+        if instance.state == WARMING:
+            if not instance.warmup.is_alive():
+                self._ready(instance, now)
+                return True
+            if now - instance.warmed < WARMUP_TIMEOUT:
+                return False
+            logger.warning('%r did not warm up, restarting', instance)
+            self._lost(instance, now)
+            instance.terminate()         # listed until it is gone
+            return True
+        if instance.state == DRAINING:
+            if instance.connections and (
+                    now - instance.drained < self.drain_timeout):
+                return False
+            logger.info('stopping %r', instance)
+            instance.terminate()
+            return True
+        if now - instance.checked >= CHECK_INTERVAL:
+            alive = instance.probe()
+            if alive is not None:
+                instance.checked = now
+            if alive is False:
+                logger.warning('%r does not answer, restarting', instance)
+                self._lost(instance, now)
+                instance.terminate()     # listed until it is gone
+                return True
+        if self._replacement(instance) is None and now >= instance.recycle_at:
+            reason = self.policy.reason(instance, now)
+            if reason is not None:
+                logger.info('recycling %r: %s', instance, reason)
+                return self._spawn(now, replaces=instance) is not None
+        return False
+
+    def _ready(self, instance, now):
+        # put `instance` into rotation and drain the one it replaces
+        logger.info('%r is ready', instance)
+        instance.state = READY
+        instance.warmup = None
+        instance.conversions = 0        # warm-ups do not count
+        old = instance.replaces
+        instance.replaces = None
+        if old is not None and old in self.instances:
+            logger.info('draining %r', old)
+            old.state = DRAINING
+            old.drained = now
+
+    def _timeout(self, now):
+        # seconds until the next tick is due
+        timeout = self.interval
+        if [x for x in self.instances if x.state in (STARTING, WARMING)]:
+            timeout = min(timeout, READY_INTERVAL)
+        if self.restarts:
+            timeout = min(timeout, max(min(self.restarts) - now, 0))
+        return timeout
+
+    def run(self):
+        """Start instances and supervise them until interrupted.
+
+        Must be called in the main thread. ``SIGCHLD`` is handled
+        until we return, which happens when :attr:`stopping` is set.
+        """
+        wakeup_in, wakeup_out = os.pipe()
+        for fd in (wakeup_in, wakeup_out):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        old_fd = signal.set_wakeup_fd(wakeup_out)
+        old_handler = signal.signal(signal.SIGCHLD, lambda *args: None)
+        self.start()
+        try:
+            while not self.stopping:
+                self.tick()
+                # wait for the next tick or a child to exit
+                select.select(
+                    [wakeup_in], [], [], self._timeout(time.time()))
+                try:
+                    os.read(wakeup_in, 512)
+                except OSError:
+                    pass                            # nothing to read
+        finally:
+            self.stop()
+            signal.signal(signal.SIGCHLD, old_handler)
+            signal.set_wakeup_fd(old_fd)
+            os.close(wakeup_in)
+            os.close(wakeup_out)
@@ -0,0 +1,369 @@
+#
+# textextract.py
+#
+# Copyright (C) 2015 Uli Fouquet
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Extract plain text from office docs without LibreOffice.
+
+Supported are OpenDocument (``.odt``, ``.ods``, ``.odp``) and Office
+Open XML (``.docx``, ``.xlsx``, ``.pptx``) documents. The XML parts of
+these documents are parsed incrementally, so large documents are never
+held in memory completely.
+
+The text we get is meant for indexing and similar. It does not
+reflect the layout of the document.
+"""
+import codecs
+import os
+import posixpath
+import zipfile
+from xml.etree.ElementTree import iterparse
+
+
+NS_TEXT = 'urn:oasis:names:tc:opendocument:xmlns:text:1.0'
+NS_TABLE = 'urn:oasis:names:tc:opendocument:xmlns:table:1.0'
+NS_OFFICE = 'urn:oasis:names:tc:opendocument:xmlns:office:1.0'
+NS_W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+NS_S = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+NS_A = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+NS_P = 'http://schemas.openxmlformats.org/presentationml/2006/main'
+NS_R = (
+    'http://schemas.openxmlformats.org/officeDocument/2006/relationships')
+NS_PR = 'http://schemas.openxmlformats.org/package/2006/relationships'
+NS_MC = 'http://schemas.openxmlformats.org/markup-compatibility/2006'
+
+
+def _tag(namespace, name):
+    return '{%s}%s' % (namespace, name)
+
+
+#: Maximum number of repeated spreadsheet cells we write out.
+MAX_REPEAT = 256
+
+
+class TextExtractionError(ValueError):
+    """Text cannot be extracted from a document without LibreOffice.
+    """
+
+
+class _TableState(object):
+    """Collect table cells and rows while parsing.
+    """
+    def __init__(self, out):
+        self.out = out
+        self.row = None
+        self.cell = None
+
+    def start_row(self):
+        if self.row is not None:
+            raise TextExtractionError('nested tables are not supported')
+        self.row = []
+
+    def start_cell(self):
+        self.cell = []
+
+    def add_paragraph(self, text):
+        if self.cell is None:
+            self.out.write(text + '\n')
+        else:
+            self.cell.append(text)
+
+    def end_cell(self, repeat=1):
+        if self.row is not None:
+            text = ' '.join(self.cell)
+            self.row.extend([text] * (text and min(repeat, MAX_REPEAT) or 1))
+        self.cell = None
+
+    def end_row(self):
+        while self.row and not self.row[-1]:
+            self.row.pop()
+        if self.row:
+            self.out.write('\t'.join(self.row) + '\n')
+        self.row = None
+
+
+def _clear(elem):
+    # remove contents of `elem` but keep text following it.
+    tail = elem.tail
+    elem.clear()
+    elem.tail = tail
+
+
+ODF_P = (_tag(NS_TEXT, 'p'), _tag(NS_TEXT, 'h'))
+ODF_S = _tag(NS_TEXT, 's')
+ODF_TAB = _tag(NS_TEXT, 'tab')
+ODF_LINE_BREAK = _tag(NS_TEXT, 'line-break')
+ODF_ROW = _tag(NS_TABLE, 'table-row')
+ODF_CELL = _tag(NS_TABLE, 'table-cell')
+ODF_SKIP = (
+    _tag(NS_TEXT, 'tracked-changes'), _tag(NS_OFFICE, 'annotation'),
+    _tag(NS_TEXT, 'note-citation'))
+
+
+def _odf_paragraph_text(elem, parts):
+    if elem.text:
+        parts.append(elem.text)
+    for child in elem:
+        if child.tag == ODF_S:
+            parts.append(' ' * int(child.get(_tag(NS_TEXT, 'c'), '1')))
+        elif child.tag == ODF_TAB:
+            parts.append('\t')
+        elif child.tag == ODF_LINE_BREAK:
+            parts.append('\n')
+        elif child.tag not in ODF_SKIP:
+            _odf_paragraph_text(child, parts)
+        if child.tail:
+            parts.append(child.tail)
+    return parts
+
+
+def extract_odf(zf, out):
+    """Write text of OpenDocument in :class:`zipfile.ZipFile` `zf` to `out`.
+    """
+    table = _TableState(out)
+    skip = 0
+    with zf.open('content.xml') as fd:
+        for event, elem in iterparse(fd, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag in ODF_SKIP:
+                    skip += 1
+                elif tag == ODF_ROW and not skip:
+                    table.start_row()
+                elif tag == ODF_CELL and not skip:
+                    table.start_cell()
+                continue
+            if tag in ODF_SKIP:
+                skip -= 1
+                _clear(elem)
+            elif skip:
+                continue
+            elif tag in ODF_P:
+                table.add_paragraph(''.join(_odf_paragraph_text(elem, [])))
+                _clear(elem)
+            elif tag == ODF_CELL:
+                table.end_cell(int(elem.get(
+                    _tag(NS_TABLE, 'number-columns-repeated'), '1')))
+                _clear(elem)
+            elif tag == ODF_ROW:
+                table.end_row()
+                _clear(elem)
+
+
+W_P = _tag(NS_W, 'p')
+W_T = _tag(NS_W, 't')
+W_TEXT = {
+    _tag(NS_W, 'tab'): '\t', _tag(NS_W, 'br'): '\n',
+    _tag(NS_W, 'cr'): '\n', _tag(NS_W, 'noBreakHyphen'): '-'}
+W_ROW = _tag(NS_W, 'tr')
+W_CELL = _tag(NS_W, 'tc')
+MC_FALLBACK = _tag(NS_MC, 'Fallback')
+
+
+def extract_docx(zf, out):
+    """Write text of Word document in :class:`zipfile.ZipFile` `zf` to `out`.
+    """
+    table = _TableState(out)
+    skip = 0
+    parts = []
+    with zf.open('word/document.xml') as fd:
+        for event, elem in iterparse(fd, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag == MC_FALLBACK:
+                    skip += 1
+                elif tag == W_ROW and not skip:
+                    table.start_row()
+                elif tag == W_CELL and not skip:
+                    table.start_cell()
+                continue
+            if tag == MC_FALLBACK:
+                skip -= 1
+                _clear(elem)
+            elif skip:
+                continue
+            elif tag == W_T:
+                parts.append(elem.text or '')
+            elif tag in W_TEXT:
+                parts.append(W_TEXT[tag])
+            elif tag == W_P:
+                table.add_paragraph(''.join(parts))
+                parts = []
+                _clear(elem)
+            elif tag == W_CELL:
+                table.end_cell()
+                _clear(elem)
+            elif tag == W_ROW:
+                table.end_row()
+                _clear(elem)
+
+
+def _get_rels(zf, part):
+    """Get the relationships of package `part` as dict.
+
+    Keys are relationship ids, values the names of the targets inside
+    the package.
+    """
+    rels_path = posixpath.join(
+        posixpath.dirname(part), '_rels', posixpath.basename(part) + '.rels')
+    result = {}
+    with zf.open(rels_path) as fd:
+        for event, elem in iterparse(fd):
+            if elem.tag != _tag(NS_PR, 'Relationship'):
+                continue
+            target = elem.get('Target')
+            if target.startswith('/'):
+                target = target[1:]
+            else:
+                target = posixpath.normpath(
+                    posixpath.join(posixpath.dirname(part), target))
+            result[elem.get('Id')] = target
+    return result
+
+
+def _get_parts(zf, part, tag):
+    """Get names of parts referenced by elements `tag` in `part`, in order.
+    """
+    rels = _get_rels(zf, part)
+    result = []
+    with zf.open(part) as fd:
+        for event, elem in iterparse(fd):
+            if elem.tag == tag:
+                result.append(rels[elem.get(_tag(NS_R, 'id'))])
+    return result
+
+
+S_SI = _tag(NS_S, 'si')
+S_T = _tag(NS_S, 't')
+S_R = _tag(NS_S, 'r')
+S_C = _tag(NS_S, 'c')
+S_V = _tag(NS_S, 'v')
+S_IS = _tag(NS_S, 'is')
+S_ROW = _tag(NS_S, 'row')
+
+
+def _xlsx_string(elem):
+    # text of a string item, without phonetic runs.
+    parts = []
+    for child in elem:
+        if child.tag == S_T:
+            parts.append(child.text or '')
+        elif child.tag == S_R:
+            parts.extend([t.text or '' for t in child.iter(S_T)])
+    return ''.join(parts)
+
+
+def extract_xlsx(zf, out):
+    """Write text of Excel workbook in :class:`zipfile.ZipFile` `zf` to `out`.
+    """
+    strings = []
+    if 'xl/sharedStrings.xml' in zf.namelist():
+        with zf.open('xl/sharedStrings.xml') as fd:
+            for event, elem in iterparse(fd):
+                if elem.tag == S_SI:
+                    strings.append(_xlsx_string(elem))
+                    elem.clear()
+    sheets = _get_parts(zf, 'xl/workbook.xml', _tag(NS_S, 'sheet'))
+    for num, sheet in enumerate(sheets):
+        if num:
+            out.write('\n')
+        row = []
+        with zf.open(sheet) as fd:
+            for event, elem in iterparse(fd):
+                if elem.tag == S_C:
+                    cell_type = elem.get('t')
+                    if cell_type == 'inlineStr':
+                        value = _xlsx_string(elem.find(S_IS))
+                    else:
+                        value = elem.findtext(S_V) or ''
+                        if cell_type == 's':
+                            value = strings[int(value)]
+                    row.append(value)
+                    elem.clear()
+                elif elem.tag == S_ROW:
+                    while row and not row[-1]:
+                        row.pop()
+                    if row:
+                        out.write('\t'.join(row) + '\n')
+                    row = []
+                    elem.clear()
+
+
+A_P = _tag(NS_A, 'p')
+A_T = _tag(NS_A, 't')
+A_BR = _tag(NS_A, 'br')
+
+
+def extract_pptx(zf, out):
+    """Write text of presentation in :class:`zipfile.ZipFile` `zf` to `out`.
+    """
+    slides = _get_parts(zf, 'ppt/presentation.xml', _tag(NS_P, 'sldId'))
+    for num, slide in enumerate(slides):
+        if num:
+            out.write('\n')
+        parts = []
+        with zf.open(slide) as fd:
+            for event, elem in iterparse(fd):
+                if elem.tag == A_T:
+                    parts.append(elem.text or '')
+                elif elem.tag == A_BR:
+                    parts.append('\n')
+                elif elem.tag == A_P:
+                    out.write(''.join(parts) + '\n')
+                    parts = []
+                    elem.clear()
+
+
+#: Mapping: filename extension <-> extractor function.
+EXTRACTORS = {
+    '.odt': extract_odf,
+    '.ods': extract_odf,
+    '.odp': extract_odf,
+    '.docx': extract_docx,
+    '.xlsx': extract_xlsx,
+    '.pptx': extract_pptx,
+    }
+
+
+def extract_text(path, out_path):
+    """Extract text from document in `path` and store it in `out_path`.
+
+    The text is stored UTF-8 encoded.
+
+    Raises :exc:`TextExtractionError` if the type of document is not
+    supported (by filename extension) or the document cannot be
+    handled. `out_path` does not exist then.
+
+    Broken documents can fail in many ways (bad ZIP files, encrypted
+    or unsupported members, invalid XML, references to missing parts
+    or strings), so any exception while extracting is turned into a
+    :exc:`TextExtractionError`. Callers can then fall back to
+    LibreOffice.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in EXTRACTORS:
+        raise TextExtractionError('unsupported document type: %s' % ext)
+    try:
+        with zipfile.ZipFile(path) as zf:
+            with codecs.open(out_path, 'w', encoding='utf-8') as out:
+                EXTRACTORS[ext](zf, out)
+    except Exception as err:
+        if os.path.exists(out_path):
+            os.unlink(out_path)
+        if isinstance(err, TextExtractionError):
+            raise
+        raise TextExtractionError('cannot extract text: %s' % err)
@@ -19,20 +19,73 @@
 """
 RESTful WSGI app
 """
+import json
 import os
 import mimetypes
+import re
+import shutil
 import tempfile
+from hashlib import md5
 from routes import Mapper
+from six.moves.urllib.parse import quote
 from routes.util import URLGenerator
 from webob import Response, exc
 from webob.dec import wsgify
-from ulif.openoffice.cachemanager import CacheManager
+from ulif.openoffice.admission import (
+    AdmissionControl, Overloaded, DEFAULT_URGENCY, get_urgency)
+from ulif.openoffice.cachemanager import CacheManager, get_marker
 from ulif.openoffice.client import convert_doc
-from ulif.openoffice.helpers import basestring
+from ulif.openoffice.endpoints import set_endpoints
+from ulif.openoffice.helpers import (
+    basestring, css_cache, iter_zip, string_to_bool)
+from ulif.openoffice.jobs import JobManager, DONE, QUEUED
+from ulif.openoffice.options import Options
+from ulif.openoffice.probe import probe
+from ulif.openoffice.processor import set_postproc_pool
 
 
 mydocs = {}
 
+#: Cache-Control header value for content addressed documents.
+CACHE_CONTROL_IMMUTABLE = 'public, max-age=31536000, immutable'
+
+#: Headers supported to let front proxies deliver cached files.
+SENDFILE_HEADERS = (None, '', 'X-Accel-Redirect', 'X-Sendfile')
+
+#: Urgency parameter of HTTP ``Priority`` headers (RFC 9218).
+RE_URGENCY = re.compile(r'(?:^|[\s,;])u\s*=\s*(\d+)')
+
+#: Suffix of cache markers of unzipped results. See
+#: :func:`get_unzipped_marker`.
+UNZIPPED_SUFFIX = '_unzipped'
+
+
+def get_unzipped_marker(options):
+    """Get the cache marker of unzipped results for `options`.
+
+    With `stream_zip` enabled, results are cached unzipped, as
+    directory. They are stored under a marker of their own, so that
+    clients looking for the (zipped) result of `options` never get a
+    directory.
+    """
+    return get_marker(options) + UNZIPPED_SUFFIX
+
+
+def get_request_urgency(req):
+    """Get the urgency of conversions requested by `req`.
+
+    Urgencies range from ``0`` (most urgent) to ``7``. They are taken
+    from a ``priority`` parameter or the ``u`` parameter of a
+    ``Priority`` header (in that order). Default is
+    :data:`ulif.openoffice.admission.DEFAULT_URGENCY`.
+    """
+    if 'priority' in req.params:
+        return get_urgency(req.params['priority'])
+    match = RE_URGENCY.search(req.headers.get('Priority', ''))
+    if match is None:
+        return DEFAULT_URGENCY
+    return get_urgency(match.group(1))
+
 
 def get_mimetype(filename):
     if not isinstance(filename, basestring):
@@ -75,7 +128,7 @@ class FileIterator(object):
     Cf. http://docs.webob.org/en/latest/file-example.html
     """
     #: Size of chunks read when processing files.
-    chunk_size = 4096
+    chunk_size = 256 * 1024
 
     def __init__(self, filename, start=0, stop=None):
         self.filename = filename
@@ -92,29 +145,132 @@ class FileIterator(object):
 
     def next(self):
         if self.length is not None and self.length <= 0:
+            self.fileobj.close()
             raise StopIteration
-        chunk = self.fileobj.read(self.chunk_size)
+        size = self.chunk_size
+        if self.length is not None:
+            size = min(size, self.length)
+        chunk = self.fileobj.read(size)
         if not chunk:
+            self.fileobj.close()
             raise StopIteration
         if self.length is not None:
             self.length -= len(chunk)
-            if self.length < 0:
-                # Chop off the extra:
-                chunk = chunk[:self.length]
         return chunk
 
     __next__ = next  # py3 compat
 
 
-def make_response(filename):
-    res = Response(content_type=get_mimetype(filename))
-    res.app_iter = FileIterable(filename)
+class ZipIterable(object):
+    """A webob compatible iterable delivering a directory as ZIP file.
+
+    The ZIP file is created on the fly while iterating. See
+    :func:`ulif.openoffice.helpers.iter_zip`.
+
+    If `remove` is set, it must be a path that will be removed when
+    the iterable is closed, i.e. after the response was sent.
+
+    `level` and `store_compressed` are passed to
+    :func:`ulif.openoffice.helpers.iter_zip`.
+    """
+    def __init__(self, path, remove=None, level=None, store_compressed=True):
+        self.path = path
+        self.remove = remove
+        self.level = level
+        self.store_compressed = store_compressed
+
+    def __iter__(self):
+        return iter_zip(
+            self.path, level=self.level,
+            store_compressed=self.store_compressed)
+
+    def close(self):
+        if self.remove is not None:
+            shutil.rmtree(self.remove, ignore_errors=True)
+
+
+def get_etag(path, cache_key=None):
+    """Get a strong entity tag for the file or directory in `path`.
+
+    The tag is computed from `cache_key` and the size of `path` (the
+    sizes of all files in it for directories). Cached documents
+    therefore get the same tag on all nodes sharing a cache and after
+    restoring a cache from backups. Without `cache_key`, the absolute
+    `path`, size and modification time of `path` are used. Other than
+    Python's :func:`hash` it is the same in all processes.
+    """
+    if cache_key:
+        if os.path.isdir(path):
+            size = sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, dirs, files in os.walk(path) for name in files)
+        else:
+            size = os.path.getsize(path)
+        ident = '%s-%s' % (cache_key, size)
+    else:
+        stat = os.stat(path)
+        ident = '%s-%s-%r' % (
+            os.path.abspath(path), stat.st_size, stat.st_mtime)
+    return md5(ident.encode('utf-8')).hexdigest()
+
+
+def make_sendfile_response(filename, header, value, cache_key=None):
+    """Create a response telling a front proxy to deliver `filename`.
+
+    The body is empty. Instead the `header` (``X-Accel-Redirect`` or
+    ``X-Sendfile``) is set to `value`. Ranges are then handled by the
+    proxy, conditional requests still by us.
+    """
+    res = Response(
+        content_type=get_mimetype(filename), conditional_response=True)
+    res.headers[header] = value
+    res.content_length = None
+    res.last_modified = os.path.getmtime(filename)
+    res.etag = get_etag(filename, cache_key)
+    return res
+
+
+def make_zip_response(path, remove=None, cache_key=None, level=None,
+                      store_compressed=True):
+    """Create a response delivering the directory in `path` as ZIP file.
+
+    See :class:`ZipIterable` for `remove`, `level` and
+    `store_compressed` and :func:`get_etag` for `cache_key`.
+    """
+    res = Response(content_type='application/zip', conditional_response=True)
+    res.app_iter = ZipIterable(
+        path, remove=remove, level=level, store_compressed=store_compressed)
+    res.last_modified = os.path.getmtime(path)
+    if cache_key:
+        # other zip settings give other archives
+        cache_key = '%s-%s-%s' % (cache_key, level, store_compressed)
+    res.etag = get_etag(path, cache_key)
+    return res
+
+
+def make_response(filename, cache_key=None, environ=None):
+    """Create a response delivering the file in `filename`.
+
+    Conditional requests (``If-None-Match``, ``If-Modified-Since``)
+    are answered with ``304 Not Modified`` where appropriate. See
+    :func:`get_etag` for `cache_key`.
+
+    If the WSGI `environ` of the current request provides a
+    ``wsgi.file_wrapper``, it is used to deliver the file, unless a
+    range was requested. Servers can then use `sendfile()` and
+    similar.
+    """
+    res = Response(
+        content_type=get_mimetype(filename), conditional_response=True)
+    file_wrapper = (environ or {}).get('wsgi.file_wrapper')
+    if file_wrapper is not None and 'HTTP_RANGE' not in environ:
+        res.app_iter = file_wrapper(
+            open(filename, 'rb'), FileIterator.chunk_size)
+    else:
+        res.app_iter = FileIterable(filename)
     res.content_length = os.path.getsize(filename)
     res.last_modified = os.path.getmtime(filename)
-    res.etag = '%s-%s-%s' % (
-        os.path.getmtime(filename),
-        os.path.getsize(filename),
-        hash(filename))
+    res.etag = get_etag(filename, cache_key)
     return res
 
 
@@ -128,23 +284,136 @@ class RESTfulDocConverter(object):
 
     - `cache_dir`:
         Path to a directory, where cached files can be stored. The
-        directory is created if it does not exist.
+        directory is created if it does not exist. Cleaned up CSS is
+        stored in a subdirectory ``.css`` of it.
+
+    - `postproc_workers`:
+        Number of worker processes to run CPU-bound processors (HTML
+        and CSS cleanup) in. By default (``0``) these processors run
+        in the request thread.
+
+    - `postproc_max_tasks`:
+        Number of tasks after which a post-processing worker process
+        is replaced by a fresh one. Unlimited by default.
+
+    - `stream_zip`:
+        If true and the requested processors end with ``zip``, the
+        ZIP file is not created by the ``zip`` processor but on the
+        fly while sending the response. Results are then cached
+        unzipped. ``False`` by default.
+
+    - `sendfile_header`:
+        If set to ``X-Accel-Redirect`` (nginx) or ``X-Sendfile``
+        (Apache `mod_xsendfile`, lighttpd), cached files are not
+        sent by us. Instead we send this header and the front proxy
+        delivers the file. Not set by default.
+
+    - `sendfile_prefix`:
+        Used with ``X-Accel-Redirect`` only. The URL path of the
+        internal nginx location serving `cache_dir`, for instance
+        ``/cached/``.
+
+    - `async_workers`:
+        Number of worker threads running conversions requested
+        asynchronously (with a ``Prefer: respond-async`` header).
+        Requires `cache_dir`. ``0`` (the default) disables
+        asynchronous conversions. Their conversions count for
+        `max_conversions` as well, with lowest urgency.
+
+    - `spool_dir`:
+        Path to a spool directory served by ``oooworker``
+        processes. If set, we do not convert anything ourselves but
+        queue all conversions there. Asynchronous conversions are
+        then enabled if a `cache_dir` is set.
+
+    - `spool_timeout`:
+        Seconds to wait for a worker to convert a doc synchronously
+        when using a `spool_dir`. ``600`` by default.
+
+    - `max_conversions`:
+        Number of conversions run at the same time. Further requests
+        wait. ``0`` (the default) means no limit.
+
+    - `max_queue`:
+        Number of requests waiting for a conversion (and of queued
+        asynchronous jobs). Further requests get ``503 Service
+        Unavailable`` with a ``Retry-After`` header. Not limited by
+        default.
+
+    - `max_queue_wait`:
+        Seconds a request may wait for a conversion before it gets
+        ``503 Service Unavailable``. Not limited by default.
+
+    - `large_cost`:
+        Conversions expected to cost this much or more are large. See
+        :func:`ulif.openoffice.probe.estimate_cost`. Not set by
+        default.
+
+    - `reserved_conversions`:
+        Number of the `max_conversions` slots not used by large
+        conversions. ``0`` by default.
+
+    - `office_endpoints`:
+        Office servers to distribute conversions over, as list of
+        ``host:port`` entries. See
+        :mod:`ulif.openoffice.endpoints`. By default the ``oocp``
+        options are used.
 
     """
     # cf: https://routes.readthedocs.io/en/latest/restful.html
     #     http://www.ianbicking.org/blog/2010/03/12/a-webob-app-example/
     map = Mapper()
-    map.resource('doc', 'docs')
+    map.resource('doc', 'docs', collection={'probe': 'POST'})
+    map.connect('/docs', action='index', conditions=dict(method=['HEAD']))
+    map.connect('/docs/{id}', action='show', conditions=dict(method=['HEAD']))
+    map.connect('job', '/jobs/{id}', action='show_job',
+                conditions=dict(method=['GET', 'HEAD']))
+    map.connect('/jobs/{id}', action='delete_job',
+                conditions=dict(method=['DELETE']))
 
     #: A cache manager instance.
     cache_manager = None
     template_dir = os.path.join(os.path.dirname(__file__), 'templates')
 
-    def __init__(self, cache_dir=None):
+    def __init__(self, cache_dir=None, postproc_workers=0,
+                 postproc_max_tasks=None, stream_zip=False,
+                 sendfile_header=None, sendfile_prefix='/',
+                 async_workers=0, spool_dir=None, spool_timeout=600,
+                 max_conversions=0, max_queue=None, max_queue_wait=None,
+                 large_cost=None, reserved_conversions=0,
+                 office_endpoints=None):
         self.cache_dir = cache_dir
+        self.stream_zip = string_to_bool(stream_zip) or False
+        if sendfile_header not in SENDFILE_HEADERS:
+            raise ValueError(
+                'sendfile_header must be one of: %s' % ', '.join(
+                    [x for x in SENDFILE_HEADERS if x]))
+        self.sendfile_header = sendfile_header or None
+        self.sendfile_prefix = sendfile_prefix
         self.cache_manager = None
         if self.cache_dir is not None:
             self.cache_manager = CacheManager(self.cache_dir)
+            css_cache.set_path(os.path.join(self.cache_dir, '.css'))
+        if int(postproc_workers or 0):
+            set_postproc_pool(
+                int(postproc_workers),
+                postproc_max_tasks and int(postproc_max_tasks) or None,
+                replace=False)
+        self.admission = AdmissionControl(
+            max_conversions, max_queue, max_queue_wait,
+            reserved=reserved_conversions, large_cost=large_cost)
+        if office_endpoints:
+            set_endpoints(office_endpoints)
+        self.job_manager = None
+        self.spool_dir = spool_dir
+        self.spool_timeout = float(spool_timeout)
+        if self.spool_dir:
+            self.job_manager = JobManager(
+                self.cache_dir, workers=0, spool_dir=self.spool_dir)
+        elif int(async_workers or 0):
+            self.job_manager = JobManager(
+                self.cache_dir, workers=int(async_workers),
+                admission=self.admission)
 
     def _url(self, req, *args, **kw):
         """Generate an URL pointing to some REST service.
@@ -167,20 +436,90 @@ class RESTfulDocConverter(object):
         match, route = results
         return getattr(self, match['action'])(req)
 
-    def index(self, req):
-        # get index of all docs
-        return Response(str(list(mydocs.keys())))
-
-    def create(self, req):
-        # post a new doc
+    def _get_options(self, req):
+        # get conversion options from request params
         options = dict([(name, val) for name, val in list(req.params.items())
-                        if name not in ('CREATE', 'doc', 'docid')])
+                        if name not in (
+                            'CREATE', 'doc', 'docid', 'source_digest',
+                            'priority')])
         if 'out_fmt' in list(req.params.keys()):
             options['oocp-out-fmt'] = options['out_fmt']
             del options['out_fmt']
         if 'CREATE' in list(req.params.keys()):
             if options.get('oocp-out-fmt', 'html') == 'pdf':
                 options['meta-procord'] = 'unzip,oocp,zip'
+        return options
+
+    def _convert(self, src_path, options, cache_dir, urgency):
+        # convert here or let some worker do it
+        cost = None
+        if self.admission.max_active:
+            # cheap and urgent conversions are admitted first
+            cost = probe(src_path, self.cache_dir)['cost']
+        with self.admission.admit(cost, urgency):
+            if self.spool_dir:
+                return self.job_manager.convert(
+                    src_path, options, cache_dir,
+                    timeout=self.spool_timeout, urgency=urgency)
+            return convert_doc(src_path, options, cache_dir)
+
+    def _make_cached_response(self, req, result_path, cache_key,
+                              **zip_args):
+        # deliver a doc from cache. Unzipped results are zipped on the
+        # fly, see `make_zip_response` for `zip_args`.
+        if os.path.isdir(result_path):
+            return make_zip_response(
+                result_path, cache_key=cache_key, **zip_args)
+        if self.sendfile_header == 'X-Sendfile':
+            return make_sendfile_response(
+                result_path, self.sendfile_header,
+                os.path.abspath(result_path), cache_key=cache_key)
+        elif self.sendfile_header == 'X-Accel-Redirect':
+            rel_path = os.path.relpath(
+                result_path, self.cache_manager.cache_dir)
+            return make_sendfile_response(
+                result_path, self.sendfile_header,
+                self.sendfile_prefix.rstrip('/') + '/' + quote(
+                    rel_path.replace(os.sep, '/')),
+                cache_key=cache_key)
+        return make_response(
+            result_path, cache_key=cache_key, environ=req.environ)
+
+    def index(self, req):
+        if 'source_digest' in req.params:
+            return self._lookup_by_digest(req)
+        # get index of all docs
+        return Response(str(list(mydocs.keys())))
+
+    def _lookup_by_digest(self, req):
+        # get a cached doc by source digest and options, without upload
+        if self.cache_manager is None:
+            return exc.HTTPNotFound()
+        options = self._get_options(req)
+        for marker in (get_marker(options), get_unzipped_marker(options)):
+            result_path, id_tag = (
+                self.cache_manager.get_cached_file_by_digest(
+                    req.params['source_digest'], marker))
+            if result_path is not None:
+                break
+        else:
+            return exc.HTTPNotFound()
+        resp = self._make_cached_response(
+            req, result_path, id_tag, **self._get_zip_args(options))
+        resp.location = self._url(req, 'doc', id=id_tag, qualified=True)
+        return resp
+
+    def create(self, req):
+        # post a new doc
+        try:
+            return self._create(req)
+        except Overloaded as err:
+            return exc.HTTPServiceUnavailable(
+                str(err), headers={'Retry-After': str(err.retry_after)})
+
+    def _create(self, req):
+        options = self._get_options(req)
+        urgency = get_request_urgency(req)
         doc = req.POST['doc']
         # write doc to filesystem
         tmp_dir = tempfile.mkdtemp()
@@ -188,17 +527,143 @@ class RESTfulDocConverter(object):
         with open(src_path, 'wb') as f:
             for chunk in iter(lambda: doc.file.read(8 * 1024), b''):
                 f.write(chunk)
-        # do the conversion
-        result_path, id_tag, metadata = convert_doc(
-            src_path, options, self.cache_dir)
+        if self.job_manager is not None and self.cache_dir is not None and (
+                'respond-async' in req.headers.get('Prefer', '')):
+            return self._create_job(req, src_path, options, urgency)
+        procord = Options(string_dict=options)['meta_processor_order']
+        try:
+            if self.stream_zip and procord and procord[-1] == 'zip':
+                return self._create_streamed(
+                    req, src_path, options, procord, urgency)
+            # do the conversion
+            result_path, id_tag, metadata = self._convert(
+                src_path, options, self.cache_dir, urgency)
+        except Overloaded:
+            shutil.rmtree(tmp_dir)
+            raise
         # deliver the created file
-        resp = make_response(result_path)
+        resp = make_response(
+            result_path, cache_key=id_tag, environ=req.environ)
         if id_tag is not None:
             # we can only signal new resources if cache is enabled
             resp.status = '201 Created'
             resp.location = self._url(req, 'doc', id=id_tag, qualified=True)
         return resp
 
+    def _create_job(self, req, src_path, options, urgency):
+        # queue a conversion and tell where to ask for progress
+        try:
+            self.admission.check_queue(self.job_manager.queue.count(QUEUED))
+        except Overloaded:
+            shutil.rmtree(os.path.dirname(src_path))
+            raise
+        job = self.job_manager.submit(src_path, options, urgency=urgency)
+        resp = self._make_job_response(req, job)
+        resp.status = '202 Accepted'
+        resp.headers['Preference-Applied'] = 'respond-async'
+        resp.location = self._url(req, 'job', id=job.id, qualified=True)
+        return resp
+
+    def _make_job_response(self, req, job):
+        data = job.as_dict()
+        if job.cache_key is not None:
+            data['location'] = self._url(
+                req, 'doc', id=job.cache_key, qualified=True)
+        return Response(
+            json.dumps(data), content_type='application/json',
+            charset='utf-8')
+
+    def show_job(self, req):
+        # get state of a job. Redirect to result if done.
+        job = None
+        if self.job_manager is not None:
+            job = self.job_manager.get(req.path.split('/')[-1])
+        if job is None:
+            return exc.HTTPNotFound()
+        resp = self._make_job_response(req, job)
+        if job.state == DONE:
+            resp.status = '303 See Other'
+            resp.location = self._url(
+                req, 'doc', id=job.cache_key, qualified=True)
+        return resp
+
+    def delete_job(self, req):
+        # cancel a job
+        if self.job_manager is None or not self.job_manager.cancel(
+                req.path.split('/')[-1]):
+            return exc.HTTPNotFound()
+        return Response(status='204 No Content')
+
+    def _create_streamed(self, req, src_path, options, procord, urgency):
+        # convert without zipping and send results as ZIP created on
+        # the fly. The unzipped results are cached.
+        zip_args = self._get_zip_args(options)
+        resp = None
+        if self.cache_manager is not None:
+            resp = self._get_streamed_cached(req, src_path, options, zip_args)
+        if resp is not None:
+            shutil.rmtree(os.path.dirname(src_path))
+            return resp
+        conv_options = dict(options)
+        conv_options['meta-procord'] = ','.join(procord[:-1])
+        result_path, id_tag, metadata = self._convert(
+            src_path, conv_options, None, urgency)
+        if result_path is None:
+            return exc.HTTPUnprocessableEntity(metadata.get('error-descr'))
+        tmp_dir = tempfile.mkdtemp()
+        bundle = os.path.join(
+            tmp_dir, os.path.splitext(os.path.basename(result_path))[0])
+        os.rename(os.path.dirname(result_path), bundle)
+        if self.cache_manager is None:
+            return make_zip_response(bundle, remove=tmp_dir, **zip_args)
+        id_tag = self.cache_manager.register_doc(
+            src_path, bundle, repr_key=get_unzipped_marker(options))
+        shutil.rmtree(tmp_dir)
+        resp = make_zip_response(
+            self.cache_manager.get_cached_file(id_tag), cache_key=id_tag,
+            **zip_args)
+        resp.status = '201 Created'
+        resp.location = self._url(req, 'doc', id=id_tag, qualified=True)
+        return resp
+
+    def _get_zip_args(self, options):
+        # settings of the zip processor for ZIP files created on the fly
+        zip_options = Options(string_dict=options)
+        return dict(
+            level=zip_options['zip_compression_level'],
+            store_compressed=zip_options['zip_store_compressed'])
+
+    def _get_streamed_cached(self, req, src_path, options, zip_args):
+        # deliver a cached result for a streamed request, if any. ZIP
+        # files cached by non-streamed requests do as well.
+        for marker in (get_marker(options), get_unzipped_marker(options)):
+            result_path, id_tag = self.cache_manager.get_cached_file_by_source(
+                src_path, marker)
+            if result_path is not None:
+                break
+        else:
+            return None
+        resp = self._make_cached_response(req, result_path, id_tag, **zip_args)
+        resp.status = '201 Created'
+        resp.location = self._url(req, 'doc', id=id_tag, qualified=True)
+        return resp
+
+    def probe(self, req):
+        # get metadata of a doc without converting it
+        doc = req.POST['doc']
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            src_path = os.path.join(tmp_dir, os.path.basename(doc.filename))
+            with open(src_path, 'wb') as f:
+                for chunk in iter(lambda: doc.file.read(8 * 1024), b''):
+                    f.write(chunk)
+            result = probe(src_path, self.cache_dir)
+        finally:
+            shutil.rmtree(tmp_dir)
+        return Response(
+            json.dumps(result), content_type='application/json',
+            charset='utf-8')
+
     def new(self, req):
         # get a form to create a new doc
         template = open(
@@ -224,7 +689,10 @@ class RESTfulDocConverter(object):
         result_path = self.cache_manager.get_cached_file(doc_id)
         if result_path is None:
             return exc.HTTPNotFound()
-        return make_response(result_path)
+        resp = self._make_cached_response(req, result_path, doc_id)
+        # cache keys are content addressed: the doc won't change
+        resp.cache_control = CACHE_CONTROL_IMMUTABLE
+        return resp
 
 
 docconverter_app = RESTfulDocConverter
@@ -22,13 +22,27 @@ Components to convert documents via XML-RPC.
 .. versionadded:: 1.1
 
 """
+import os
 from webob import Response, exc
 from webob.dec import wsgify
+from ulif.openoffice.admission import (
+    AdmissionControl, Overloaded, DEFAULT_URGENCY)
 from ulif.openoffice.client import Client, convert_doc
+from ulif.openoffice.endpoints import set_endpoints
+from ulif.openoffice.helpers import css_cache
+from ulif.openoffice.jobs import JobManager
+from ulif.openoffice.probe import probe
+from ulif.openoffice.processor import set_postproc_pool
 try:
     from SimpleXMLRPCServer import SimpleXMLRPCDispatcher  # Python 2.x
+    from xmlrpclib import Fault
 except ImportError:                                        # pragma: no cover
     from xmlrpc.server import SimpleXMLRPCDispatcher       # Python 3.x
+    from xmlrpc.client import Fault
+
+
+#: Fault code sent if too many conversions are requested.
+FAULT_OVERLOADED = 503
 
 
 class WSGIXMLRPCApplication(object):
@@ -38,9 +52,32 @@ class WSGIXMLRPCApplication(object):
     `SimpleXMLRPCServer` but processes WSGI requests instead and does
     not fiddle around with raw HTTP.
 
-    The passed in `cache_dir` is used only if set.
+    The passed in `cache_dir` is used only if set. Cleaned up CSS is
+    stored in a subdirectory ``.css`` of it.
+
+    `postproc_workers` and `postproc_max_tasks` configure a process
+    pool for CPU-bound processors. See
+    :func:`ulif.openoffice.processor.set_postproc_pool`.
+
+    If `spool_dir` is set, conversions are not done locally but queued
+    in this spool directory for ``oooworker`` processes. We wait at
+    most `spool_timeout` seconds for the result.
+
+    `max_conversions`, `max_queue`, `max_queue_wait`, `large_cost`
+    and `reserved_conversions` limit the number of conversions done
+    at the same time, see
+    :class:`ulif.openoffice.admission.AdmissionControl`. Requests
+    exceeding these limits get a fault with code
+    :data:`FAULT_OVERLOADED`.
+
+    `office_endpoints` is a list of office servers to distribute
+    conversions over, see :mod:`ulif.openoffice.endpoints`.
     """
-    def __init__(self, cache_dir=None):
+    def __init__(self, cache_dir=None, postproc_workers=0,
+                 postproc_max_tasks=None, spool_dir=None,
+                 spool_timeout=600, max_conversions=0, max_queue=None,
+                 max_queue_wait=None, large_cost=None,
+                 reserved_conversions=0, office_endpoints=None):
         # set up a dispatcher
         self.dispatcher = SimpleXMLRPCDispatcher(
             allow_none=True, encoding=None)
@@ -48,8 +85,27 @@ class WSGIXMLRPCApplication(object):
             self.convert_locally, 'convert_locally')
         self.dispatcher.register_function(
             self.get_cached, 'get_cached')
+        self.dispatcher.register_function(
+            self.probe_locally, 'probe_locally')
         self.dispatcher.register_introspection_functions()
         self.cache_dir = cache_dir
+        if self.cache_dir is not None:
+            css_cache.set_path(os.path.join(self.cache_dir, '.css'))
+        if int(postproc_workers or 0):
+            set_postproc_pool(
+                int(postproc_workers),
+                postproc_max_tasks and int(postproc_max_tasks) or None,
+                replace=False)
+        self.admission = AdmissionControl(
+            max_conversions, max_queue, max_queue_wait,
+            reserved=reserved_conversions, large_cost=large_cost)
+        if office_endpoints:
+            set_endpoints(office_endpoints)
+        self.job_manager = None
+        self.spool_timeout = float(spool_timeout)
+        if spool_dir:
+            self.job_manager = JobManager(
+                cache_dir, workers=0, spool_dir=spool_dir)
 
     def convert_locally(self, src_path, options):
         """Convert document in `path`.
@@ -57,16 +113,37 @@ class WSGIXMLRPCApplication(object):
         Expects a local path to the document to convert.
 
         The `options` are a dictionary of options as accepted by all
-        converter components in this package.
+        converter components in this package. An additional
+        ``priority`` option sets the urgency of the conversion (``0``
+        is most urgent, ``7`` least, ``3`` is default).
 
-        The cache (if set) will be updated.
+        The cache (if set) will be updated. With a spool dir set, the
+        conversion is done by some worker serving the spool.
 
         Returns path of converted document, a cache key and a
         dictionary of metadata. The cache key is ``None`` if no cache
         was used.
+
+        If too many conversions are requested, a fault with code
+        :data:`FAULT_OVERLOADED` is returned. Its message tells after
+        how many seconds to retry.
         """
-        result_path, cache_key, metadata = convert_doc(
-            src_path, options, self.cache_dir)
+        options = dict(options)
+        urgency = options.pop('priority', DEFAULT_URGENCY)
+        cost = None
+        if self.admission.max_active:
+            cost = probe(src_path, self.cache_dir)['cost']
+        try:
+            with self.admission.admit(cost, urgency):
+                if self.job_manager is not None:
+                    return self.job_manager.convert(
+                        src_path, options, self.cache_dir,
+                        timeout=self.spool_timeout, urgency=urgency)
+                result_path, cache_key, metadata = convert_doc(
+                    src_path, options, self.cache_dir)
+        except Overloaded as err:
+            raise Fault(FAULT_OVERLOADED, '%s, retry after %s seconds' % (
+                err, err.retry_after))
         return result_path, cache_key, metadata
 
     def get_cached(self, cache_key):
@@ -78,6 +155,17 @@ class WSGIXMLRPCApplication(object):
         client = Client(cache_dir=self.cache_dir)
         return client.get_cached(cache_key)
 
+    def probe_locally(self, src_path):
+        """Get metadata of document in `src_path`.
+
+        Expects a local path to the document. It is not converted.
+
+        Returns a dictionary as described in
+        :func:`ulif.openoffice.probe.probe_document`. Results are
+        cached if a cache is set.
+        """
+        return probe(src_path, self.cache_dir)
+
     @wsgify
     def __call__(self, req):
         """Handles the HTTP POST request.
@@ -25,6 +25,20 @@ def tmpdir_sess(request):
     return sess_dir
 
 
+@pytest.fixture(scope='function')
+def pipe_tmpdir(request):
+    """return a temporary py.path.local object with a short path
+    (scope: function).
+
+    Unix domain sockets (office pipes) can be bound there. Their paths
+    are limited to about 100 chars, which `tmpdir` paths can exceed
+    (with `pytest-xdist`, for instance).
+    """
+    pipe_dir = py.path.local(tempfile.mkdtemp(dir='/tmp'))
+    request.addfinalizer(lambda: pipe_dir.remove(rec=1, ignore_errors=True))
+    return pipe_dir
+
+
 @pytest.fixture(scope='session')
 def monkeypatch_sess(request):
     """Like `monkeypatch` fixture, but for sessions.
@@ -0,0 +1,244 @@
+# tests for admission module
+import pytest
+import threading
+import time
+from ulif.openoffice.admission import (
+    AdmissionControl, Overloaded, DEFAULT_SERVICE_TIME, AGING_RATE,
+    get_urgency, schedule_key)
+
+
+def admit_in_thread(control, release):
+    # enter `control` in a thread, stay there until `release` is set.
+    entered = threading.Event()
+    result = []
+
+    def run():
+        try:
+            with control.admit():
+                entered.set()
+                release.wait(5)
+            result.append('done')
+        except Overloaded as err:
+            result.append(err)
+            entered.set()
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, entered, result
+
+
+def queue_waiters(control, requests):
+    # queue admission `requests` (name, cost, urgency) one by one.
+    # Returns threads and a list of names in order of admission.
+    order = []
+    threads = []
+
+    def run(name, cost, urgency):
+        with control.admit(cost, urgency):
+            order.append(name)
+    for num, (name, cost, urgency) in enumerate(requests):
+        thread = threading.Thread(target=run, args=(name, cost, urgency))
+        thread.start()
+        threads.append(thread)
+        for x in range(500):
+            if control.waiting > num:
+                break
+            time.sleep(0.01)
+    return threads, order
+
+
+class TestHelpers(object):
+
+    def test_get_urgency(self):
+        # we get urgencies from any values
+        assert get_urgency('1') == 1
+        assert get_urgency(9) == 7
+        assert get_urgency(-1) == 0
+        assert get_urgency('foo') == 3
+        assert get_urgency(None, default=5) == 5
+
+    def test_schedule_key(self):
+        # cheap and urgent jobs get lower keys
+        assert schedule_key(1.0, 3, 0) < schedule_key(2.0, 3, 0)
+        assert schedule_key(2.0, 2, 0) == schedule_key(1.0, 3, 0)
+        assert schedule_key(None, 3, 0) == 1.0
+        # waiting jobs age
+        assert schedule_key(10.0, 3, 10 / AGING_RATE) == 0.0
+
+
+class TestAdmissionControl(object):
+
+    def test_unlimited(self):
+        # by default everything is admitted
+        control = AdmissionControl()
+        with control.admit():
+            with control.admit():
+                assert control.active == 0
+
+    def test_paste_values(self):
+        # we accept strings as given by paste configs
+        control = AdmissionControl('2', '', '1.5')
+        assert control.max_active == 2
+        assert control.max_queue is None
+        assert control.max_wait == 1.5
+
+    def test_queue_full(self):
+        # requests exceeding the queue are rejected
+        control = AdmissionControl(max_active=1, max_queue=0)
+        with control.admit():
+            with pytest.raises(Overloaded) as exc_info:
+                with control.admit():
+                    pass
+        assert exc_info.value.retry_after == DEFAULT_SERVICE_TIME
+        assert str(exc_info.value) == 'queue full'
+        # free slots are taken again
+        with control.admit():
+            assert control.active == 1
+
+    def test_wait(self):
+        # requests wait for free slots
+        control = AdmissionControl(max_active=1, max_queue=1)
+        release = threading.Event()
+        thread, entered, result = admit_in_thread(control, release)
+        assert entered.wait(5)
+        thread2, entered2, result2 = admit_in_thread(control, release)
+        for x in range(500):
+            if control.waiting:
+                break
+            time.sleep(0.01)
+        assert control.waiting == 1
+        with pytest.raises(Overloaded):
+            with control.admit():
+                pass
+        release.set()
+        thread.join()
+        thread2.join()
+        assert result == result2 == ['done']
+        assert control.active == control.waiting == 0
+
+    def test_max_wait(self):
+        # requests wait not longer than `max_wait`
+        control = AdmissionControl(max_active=1, max_wait=0.05)
+        with control.admit():
+            start = time.time()
+            with pytest.raises(Overloaded) as exc_info:
+                with control.admit():
+                    pass
+        assert time.time() - start >= 0.05
+        assert str(exc_info.value) == 'queue wait too long'
+        assert control.waiting == 0
+
+    def test_expected_wait_too_long(self):
+        # requests that would wait too long are rejected early
+        control = AdmissionControl(max_active=1, max_wait=10)
+        control.service_time = 20.0
+        with control.admit():
+            start = time.time()
+            with pytest.raises(Overloaded) as exc_info:
+                with control.admit():
+                    pass
+        assert time.time() - start < 1
+        assert exc_info.value.retry_after == 20
+
+    def test_service_time(self):
+        # we measure how long conversions take
+        control = AdmissionControl(max_active=2)
+        assert control.service_time is None
+        with control.admit():
+            time.sleep(0.01)
+        assert 0.01 <= control.service_time < 1
+        control.service_time = 10.0
+        with control.admit():
+            pass
+        assert control.service_time < 8.1
+
+    def test_retry_after(self):
+        # retry times depend on queue length and service rate
+        control = AdmissionControl(max_active=2)
+        control.service_time = 3.0
+        assert control.retry_after() == 2
+        assert control.retry_after(3) == 6
+        control.service_time = 0.01
+        assert control.retry_after() == 1
+
+    def test_check_queue(self):
+        # we can check lengths of other queues
+        control = AdmissionControl(max_active=1, max_queue=2)
+        control.check_queue(1)
+        with pytest.raises(Overloaded) as exc_info:
+            control.check_queue(2)
+        assert exc_info.value.retry_after == 3 * DEFAULT_SERVICE_TIME
+        AdmissionControl().check_queue(1000)
+
+    def test_schedule(self):
+        # waiting requests are admitted by cost and urgency
+        control = AdmissionControl(max_active=1)
+        with control.admit():
+            threads, order = queue_waiters(control, [
+                ('big', 50.0, 3), ('small', 1.2, 3), ('urgent', 8.0, 0),
+                ('medium', 5.0, 3), ('batch', 1.2, 7)])
+        for thread in threads:
+            thread.join()
+        assert order == ['urgent', 'small', 'medium', 'batch', 'big']
+
+    def test_aging(self):
+        # requests waiting long enough are preferred
+        control = AdmissionControl(max_active=1)
+        with control.admit():
+            threads, order = queue_waiters(control, [
+                ('big', 50.0, 3), ('small', 1.2, 3)])
+            control._waiters[0].since -= 50.0 / AGING_RATE
+        for thread in threads:
+            thread.join()
+        assert order == ['big', 'small']
+
+    def test_reserved(self):
+        # large conversions do not use reserved slots
+        control = AdmissionControl(max_active=2, reserved=1, large_cost=10)
+        assert control.is_large(10.0)
+        assert not control.is_large(None)
+        with control.admit(20.0):
+            threads, order = queue_waiters(control, [('large', 30.0, 0)])
+            with control.admit(1.0):
+                assert control.active == 2
+            assert control.waiting == 1
+        for thread in threads:
+            thread.join()
+        assert order == ['large']
+        assert control.active == control.active_large == 0
+
+    def test_background(self):
+        # background work waits without limits, not counted for others
+        control = AdmissionControl(max_active=1, max_queue=1, max_wait=0.05)
+        order = []
+
+        def run():
+            with control.admit(1.0, 7, limited=False):
+                order.append('background')
+        with control.admit():
+            thread = threading.Thread(target=run)
+            thread.start()
+            for x in range(500):
+                if control.waiting:
+                    break
+                time.sleep(0.01)
+            time.sleep(0.1)         # longer than `max_wait`
+            assert control.waiting == 1
+            assert control.queued == 0
+            control.max_wait = None
+            threads, order2 = queue_waiters(control, [('interactive', 1.0, 3)])
+            for x in range(500):
+                if control.queued:
+                    break
+                time.sleep(0.01)
+            assert control.waiting == 2
+        for thread in threads + [thread]:
+            thread.join()
+        assert order2 == ['interactive']
+        assert order == ['background']
+
+    def test_reserved_all(self):
+        # we must leave at least one slot for large conversions
+        with pytest.raises(ValueError):
+            AdmissionControl(max_active=2, reserved=2, large_cost=10)
+        # without large conversions, nothing is reserved
+        AdmissionControl(max_active=2, reserved=2)
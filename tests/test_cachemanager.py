@@ -176,6 +176,19 @@ class TestCacheBucket(object):
         assert result_dir.join("result2.txt").exists() is True
         assert result_dir.join("result2.txt").read() == "result2\n"
 
+    def test_store_representation_dir(self, cache_env):
+        # we can store directories as representations
+        result_dir = cache_env.mkdir("result.html.zip")
+        result_dir.join("result.html").write("result\n")
+        result_dir.mkdir("sub").join("result.css").write("css\n")
+        bucket = Bucket(str(cache_env / "cache"))
+        res = bucket.store_representation(
+            str(cache_env / "src1.txt"), str(result_dir), repr_key='mykey')
+        path = cache_env / "cache" / "repr" / "1" / "1" / "result.html.zip"
+        assert bucket.get_representation(res) == path
+        assert path.join("result.html").read() == "result\n"
+        assert path.join("sub", "result.css").read() == "css\n"
+
     def test_get_representation_unstored(self, tmpdir):
         # we cannot get unstored representations
         bucket = Bucket(str(tmpdir.join("cache")))
@@ -376,6 +389,29 @@ class TestCacheManager(object):
         assert key3 == my_id3
         return
 
+    def test_get_cached_file_by_digest(self, cache_env):
+        # we can get cached files by source digest
+        cm = CacheManager(str(cache_env / "cache"))
+        src = str(cache_env / "src1.txt")
+        my_id = cm.register_doc(src, str(cache_env / "result1.txt"), 'mykey')
+        path, key = cm.get_cached_file_by_digest(
+            '737b337e605199de28b3b64c674f9422', 'mykey')
+        assert filecmp.cmp(path, str(cache_env / "result1.txt"))
+        assert key == my_id
+        # other keys are not found
+        assert cm.get_cached_file_by_digest(
+            '737b337e605199de28b3b64c674f9422', 'otherkey') == (None, None)
+
+    def test_get_cached_file_by_digest_failed(self, cache_env):
+        # unknown or invalid digests result in `None`
+        cm = CacheManager(str(cache_env / "cache"))
+        assert cm.get_cached_file_by_digest(
+            '737b337e605199de28b3b64c674f9422') == (None, None)
+        assert cm.get_cached_file_by_digest('../../etc') == (None, None)
+        assert cm.get_cached_file_by_digest(None) == (None, None)
+        # no buckets were created
+        assert (cache_env / "cache").listdir() == []
+
     def test_register_doc(self, cache_env):
         # we can register docs
         cm = CacheManager(str(cache_env / "cache"))
@@ -462,6 +498,12 @@ class NotHashingCacheManager(CacheManager):
         return 'somefakedhash'
 
 
+class CollidingCacheManager(CacheManager):
+    # a cache manager that always returns the same (valid) hash
+    def get_hash(self, path=None):
+        return '0' * 32
+
+
 class TestCollision(object):
     # make sure hash collisions are handled correctly
     def test_collisions(self, cache_env):
@@ -484,3 +526,14 @@ class TestCollision(object):
         assert (repr_path / "1" / "2" / "result2.txt").read() == ("result2\n")
         assert (repr_path / "2" / "1" / "result3.txt").read() == ("result3\n")
         assert (repr_path / "2" / "2" / "result4.txt").read() == ("result4\n")
+
+    def test_collisions_by_digest(self, cache_env):
+        # with colliding sources we cannot tell by digest
+        cm = CollidingCacheManager(cache_dir=str(cache_env / "cache"))
+        src1 = str(cache_env / "src1.txt")
+        src2 = str(cache_env / "src2.txt")
+        cm.register_doc(src1, str(cache_env / "result1.txt"), repr_key="pdf")
+        assert cm.get_cached_file_by_digest(
+            '0' * 32, 'pdf')[1] == '%s_1_1' % ('0' * 32)
+        cm.register_doc(src2, str(cache_env / "result2.txt"), repr_key="pdf")
+        assert cm.get_cached_file_by_digest('0' * 32, 'pdf') == (None, None)
@@ -2,7 +2,13 @@
 import filecmp
 import os
 import pytest
-from ulif.openoffice.client import convert_doc, Client, main
+import threading
+import time
+from ulif.openoffice import client as client_module
+from ulif.openoffice import endpoints
+from ulif.openoffice.cachemanager import CacheManager, get_marker
+from ulif.openoffice.client import (
+    convert_doc, Client, main, _conversion_lock)
 from ulif.openoffice.options import ArgumentParserError
 
 
@@ -74,6 +80,141 @@ class TestConvertDoc(object):
         assert 'sample.html' in result_list
 
 
+class FakeMetaProcessor(object):
+    # a meta processor that counts calls and waits for other threads
+
+    calls = []
+    wait_for = 0
+    error = None
+
+    def __init__(self, options={}):
+        self.options = options
+
+    def process(self, input_path):
+        self.calls.append(input_path)
+        timeout = time.time() + 5
+        while time.time() < timeout:
+            # wait until all other threads wait for us
+            if sum([f.waiters for f in client_module._flights.values()]
+                   ) >= self.wait_for:
+                break
+            time.sleep(0.01)
+        if self.error is not None:
+            raise self.error
+        result_path = os.path.join(os.path.dirname(input_path), 'result.txt')
+        with open(result_path, 'w') as fd:
+            fd.write('Result of %s' % self.options)
+        return result_path, {'error': False}
+
+
+@pytest.fixture
+def fake_meta(monkeypatch):
+    monkeypatch.setattr(client_module, 'MetaProcessor', FakeMetaProcessor)
+    monkeypatch.setattr(FakeMetaProcessor, 'calls', [])
+    monkeypatch.setattr(FakeMetaProcessor, 'wait_for', 0)
+    monkeypatch.setattr(FakeMetaProcessor, 'error', None)
+    return FakeMetaProcessor
+
+
+def convert_in_threads(src_doc, options_list, cache_dir=None):
+    # call `convert_doc` concurrently, once for each options.
+    results = [None] * len(options_list)
+
+    def convert(num):
+        try:
+            results[num] = convert_doc(src_doc, options_list[num], cache_dir)
+        except Exception as exc:
+            results[num] = exc
+
+    threads = [threading.Thread(target=convert, args=(num, ))
+               for num in range(len(options_list))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class TestSingleFlight(object):
+    # identical conversions in progress are done only once
+
+    def test_identical_conversions(self, workdir, fake_meta):
+        # concurrent identical conversions are done once
+        fake_meta.wait_for = 3
+        results = convert_in_threads(
+            str(workdir / 'src' / 'sample.txt'), [{'foo': 'bar'}] * 4,
+            str(workdir / 'cache'))
+        assert len(fake_meta.calls) == 1
+        paths = set([path for path, key, metadata in results])
+        # every caller gets own copy of result
+        assert len(paths) == 4
+        for path in paths:
+            assert open(path).read() == "Result of {'foo': 'bar'}"
+        keys = set([key for path, key, metadata in results])
+        assert keys == set(['396199333edbf40ad43e62a1c1397793_1_1'])
+        assert client_module._flights == {}
+
+    def test_different_options(self, workdir, fake_meta):
+        # conversions with different options are done separately
+        results = convert_in_threads(
+            str(workdir / 'src' / 'sample.txt'),
+            [{'foo': 'bar'}, {'foo': 'baz'}])
+        assert len(fake_meta.calls) == 2
+        assert results[0][0] != results[1][0]
+
+    def test_errors_shared(self, workdir, fake_meta):
+        # waiting callers get errors raised in conversion
+        fake_meta.wait_for = 2
+        fake_meta.error = ValueError('Boom!')
+        results = convert_in_threads(
+            str(workdir / 'src' / 'sample.txt'), [{'foo': 'bar'}] * 3)
+        assert len(fake_meta.calls) == 1
+        assert [str(exc) for exc in results] == ['Boom!'] * 3
+        assert client_module._flights == {}
+
+    def test_conversion_lock(self, workdir):
+        # we can lock conversions across processes
+        cache_dir = str(workdir / 'cache')
+        with _conversion_lock(cache_dir, ('a', 'b', cache_dir)) as waited:
+            assert waited is False
+        assert len(workdir.join('cache', '.locks').listdir()) == 1
+        with _conversion_lock(None, ('a', 'b', None)) as waited:
+            assert waited is False
+
+    def test_conversion_lock_slots(self, workdir, monkeypatch):
+        # the number of lock files is limited
+        monkeypatch.setattr(client_module, 'LOCK_SLOTS', 4)
+        cache_dir = str(workdir / 'cache')
+        for num in range(50):
+            with _conversion_lock(cache_dir, (str(num), 'b', cache_dir)):
+                pass
+        assert len(workdir.join('cache', '.locks').listdir()) == 4
+
+    def test_other_process(self, workdir, fake_meta):
+        # if some other process holds the lock, we wait and use the
+        # result it cached.
+        src_doc = str(workdir / 'src' / 'sample.txt')
+        cache_dir = str(workdir / 'cache')
+        workdir.join('result.txt').write('Cached result')
+        options = {'foo': 'bar'}
+        key = (CacheManager.get_hash(src_doc), get_marker(options), cache_dir)
+        results = []
+        with _conversion_lock(cache_dir, key):
+            thread = threading.Thread(target=lambda: results.append(
+                convert_doc(src_doc, options, cache_dir)))
+            thread.start()
+            time.sleep(0.2)
+            CacheManager(cache_dir).register_doc(
+                src_doc, str(workdir / 'result.txt'), get_marker(options))
+        thread.join()
+        assert fake_meta.calls == []
+        result_path, cache_key, metadata = results[0]
+        assert open(result_path).read() == 'Cached result'
+        assert cache_dir not in result_path
+        assert cache_key == '396199333edbf40ad43e62a1c1397793_1_1'
+        assert metadata == {'error': False}
+
+
 class ClientEnv(object):
     def __init__(self, workdir):
         self.workdir = workdir
@@ -118,6 +259,16 @@ class TestClient(object):
         assert filecmp.cmp(result_path, cached_path, shallow=False)
         assert client_env.cache_dir in cached_path
 
+    def test_get_cached_dir(self, client_env, tmpdir):
+        # unzipped results (directories) are not returned
+        client = Client(cache_dir=client_env.cache_dir)
+        result_dir = tmpdir.mkdir("sample")
+        result_dir.join("sample.html").write("Result")
+        cache_key = client.cache_manager.register_doc(
+            client_env.src_doc, str(result_dir), repr_key='unzipped')
+        assert client.cache_manager.get_cached_file(cache_key) is not None
+        assert client.get_cached(cache_key) is None
+
     def test_options(self, client_env):
         # we can pass in options
         client = Client()
@@ -160,6 +311,31 @@ class TestClient(object):
         assert c_key == '396199333edbf40ad43e62a1c1397793_1_1'
 
 
+class TestClientCached(object):
+    # the client uses cached results if available
+
+    def test_convert_cached(self, workdir, fake_meta):
+        # cached results are not converted again
+        client = Client(cache_dir=str(workdir / 'cache'))
+        path1, key1, metadata1 = client.convert(
+            str(workdir / 'src' / 'sample.txt'), {'foo': 'bar'})
+        path2, key2, metadata2 = client.convert(
+            str(workdir / 'src' / 'sample.txt'), {'foo': 'bar'})
+        assert len(fake_meta.calls) == 1
+        assert key1 == key2
+        assert path1 != path2
+        assert filecmp.cmp(path1, path2, shallow=False)
+        assert str(workdir / 'cache') not in path2
+        assert metadata2 == {'error': False}
+
+    def test_convert_no_cache(self, workdir, fake_meta):
+        # without cache we always convert
+        client = Client()
+        client.convert(str(workdir / 'src' / 'sample.txt'), {'foo': 'bar'})
+        client.convert(str(workdir / 'src' / 'sample.txt'), {'foo': 'bar'})
+        assert len(fake_meta.calls) == 2
+
+
 class TestClientMain(object):
     # tests for the client modules `main` function
 
@@ -178,6 +354,20 @@ class TestClientMain(object):
         assert os.path.isfile(outfile_path)
         assert outfile_path.endswith('/sample.pdf')
 
+    def test_statefile(self, client_env, capsys, monkeypatch):
+        # we can tell where to find the state file of oooctl
+        monkeypatch.setattr(endpoints, '_state_file', None)
+        main(
+            [
+                '--statefile', '/tmp/ooodaemon.json',
+                '-meta-procord', 'oocp',
+                '-oocp-out-fmt', 'pdf',
+                client_env.src_doc
+            ])
+        out, err = capsys.readouterr()
+        assert out.startswith('RESULT in')
+        assert endpoints._state_file == '/tmp/ooodaemon.json'
+
     def test_help(self, client_env, capsys):
         # we can get help
         with pytest.raises(SystemExit):
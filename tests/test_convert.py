@@ -2,7 +2,10 @@
 import os
 import pytest
 import shutil
-from ulif.openoffice.convert import convert, exec_cmd
+import socket
+from ulif.openoffice import convert as convert_module
+from ulif.openoffice.convert import (
+    convert, exec_cmd, get_pipe_path, get_url)
 
 pytestmark = pytest.mark.converter
 
@@ -13,6 +16,16 @@ class TestConvert(object):
         # w/o a path we get no conversion
         assert (None, None) == convert()
 
+    def test_convert_no_launch(self, monkeypatch, tmpdir):
+        # we can tell unoconv not to start office servers itself
+        cmds = []
+        monkeypatch.setattr(convert_module, 'exec_cmd', lambda cmd: (
+            cmds.append(cmd) or (0, '')))
+        convert(path='/doc.txt', out_dir=str(tmpdir))
+        convert(path='/doc.txt', out_dir=str(tmpdir), no_launch=True)
+        assert '--no-launch' not in cmds[0]
+        assert ' -d document --no-launch /doc.txt' in cmds[1]
+
     def test_exec_cmd(self, envpath_no_venv):
         # we can exec commands and get the output back
         status, output = exec_cmd('unoconv --help')
@@ -78,3 +91,57 @@ class TestConvert(object):
         assert (
             '<DIV TYPE=HEADER>' in content) or (
             '<div title="header"' in content)
+
+
+def listen(path):
+    # get a Unix domain socket listening at `path`
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    return server
+
+
+class TestGetURL(object):
+
+    @pytest.fixture
+    def pipe_dir(self, pipe_tmpdir, monkeypatch):
+        # a directory office pipes are looked up in
+        monkeypatch.setattr(
+            convert_module, 'PIPE_DIRS', (str(pipe_tmpdir), ))
+        return pipe_tmpdir
+
+    def test_get_pipe_path(self, pipe_dir):
+        # we can find the sockets of office pipes
+        assert get_pipe_path('foo') is None
+        path = pipe_dir / ('OSL_PIPE_%s_foo' % os.getuid())
+        path.write('')
+        assert get_pipe_path('foo') == str(path)
+        # plain files do not accept connections
+        assert get_pipe_path('foo', connect=True) is None
+        path.remove()
+        server = listen(str(path))
+        assert get_pipe_path('foo', connect=True) == str(path)
+        server.close()
+
+    def test_get_url_socket(self, pipe_dir):
+        # w/o pipe we connect via TCP
+        assert get_url('localhost', 2002) == (
+            'socket,host=localhost,port=2002;urp;StarOffice.ComponentContext')
+
+    def test_get_url_pipe(self, pipe_dir):
+        # local office servers listening on pipes are connected by pipe
+        server = listen(str(pipe_dir.join(
+            'OSL_PIPE_%s_ulif_openoffice_2002' % os.getuid())))
+        assert get_url('localhost', 2002) == (
+            'pipe,name=ulif_openoffice_2002;urp;StarOffice.ComponentContext')
+        assert get_url('127.0.0.1', 2002).startswith('pipe,')
+        # remote hosts cannot use our pipes
+        assert get_url('otherhost', 2002).startswith('socket,')
+        server.close()
+
+    def test_get_url_pipe_stale(self, pipe_dir):
+        # sockets left by crashed office servers are not used
+        server = listen(str(pipe_dir.join(
+            'OSL_PIPE_%s_ulif_openoffice_2002' % os.getuid())))
+        server.close()
+        assert get_url('localhost', 2002).startswith('socket,')
@@ -0,0 +1,341 @@
+# tests for endpoints module
+import json
+import os
+import pytest
+import socket
+import struct
+import subprocess
+import threading
+import time
+from ulif.openoffice import convert as _convert
+from ulif.openoffice.endpoints import (
+    parse_endpoints, probe_endpoint, Endpoint, EndpointPool,
+    NoEndpointAvailable, set_endpoints, get_endpoint_pool, resolve_endpoint,
+    set_state_file)
+
+
+def serve_once(greeting=None):
+    # start a server accepting one connection, sending `greeting`.
+    # Returns the port.
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def run():
+        conn, addr = server.accept()
+        if greeting is not None:
+            conn.sendall(greeting)
+        time.sleep(0.5)
+        conn.close()
+        server.close()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1]
+
+
+def free_port():
+    # get a port nobody listens on
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class FakeProbe(object):
+    # a probe reporting endpoints in `dead` as unhealthy
+    def __init__(self, dead=()):
+        self.dead = list(dead)
+        self.probed = []
+
+    def __call__(self, host, port):
+        self.probed.append((host, port))
+        return (host, port) not in self.dead
+
+
+@pytest.fixture
+def endpoints_reset(request):
+    # remove any endpoint pool set during test
+    request.addfinalizer(set_endpoints)
+
+
+class TestHelpers(object):
+
+    def test_parse_endpoints(self):
+        # we can parse lists of endpoints
+        assert parse_endpoints('a:1, b:2') == [('a', 1), ('b', 2)]
+        assert parse_endpoints(' a:1 b ') == [('a', 1), ('b', 2002)]
+        assert parse_endpoints('') == []
+
+    def test_probe_endpoint(self):
+        # office servers greet us with a URP message block
+        port = serve_once(struct.pack('>II', 20, 1))
+        assert probe_endpoint('127.0.0.1', port) is True
+
+    def test_probe_endpoint_silent(self):
+        # servers accepting connections but not talking are unhealthy
+        port = serve_once()
+        assert probe_endpoint('127.0.0.1', port, timeout=0.2) is False
+
+    def test_probe_endpoint_closed(self):
+        # servers we cannot connect to are unhealthy
+        assert probe_endpoint('127.0.0.1', free_port()) is False
+
+    def test_endpoint_url(self):
+        # endpoints provide connection strings for unoconv
+        assert Endpoint('host', 2003).url == (
+            'socket,host=host,port=2003;urp;StarOffice.ComponentContext')
+
+    def test_endpoint_url_pipe(self, pipe_tmpdir, monkeypatch):
+        # local endpoints listening on pipes are connected by pipe
+        monkeypatch.setattr(_convert, 'PIPE_DIRS', (str(pipe_tmpdir), ))
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(str(pipe_tmpdir.join(
+            'OSL_PIPE_%s_ulif_openoffice_2003' % os.getuid())))
+        server.listen(1)
+        assert Endpoint('localhost', 2003).url == (
+            'pipe,name=ulif_openoffice_2003;urp;StarOffice.ComponentContext')
+        server.close()
+
+    def write_state(self, tmpdir, pid, states):
+        # write an oooctl state file with instances in `states`
+        path = tmpdir.join('state.json')
+        path.write(json.dumps(dict(pid=pid, port=2002, instances=[
+            dict(host='localhost', port=port, state=state)
+            for port, state in states])))
+        path.chmod(0o644)
+        return str(path)
+
+    def test_resolve_endpoint(self, tmpdir):
+        # we follow oooctl instances moved off their base port
+        path = self.write_state(
+            tmpdir, os.getpid(), [(2002, 'draining'), (2003, 'ready')])
+        assert resolve_endpoint('localhost', 2002, path) == (
+            'localhost', 2003)
+        path = self.write_state(
+            tmpdir, os.getpid(), [(2002, 'ready'), (2003, 'ready')])
+        assert resolve_endpoint('localhost', 2002, path) == (
+            'localhost', 2002)
+
+    def test_resolve_endpoint_unchanged(self, tmpdir):
+        # other hosts, ports and missing or stale state files are ignored
+        path = self.write_state(
+            tmpdir, os.getpid(), [(2002, 'draining'), (2003, 'ready')])
+        assert resolve_endpoint('otherhost', 2002, path) == (
+            'otherhost', 2002)
+        assert resolve_endpoint('localhost', 2010, path) == (
+            'localhost', 2010)
+        assert resolve_endpoint('localhost', 2002, str(
+            tmpdir.join('missing'))) == ('localhost', 2002)
+        tmpdir.join('state.json').write('{not json')
+        assert resolve_endpoint('localhost', 2002, path) == (
+            'localhost', 2002)
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        path = self.write_state(
+            tmpdir, proc.pid, [(2002, 'draining'), (2003, 'ready')])
+        assert resolve_endpoint('localhost', 2002, path) == (
+            'localhost', 2002)
+
+    def test_resolve_endpoint_untrusted(self, tmpdir, monkeypatch):
+        # state files others can write or owned by others are ignored
+        path = self.write_state(
+            tmpdir, os.getpid(), [(2002, 'draining'), (2003, 'ready')])
+        os.chmod(path, 0o666)
+        assert resolve_endpoint('localhost', 2002, path) == (
+            'localhost', 2002)
+        os.chmod(path, 0o664)
+        assert resolve_endpoint('localhost', 2002, path) == (
+            'localhost', 2002)
+        os.chmod(path, 0o644)
+        monkeypatch.setattr(os, 'getuid', lambda: os.stat(path).st_uid + 1)
+        assert resolve_endpoint('localhost', 2002, path) == (
+            'localhost', 2002)
+
+    def test_resolve_endpoint_state_file_set(self, tmpdir):
+        # without a state file given or set, no state file is read
+        path = self.write_state(
+            tmpdir, os.getpid(), [(2002, 'draining'), (2003, 'ready')])
+        assert resolve_endpoint('localhost', 2002) == ('localhost', 2002)
+        set_state_file(path)
+        try:
+            assert resolve_endpoint('localhost', 2002) == (
+                'localhost', 2003)
+        finally:
+            set_state_file(None)
+        assert resolve_endpoint('localhost', 2002) == ('localhost', 2002)
+
+
+class TestEndpointPool(object):
+
+    def test_create(self):
+        # we can create pools from strings
+        pool = EndpointPool('a:1,b:2')
+        assert [(ep.host, ep.port) for ep in pool.endpoints] == [
+            ('a', 1), ('b', 2)]
+
+    def test_create_empty(self):
+        # we need at least one endpoint
+        with pytest.raises(ValueError):
+            EndpointPool('')
+
+    def test_acquire_least_loaded(self):
+        # we get the endpoint with least conversions running
+        pool = EndpointPool([('a', 1), ('b', 2)])
+        ep1 = pool.acquire()
+        ep2 = pool.acquire()
+        assert ep1 is not ep2
+        pool.release(ep1)
+        assert pool.acquire() is ep1
+
+    def test_acquire_exclude(self):
+        # we can exclude endpoints
+        pool = EndpointPool([('a', 1), ('b', 2)])
+        ep = pool.acquire(exclude=[pool.endpoints[0]])
+        assert ep is pool.endpoints[1]
+        with pytest.raises(NoEndpointAvailable):
+            pool.acquire(exclude=pool.endpoints)
+
+    def test_release_trips(self):
+        # endpoints failing too often are out of rotation
+        pool = EndpointPool([('a', 1)], failure_threshold=2, backoff=10)
+        ep = pool.acquire()
+        pool.release(ep, ok=False)
+        assert ep.open_until is None
+        pool.release(pool.acquire(), ok=False)
+        assert ep.open_until > time.time() + 9
+        with pytest.raises(NoEndpointAvailable):
+            pool.acquire()
+
+    def test_release_ok_resets(self):
+        # successful conversions reset failure counts
+        pool = EndpointPool([('a', 1)], failure_threshold=2)
+        pool.release(pool.acquire(), ok=False)
+        pool.release(pool.acquire(), ok=True)
+        assert pool.endpoints[0].failures == 0
+
+    def test_backoff_doubles(self):
+        # backoff times double up to a maximum
+        pool = EndpointPool([('a', 1)], backoff=1, max_backoff=3)
+        ep = pool.endpoints[0]
+        backoffs = []
+        for num in range(3):
+            pool._trip(ep)
+            backoffs.append(ep.backoff)
+        assert backoffs == [1, 2, 3]
+
+    def test_expired_probed_healthy(self):
+        # endpoints out of rotation are probed before they get back
+        probe = FakeProbe()
+        pool = EndpointPool(
+            [('a', 1)], failure_threshold=3, probe=probe)
+        ep = pool.endpoints[0]
+        ep.open_until = time.time() - 1
+        assert pool.acquire() is ep
+        assert probe.probed == [('a', 1)]
+        # on probation
+        assert ep.failures == 2
+        pool.release(ep, ok=False)
+        assert ep.open_until is not None
+
+    def test_expired_probed_unhealthy(self):
+        # endpoints failing the probe stay out of rotation
+        probe = FakeProbe(dead=[('a', 1)])
+        pool = EndpointPool([('a', 1)], backoff=1, probe=probe)
+        ep = pool.endpoints[0]
+        ep.open_until = time.time() - 1
+        ep.backoff = 1
+        with pytest.raises(NoEndpointAvailable):
+            pool.acquire()
+        assert ep.backoff == 2
+
+    def test_check(self):
+        # we can probe all endpoints in rotation
+        probe = FakeProbe(dead=[('b', 2)])
+        pool = EndpointPool([('a', 1), ('b', 2)], probe=probe)
+        pool.check()
+        assert pool.endpoints[0].open_until is None
+        assert pool.endpoints[1].open_until is not None
+
+    def test_convert(self, monkeypatch):
+        # conversions are done at some endpoint
+        calls = []
+
+        def fake_convert(url=None, **kw):
+            calls.append((url, kw))
+            return 0, 'result'
+        monkeypatch.setattr(_convert, 'convert', fake_convert)
+        pool = EndpointPool([('a', 1)])
+        assert pool.convert(path='doc') == (0, 'result')
+        # unoconv must not start office servers on its own
+        assert calls == [
+            (pool.endpoints[0].url, dict(path='doc', no_launch=True))]
+        assert pool.endpoints[0].active == 0
+
+    def test_convert_retry(self, monkeypatch):
+        # conversions failing to connect are retried elsewhere
+        calls = []
+
+        def fake_convert(url=None, **kw):
+            calls.append(url)
+            if 'host=a' in url:
+                return 113, ''
+            return 0, 'result'
+        monkeypatch.setattr(_convert, 'convert', fake_convert)
+        pool = EndpointPool([('a', 1), ('b', 2)])
+        assert pool.convert(path='doc') == (0, 'result')
+        assert pool.convert(path='doc') == (0, 'result')
+        assert pool.endpoints[0].failures == 2
+        assert len([x for x in calls if 'host=b' in x]) == 2
+
+    def test_convert_all_failing(self, monkeypatch):
+        # if all endpoints fail, we get the last result
+        monkeypatch.setattr(
+            _convert, 'convert', lambda url=None, **kw: (251, ''))
+        pool = EndpointPool([('a', 1), ('b', 2)])
+        assert pool.convert(path='doc') == (251, '')
+
+    def test_convert_other_errors(self, monkeypatch):
+        # conversion errors not related to connections are not retried
+        calls = []
+
+        def fake_convert(url=None, **kw):
+            calls.append(url)
+            return 1, ''
+        monkeypatch.setattr(_convert, 'convert', fake_convert)
+        pool = EndpointPool([('a', 1), ('b', 2)])
+        assert pool.convert(path='doc') == (1, '')
+        assert len(calls) == 1
+
+    def test_state_file(self, tmpdir):
+        # pools can follow the instances listed in a state file
+        path = tmpdir / "state.json"
+        pool = EndpointPool(str(path))
+        with pytest.raises(NoEndpointAvailable):
+            pool.acquire()
+        path.write(json.dumps(dict(pid=1, instances=[
+            dict(host='a', port=1, state='draining'),
+            dict(host='b', port=2, state='ready')])))
+        ep = pool.acquire()
+        assert (ep.host, ep.port) == ('b', 2)
+        path.remove()
+        path.write(json.dumps(dict(pid=1, instances=[
+            dict(host='b', port=2, state='ready'),
+            dict(host='c', port=3, state='ready')])))
+        assert pool.acquire().host == 'c'
+        # running conversions are kept
+        assert pool.endpoints[0] is ep
+        pool.release(ep)
+
+
+class TestSetEndpoints(object):
+
+    def test_set_endpoints(self, endpoints_reset):
+        # we can set and remove a global pool
+        assert get_endpoint_pool() is None
+        pool = set_endpoints('a:1', failure_threshold=1)
+        assert get_endpoint_pool() is pool
+        assert pool.failure_threshold == 1
+        assert set_endpoints(None) is None
+        assert get_endpoint_pool() is None
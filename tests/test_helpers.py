@@ -22,16 +22,20 @@ import os
 import pytest
 import shutil
 import stat
+import time
 import zipfile
 from io import StringIO, BytesIO
 from six import text_type
+from ulif.openoffice import helpers
 from ulif.openoffice.processor import OOConvProcessor
 from ulif.openoffice.helpers import (
-    copytree, copy_to_secure_location, get_entry_points, unzip, zip,
-    remove_file_dir, extract_css, cleanup_html, cleanup_css,
+    copytree, copy_to_secure_location, fix_heading_numbers, get_entry_points,
+    get_entry_point_names, clear_entry_point_cache, unzip, zip,
+    remove_file_dir, extract_css, normalize_css, cleanup_html, cleanup_css,
     rename_html_img_links, rename_sdfield_tags, base64url_encode,
     base64url_decode, string_to_bool, strict_string_to_bool,
-    string_to_stringtuple, filelike_cmp, write_filelike)
+    string_to_stringtuple, filelike_cmp, write_filelike, CSSCache,
+    css_cache, ZipLimitError, is_compressed, iter_zip)
 from ulif.openoffice.helpers import basestring as basestring_modified
 
 
@@ -181,42 +185,54 @@ class TestExtractCSS(object):
         )
 
     def test_extract_css_puts_links_into_html(self, samples_dir):
-        # the returned HTML part has the styles replaced with a link:
+        # the returned HTML part has the styles replaced with a link.
+        # Everything else is left untouched.
         content = samples_dir.join("sample2.html").read_text('utf-8')
         html, css = extract_css(content, "sample.html")
+        head = content.split('<style', 1)[0]
+        tail = content.split('</style>')[-1]
         assert html == (
-            '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"\n'
-            '    "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">\n'
-            '\n'
-            '<html xmlns="http://www.w3.org/1999/xhtml">\n'
-            '<head>\n'
-            '<meta content="HTML Tidy for Linux/x86 (vers 6 November 2007)'
-            ', see www.w3.org" name="generator"/>\n'
-            '<meta content="text/html; charset=utf-8" '
-            'http-equiv="CONTENT-TYPE"/>\n'
-            '<title></title>\n'
-            '<meta content="OpenOffice.org 2.4 (Linux)" name="GENERATOR"/>\n'
-            '<meta content="Uli Fouquet" name="AUTHOR"/>\n'
-            '<meta content="20110517;485000" name="CREATED"/>\n'
-            '<meta content="Uli Fouquet" name="CHANGEDBY"/>\n'
-            '<meta content="20110517;524000" name="CHANGED"/>\n'
-            '<link href="sample.css" rel="stylesheet" type="text/css"/>\n'
-            '\n'
-            '</head>\n'
-            '<body dir="ltr" lang="de-DE" xml:lang="de-DE">\n'
-            '<p class="c1">Some text</p>\n'
-            '<p class="c1"><br/></p>\n'
-            '<p class="c1">with <b>bold</b> and <i>italic</i> fonts.</p>\n'
-            '<p class="c1"><br/></p>\n'
-            '<p class="c1">Also a <span class="c2">complete different\n'
-            '  font</span> is here. With umlaut: ä</p>\n'
-            '<p class="c1">Finally, some\n'
-            '    <span class="c2">seam</span><span>less text.</span>\n'
-            '</p>\n'
-            '<p class="c1"><br/></p>\n'
-            '</body>\n'
-            '</html>\n'
-            )
+            head + '<link href="sample.css" rel="stylesheet" '
+            'type="text/css"/>\n  ' + tail)
+
+    def test_extract_css_uppercase_tags(self):
+        # tag names are case-insensitive
+        result, css = extract_css(
+            "<HTML><STYLE>P {x}</Style></HTML>", 'sample.html')
+        assert css == 'p { x }'
+        assert result == (
+            '<HTML><link href="sample.css" rel="stylesheet" '
+            'type="text/css"/></HTML>')
+
+    def test_extract_css_ignores_comments_and_scripts(self):
+        # styles in comments and scripts are not touched
+        html_input = (
+            "<!-- <style>a {}</style> -->"
+            "<script>var x = '<style>b {}</style>';</script>")
+        result, css = extract_css(html_input, 'sample.html')
+        assert css is None
+        assert result == html_input
+
+    def test_extract_css_unclosed_style(self):
+        # an unclosed style lasts until end of input
+        result, css = extract_css("<p><style>a {x}", 'sample.html')
+        assert css == 'a { x }'
+        assert result == (
+            '<p><link href="sample.css" rel="stylesheet" type="text/css"/>')
+
+    def test_extract_css_strips_comment_markers(self):
+        # HTML comment markers in styles are removed
+        result, css = extract_css(
+            "<style><!--\nP {x}\n--></style>", 'sample.html')
+        assert css == 'p { x }\n'
+
+    def test_extract_css_large_input(self):
+        # many styles and unterminated things are handled in linear time
+        html_input = '<style>p.c%s {x: y}</style>' * 20000 + '<!--' * 20000
+        ts = time.time()
+        result, css = extract_css(html_input, 'sample.html')
+        assert time.time() - ts < 2.0
+        assert css.count('\n') == 19999
 
     def test_extract_css_utf8(self):
         # we do not stumble over umlauts.
@@ -275,6 +291,29 @@ class TestExtractCSS(object):
         assert result == "<span>text<span>no</span>gap</span>"
 
 
+class TestNormalizeCSS(object):
+    # tests for normalize_css()
+
+    def test_normalize_css(self):
+        assert normalize_css(
+            "  P.Foo {Color: Red}\n\n  A {x}") == (
+                "p.foo { Color: Red }\na { x }")
+
+    def test_normalize_css_empty_comments(self):
+        # empty comments are removed, others kept
+        assert normalize_css("p {/* */x/**/}/* Foo */") == (
+            "p { x }/* Foo */")
+
+    def test_normalize_css_statements(self):
+        # statements before rule sets are left untouched
+        assert normalize_css('@charset "UTF-8"; P {x}') == (
+            '@charset "UTF-8";\np { x }')
+
+    def test_normalize_css_nested(self):
+        assert normalize_css("@MEDIA print {\n  P {x}}") == (
+            "@media print {\np { x } }")
+
+
 class TestCleanupHTML(object):
     # tests for cleanup_html().
 
@@ -325,6 +364,37 @@ class TestCleanupHTML(object):
         expected += 'Heading</h1></body>'
         assert result == expected % ('1.1.')
 
+    def test_cleanup_html_fix_head_nums_several(self):
+        html_input = '<h1>1Foo</h1><p>2.</p><h2>1.1 Bar</h2><h3>.x</h3>'
+        result, img_map = cleanup_html(html_input, 'sample.html')
+        assert result == (
+            '<h1><span class="u-o-headnum">1</span>Foo</h1><p>2.</p>'
+            '<h2><span class="u-o-headnum">1.1</span> Bar</h2>'
+            '<h3><span class="u-o-headnum">.</span>x</h3>')
+
+    def test_cleanup_html_fix_head_nums_at_end_of_input(self):
+        # numbers w/o terminating char are cut at their last dot
+        assert fix_heading_numbers('<h1>1.2.3') == (
+            '<h1><span class="u-o-headnum">1.2</span>.3')
+        assert fix_heading_numbers('<h1>123') == '<h1>123'
+        assert fix_heading_numbers('<h1>.123') == '<h1>.123'
+        assert fix_heading_numbers('<h1') == '<h1'
+
+    @pytest.mark.parametrize("html_input", [
+        '<h1>' + '1' * 100000,
+        '<h1>' + '1.' * 50000 + '1',
+        '<h1>' + ' ' * 100000,
+        '<h1' * 30000 + '>' + '1' * 10000,
+        '<h1>1.1' * 30000,
+        ])
+    def test_cleanup_html_fix_head_nums_adversarial(self, html_input):
+        # long runs of digits and dots are handled in linear time
+        ts = time.time()
+        result = fix_heading_numbers(html_input)
+        assert time.time() - ts < 1.0
+        assert result.replace('<span class="u-o-headnum">', '').replace(
+            '</span>', '') == html_input
+
     def test_cleanup_html_fix_sdfields(self):
         html_input = '<p>Blah<sdfield type="PAGE">8</sdfield></p>'
         result, img_map = cleanup_html(html_input, 'sample.html')
@@ -418,6 +488,111 @@ class TestCleanupCSS(object):
         result, errors = cleanup_css(css_input, minified=False)
         assert result == 'p {\n    foo: baz;\n    bar: baz\n    }'
 
+    def test_cleanup_css_memoized(self):
+        # repeated CSS is not parsed again
+        css_input = 'p { foo: baz ; font-family: ; bar: baz}'
+        result1 = cleanup_css(css_input)
+        assert css_cache.get(css_input, True) == result1
+        result2 = cleanup_css(css_input)
+        assert result1 == result2
+        assert 'ERROR PropertyValue: Unknown syntax' in result2[1]
+
+    def test_cleanup_css_memoized_minified(self):
+        # minified and non-minified results are stored separately
+        css_input = 'p { foo: baz ; font-family: ; bar: baz}'
+        result1, errors = cleanup_css(css_input, minified=True)
+        result2, errors = cleanup_css(css_input, minified=False)
+        assert result1 == 'p{foo:baz;bar:baz}'
+        assert result2 == 'p {\n    foo: baz;\n    bar: baz\n    }'
+
+    def test_cleanup_css_no_root_handlers(self):
+        # we do not add log handlers to the root logger
+        import logging
+        num_handlers = len(logging.getLogger().handlers)
+        cleanup_css('p { foo: bar; }')
+        cleanup_css('p { foo: baz; }')
+        assert len(logging.getLogger().handlers) == num_handlers
+
+
+class TestCSSCache(object):
+    # tests for the CSSCache
+
+    def test_get_set(self):
+        # we can store and retrieve results
+        cache = CSSCache()
+        assert cache.get('p {}', True) is None
+        cache.set('p {}', True, ('', 'some error'))
+        assert cache.get('p {}', True) == ('', 'some error')
+        assert cache.get('p {}', False) is None
+
+    def test_maxsize(self):
+        # least recently used entries are dropped
+        cache = CSSCache(maxsize=2)
+        cache.set('a', True, ('a', ''))
+        cache.set('b', True, ('b', ''))
+        cache.get('a', True)
+        cache.set('c', True, ('c', ''))
+        assert cache.get('a', True) == ('a', '')
+        assert cache.get('b', True) is None
+        assert cache.get('c', True) == ('c', '')
+
+    def test_persistent(self, tmpdir):
+        # with a path set, entries are stored on disk
+        path = str(tmpdir / 'css')
+        cache = CSSCache(path=path)
+        assert os.path.isdir(path)
+        cache.set('p {}', True, ('', 'some error'))
+        assert len(os.listdir(path)) == 1
+        assert os.listdir(path)[0].endswith('.json')
+        cache2 = CSSCache(path=path)
+        assert cache2.get('p {}', True) == ('', 'some error')
+
+    def test_persistent_invalid(self, tmpdir):
+        # files that contain no valid entries are ignored
+        path = str(tmpdir / 'css')
+        cache = CSSCache(path=path)
+        key = cache.get_key('p {}', True)
+        for content in ('{not json', '{"a": 1}', '["a", 1]'):
+            tmpdir.join('css', key + '.json').write(content)
+            assert cache.get('p {}', True) is None
+
+    def test_persistent_pruned(self, tmpdir):
+        # only `maxfiles` least recently used entries are kept on disk
+        path = str(tmpdir / 'css')
+        cache = CSSCache(path=path, maxfiles=2)
+        for num, name in enumerate('abc'):
+            cache.set(name, True, (name, ''))
+            file_path = os.path.join(path, cache.get_key(name, True))
+            os.utime(file_path + '.json', (num, num))
+        cache.clear()
+        assert cache.get('a', True) is None
+        assert cache.get('b', True) == ('b', '')
+        assert cache.get('c', True) == ('c', '')
+
+    def test_persistent_pruned_rarely(self, tmpdir, monkeypatch):
+        # the directory is not listed for each new entry
+        path = str(tmpdir / 'css')
+        cache = CSSCache(path=path, maxfiles=20)
+        listed = []
+
+        def listdir(path):
+            listed.append(path)
+            return real_listdir(path)
+        real_listdir = os.listdir
+        monkeypatch.setattr(os, 'listdir', listdir)
+        for num in range(40):
+            cache.set('p%s' % num, True, ('', ''))
+            assert len(real_listdir(path)) <= 20
+        assert len(listed) < 15
+
+    def test_persistent_path_vanished(self, tmpdir):
+        # if the storage dir vanishes, we still keep results in memory
+        path = str(tmpdir / 'css')
+        cache = CSSCache(path=path)
+        shutil.rmtree(path)
+        cache.set('p {}', True, ('', ''))
+        assert cache.get('p {}', True) == ('', '')
+
 
 class TestRenameHTMLImgLinks(object):
     # tests for renam_html_img_links() helper.
@@ -565,6 +740,20 @@ class TestHelpers(object):
         result = get_entry_points('ulif.openoffice.processors')
         assert result['oocp'] is OOConvProcessor
 
+    def test_get_entry_point_names(self):
+        # we can get the names of entry points without loading them
+        result = get_entry_point_names('ulif.openoffice.processors')
+        assert 'oocp' in result
+        assert result == sorted(result)
+        assert get_entry_point_names('not-existing-group') == []
+
+    def test_clear_entry_point_cache(self):
+        # after clearing the cache we still get the same plugins
+        result1 = get_entry_points('ulif.openoffice.processors')
+        clear_entry_point_cache()
+        result2 = get_entry_points('ulif.openoffice.processors')
+        assert result1 == result2
+
     def test_unzip(self, tmpdir):
         # make sure we can unzip filetrees
         zip_file = str(tmpdir / "sample.zip")
@@ -577,6 +766,48 @@ class TestHelpers(object):
         assert sorted(os.listdir(str(dst.join("somedir")))) == [
             'othersample.txt', 'sample.txt']
 
+    def test_unzip_max_members(self, tmpdir):
+        # we can limit the number of members
+        zip_file = os.path.join(
+            os.path.dirname(__file__), 'input', 'sample1.zip')
+        dst = tmpdir.mkdir("dst")
+        with pytest.raises(ZipLimitError):
+            unzip(zip_file, str(dst), max_members=2)
+        assert dst.listdir() == []
+
+    def test_unzip_max_size(self, tmpdir):
+        # we can limit the total number of uncompressed bytes
+        zip_file = str(tmpdir / "sample.zip")
+        with zipfile.ZipFile(zip_file, 'w') as zf:
+            zf.writestr('sample.txt', 'A' * 1000)
+        dst = tmpdir.mkdir("dst")
+        with pytest.raises(ZipLimitError):
+            unzip(zip_file, str(dst), max_size=999)
+        assert dst.listdir() == []
+        unzip(zip_file, str(dst), max_size=1000)
+        assert dst.join('sample.txt').read() == 'A' * 1000
+
+    def test_unzip_max_ratio(self, tmpdir):
+        # we can limit the compression ratio
+        zip_file = str(tmpdir / "sample.zip")
+        with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('sample.txt', 'A' * 100000)
+        dst = tmpdir.mkdir("dst")
+        with pytest.raises(ZipLimitError):
+            unzip(zip_file, str(dst), max_ratio=10)
+        assert dst.listdir() == []
+
+    def test_unzip_streamed(self, tmpdir, monkeypatch):
+        # members are extracted in chunks
+        monkeypatch.setattr(
+            'ulif.openoffice.helpers.UNZIP_CHUNK_SIZE', 10)
+        zip_file = str(tmpdir / "sample.zip")
+        with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('sample.txt', 'A' * 95)
+        dst = tmpdir.mkdir("dst")
+        unzip(zip_file, str(dst))
+        assert dst.join('sample.txt').read() == 'A' * 95
+
     def test_zip_file(self, workdir):
         # make sure we can zip single files
         workdir.join("sample_dir").mkdir()
@@ -599,6 +830,115 @@ class TestHelpers(object):
             'subdir2/', 'subdir2/sample.txt', 'subdir2/subdir21/']
         assert zip_file.testzip() is None
 
+    def test_zip_deterministic(self, workdir):
+        # zipping the same content twice gives the same archive
+        dir_to_zip = workdir / "src"
+        dir_to_zip.join("subdir1").mkdir().join("a.txt").write("A sample")
+        result_path1 = zip(str(dir_to_zip))
+        os.utime(str(dir_to_zip / "sample.txt"), (0, 0))
+        result_path2 = zip(str(dir_to_zip), threads=2)
+        with open(result_path1, 'rb') as fd1:
+            with open(result_path2, 'rb') as fd2:
+                assert fd1.read() == fd2.read()
+        zip_file = zipfile.ZipFile(result_path1, 'r')
+        assert zip_file.testzip() is None
+        assert zip_file.getinfo('sample.txt').date_time == (
+            1980, 1, 1, 0, 0, 0)
+
+    def test_zip_threads_bounded(self, workdir, monkeypatch):
+        # with threads, only few members are compressed ahead
+        dir_to_zip = workdir / "src"
+        for num in range(20):
+            dir_to_zip.join("file%02d.txt" % num).write("Text %s" % num)
+        calls = []
+
+        def compress_member(path, level, store_compressed):
+            calls.append(path)
+            return real_compress_member(path, level, store_compressed)
+        real_compress_member = helpers._compress_member
+        monkeypatch.setattr(helpers, '_compress_member', compress_member)
+        zout = zipfile.ZipFile(BytesIO(), 'w', zipfile.ZIP_DEFLATED)
+        writes = helpers._iter_zip_writes(
+            zout, helpers._zip_members(str(dir_to_zip)), 6, True, 2)
+        next(writes)
+        assert len(calls) <= 4
+        list(writes)
+        assert len(calls) == 21
+        zout.close()
+
+    def test_zip_store_compressed(self, workdir):
+        # already compressed files are stored if requested
+        dir_to_zip = workdir / "src"
+        dir_to_zip.join("image.jpg").write("J" * 1000)
+        zip_file = zipfile.ZipFile(zip(str(dir_to_zip)), 'r')
+        assert zip_file.getinfo(
+            'image.jpg').compress_type == zipfile.ZIP_STORED
+        zip_file = zipfile.ZipFile(
+            zip(str(dir_to_zip), store_compressed=False), 'r')
+        assert zip_file.getinfo(
+            'image.jpg').compress_type == zipfile.ZIP_DEFLATED
+        assert zip_file.read('image.jpg') == b"J" * 1000
+
+    def test_zip_level(self, workdir):
+        # we can set the compression level
+        dir_to_zip = workdir / "src"
+        dir_to_zip.join("sample.txt").write("A sample " * 1000)
+        size1 = os.path.getsize(zip(str(dir_to_zip), level=1))
+        size9 = os.path.getsize(zip(str(dir_to_zip), level=9))
+        size0 = os.path.getsize(zip(str(dir_to_zip), level=0))
+        assert size9 <= size1 < size0
+
+    def test_zip_round_trip(self, workdir):
+        # archives with stored and deflated members are valid
+        dir_to_zip = workdir / "src"
+        dir_to_zip.join("image.png").write("Fake image")
+        dir_to_zip.join("big.txt").write("Some text\n" * 100000)
+        for threads in (0, 2):
+            result_path = zip(str(dir_to_zip), threads=threads)
+            zip_file = zipfile.ZipFile(result_path, 'r')
+            assert zip_file.testzip() is None
+            assert zip_file.read('big.txt') == b"Some text\n" * 100000
+            assert zip_file.read('image.png') == b"Fake image"
+            zip_file.close()
+            # zipfile can append members to our archives
+            zip_file = zipfile.ZipFile(result_path, 'a')
+            zip_file.writestr('extra.txt', 'extra')
+            zip_file.close()
+            zip_file = zipfile.ZipFile(result_path, 'r')
+            assert zip_file.testzip() is None
+            assert zip_file.read('extra.txt') == b"extra"
+            assert len(zip_file.namelist()) == 4
+
+    def test_is_compressed(self, tmpdir):
+        # we detect compressed files by extension or content
+        path = tmpdir / "sample.txt"
+        path.write("Some text")
+        assert is_compressed(str(path)) is False
+        path.write(b"\xff\xd8\xff\xe0 fake JPEG", mode="wb")
+        assert is_compressed(str(path)) is True
+        path = tmpdir / "sample.PNG"
+        path.write("Not a PNG")
+        assert is_compressed(str(path)) is True
+
+    def test_iter_zip(self, workdir):
+        # we can create zip files on the fly
+        dir_to_zip = workdir / "src"
+        dir_to_zip.join("subdir1").mkdir().join("a.txt").write("A sample")
+        dir_to_zip.join("image.png").write("Fake image")
+        content = b"".join(iter_zip(str(dir_to_zip)))
+        zip_file = zipfile.ZipFile(BytesIO(content), 'r')
+        assert zip_file.testzip() is None
+        assert zip_file.namelist() == [
+            'subdir1/', 'image.png', 'sample.txt', 'subdir1/a.txt']
+        assert zip_file.read('subdir1/a.txt') == b'A sample'
+        assert zip_file.getinfo(
+            'image.png').compress_type == zipfile.ZIP_STORED
+
+    def test_iter_zip_invalid_path(self):
+        # we get a ValueError if zip path is not valid
+        with pytest.raises(ValueError):
+            list(iter_zip("not-a-valid-path"))
+
     def test_zip_invalid_path(self):
         # we get a ValueError if zip path is not valid
         with pytest.raises(ValueError) as why:
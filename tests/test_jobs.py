@@ -0,0 +1,547 @@
+# tests for jobs module
+import os
+import pytest
+import socket
+import tempfile
+import threading
+import time
+from ulif.openoffice import jobs
+from ulif.openoffice.admission import AdmissionControl
+from ulif.openoffice.cachemanager import CacheManager
+from ulif.openoffice.jobs import (
+    Job, JobManager, SpoolQueue, main, QUEUED, RUNNING, DONE, FAILED,
+    CANCELLED)
+
+#: content of a doc expected to be expensive to convert.
+BIG_CONTENT = 'x' * 5 * 1024 * 1024
+
+
+class FakeConverter(object):
+    # replacement for `convert_doc`, blocks until `release` is set.
+
+    def __init__(self, error=None, result=True):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.error = error
+        self.result = result
+
+    def __call__(self, src_path, options, cache_dir):
+        self.calls.append((open(src_path).read(), options, cache_dir))
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        if not self.result:
+            return None, None, {'error': True, 'error-descr': 'Boom!'}
+        result_path = os.path.join(tempfile.mkdtemp(), 'result.txt')
+        with open(result_path, 'w') as fd:
+            fd.write('result')
+        self.result_path = result_path
+        return result_path, 'somekey_1_1', {'error': False}
+
+
+@pytest.fixture
+def fake_converter(monkeypatch):
+    converter = FakeConverter()
+    monkeypatch.setattr(jobs, 'convert_doc', converter)
+    return converter
+
+
+@pytest.fixture
+def job_manager(request, tmpdir):
+    manager = JobManager(str(tmpdir / "cache"), workers=1)
+    request.addfinalizer(manager.shutdown)
+    return manager
+
+
+@pytest.fixture
+def spool(tmpdir):
+    return SpoolQueue(str(tmpdir / "spool"))
+
+
+def make_src(tmpdir, name="src", content="Hi there!"):
+    # create a source doc in its own dir
+    tmpdir.mkdir(name).join("sample.txt").write(content)
+    return str(tmpdir / name / "sample.txt")
+
+
+def wait_for(manager, job_id, timeout=5):
+    # wait until job `job_id` is finished
+    for x in range(int(timeout * 100)):
+        job = manager.get(job_id)
+        if job.state not in (QUEUED, RUNNING):
+            return job
+        time.sleep(0.01)
+
+
+def owner(pid=None):
+    return '%s:%s:foo' % (socket.gethostname(), pid or os.getpid())
+
+
+class TestJob(object):
+
+    def test_as_dict(self):
+        # we can get job data as dict
+        job = Job('/src/sample.txt', {}, job_id='myid')
+        data = job.as_dict()
+        assert data['id'] == 'myid'
+        assert data['state'] == QUEUED
+        assert data['cache_key'] is None
+
+    def test_ids_unique(self):
+        # new jobs get unique ids
+        assert Job('foo', {}).id != Job('foo', {}).id
+
+    def test_dump_load(self):
+        # we can dump and load jobs
+        job = Job('/src/sample.txt', {'foo': 'bar'}, urgency=1, cost=2.5)
+        job.attempts = 2
+        data = job.dump()
+        assert data['filename'] == 'sample.txt'
+        job2 = Job.load(data, '/other/sample.txt')
+        assert job2.dump() == data
+        assert job2.src_path == '/other/sample.txt'
+
+
+class TestSpoolQueue(object):
+
+    def test_put(self, tmpdir, spool):
+        # we can put jobs into the queue
+        src = make_src(tmpdir)
+        job = spool.put(src, {'foo': 'bar'})
+        assert not os.path.exists(src)  # moved into queue
+        assert open(job.src_path).read() == 'Hi there!'
+        assert spool.count(QUEUED) == 1
+        job2 = spool.get(job.id)
+        assert job2.state == QUEUED
+        assert job2.options == {'foo': 'bar'}
+        assert job2.src_path == job.src_path
+
+    def test_put_copy(self, tmpdir, spool):
+        # we can put copies of docs into the queue
+        src = make_src(tmpdir)
+        job = spool.put(src, {}, move=False)
+        assert open(src).read() == 'Hi there!'
+        assert open(job.src_path).read() == 'Hi there!'
+
+    def test_persistent(self, tmpdir, spool):
+        # queued jobs survive
+        job = spool.put(make_src(tmpdir), {'foo': 'bar'})
+        spool2 = SpoolQueue(spool.path)
+        assert spool2.get(job.id).options == {'foo': 'bar'}
+
+    def test_get_invalid(self, spool):
+        # invalid or unknown job ids give `None`
+        assert spool.get('../../etc') is None
+        assert spool.get(None) is None
+        assert spool.get('0' * 32) is None
+
+    def test_claim(self, tmpdir, spool):
+        # jobs are claimed in order
+        job1 = spool.put(make_src(tmpdir, "src1", "one"), {})
+        job2 = spool.put(make_src(tmpdir, "src2", "two"), {})
+        claimed = spool.claim(owner())
+        assert claimed.id == job1.id
+        assert claimed.state == RUNNING
+        assert open(claimed.src_path).read() == 'one'
+        assert spool.claim(owner()).id == job2.id
+        assert spool.claim(owner()) is None
+
+    def test_put_cost(self, tmpdir, spool):
+        # the cost of jobs is estimated when queued
+        job = spool.put(make_src(tmpdir, content=BIG_CONTENT), {})
+        assert spool.get(job.id).cost == 26.6
+        assert job.urgency == 3
+
+    def test_claim_schedule(self, tmpdir, spool):
+        # cheap and urgent jobs are claimed first
+        big = spool.put(make_src(tmpdir, "src1", BIG_CONTENT), {})
+        small = spool.put(make_src(tmpdir, "src2"), {})
+        batch = spool.put(make_src(tmpdir, "src3"), {}, urgency='7')
+        urgent = spool.put(
+            make_src(tmpdir, "src4", BIG_CONTENT), {}, urgency=0)
+        assert [spool.claim(owner()).id for x in range(4)] == [
+            small.id, urgent.id, batch.id, big.id]
+
+    def test_claim_max_cost(self, tmpdir, spool):
+        # we can claim cheap jobs only
+        spool.put(make_src(tmpdir, "src1", BIG_CONTENT), {})
+        small = spool.put(make_src(tmpdir, "src2"), {})
+        assert spool.pending() == 2
+        assert spool.pending(max_cost=10) == 1
+        assert spool.claim(owner(), max_cost=10).id == small.id
+        assert spool.claim(owner(), max_cost=10) is None
+        assert spool.pending(max_cost=10) == 0
+
+    def test_finish(self, tmpdir, spool):
+        # we can finish running jobs
+        spool.put(make_src(tmpdir), {})
+        job = spool.claim(owner())
+        assert spool.finish(job, cache_key='somekey_1_1') == DONE
+        job = spool.get(job.id)
+        assert job.state == DONE
+        assert job.cache_key == 'somekey_1_1'
+        # sources are removed
+        assert os.listdir(os.path.dirname(job.src_path)) == ['job.json']
+
+    def test_finish_result(self, tmpdir, spool):
+        # results can be kept in the spool
+        spool.put(make_src(tmpdir), {})
+        job = spool.claim(owner())
+        tmpdir.mkdir("result").join("result.txt").write("result")
+        assert spool.finish(
+            job, result_path=str(tmpdir / "result" / "result.txt"),
+            metadata={'error': False}) == DONE
+        assert not (tmpdir / "result").exists()
+        job = spool.get(job.id)
+        assert job.result == 'result.txt'
+        assert job.metadata == {'error': False}
+        assert open(job.result_path).read() == 'result'
+        # sources are kept as well
+        assert open(job.src_path).read() == 'Hi there!'
+
+    def test_finish_failed(self, tmpdir, spool):
+        # jobs with errors fail
+        spool.put(make_src(tmpdir), {})
+        job = spool.claim(owner())
+        assert spool.finish(job, error='Boom!') == FAILED
+        assert spool.get(job.id).error == 'Boom!'
+
+    def test_cancel_queued(self, tmpdir, spool):
+        # we can cancel queued jobs
+        job = spool.put(make_src(tmpdir), {})
+        assert spool.cancel(job.id) is True
+        assert spool.get(job.id).state == CANCELLED
+        assert spool.claim(owner()) is None
+
+    def test_cancel_running(self, tmpdir, spool):
+        # running jobs are marked as cancelled when finished
+        spool.put(make_src(tmpdir), {})
+        job = spool.claim(owner())
+        assert spool.cancel(job.id) is True
+        assert spool.finish(job, cache_key='somekey_1_1') == CANCELLED
+        assert spool.get(job.id).cache_key is None
+
+    def test_cancel_finished(self, tmpdir, spool):
+        # finished jobs are forgotten when cancelled
+        spool.put(make_src(tmpdir), {})
+        job = spool.claim(owner())
+        spool.finish(job, cache_key='somekey_1_1')
+        assert spool.cancel(job.id) is True
+        assert spool.get(job.id) is None
+        assert spool.cancel(job.id) is False
+
+    def test_requeue_expired(self, tmpdir):
+        # jobs with expired leases are queued again
+        spool = SpoolQueue(str(tmpdir / "spool"), lease_time=0)
+        spool.put(make_src(tmpdir), {})
+        job = spool.claim(owner())
+        spool.requeue_expired()
+        job = spool.get(job.id)
+        assert job.state == QUEUED
+        assert job.attempts == 1
+        # the former owner cannot finish it any more
+        assert spool.finish(job, cache_key='somekey_1_1') is None
+        assert spool.claim(owner()).id == job.id
+
+    def test_requeue_dead_owner(self, tmpdir, spool):
+        # leases of dead local processes expire immediately
+        spool.put(make_src(tmpdir), {})
+        job = spool.claim(owner())
+        spool.requeue_expired()
+        assert spool.get(job.id).state == RUNNING
+        spool.renew(job.id, owner(pid=2 ** 22 + 1))
+        spool.requeue_expired()
+        assert spool.get(job.id).state == QUEUED
+
+    def test_recover_incoming(self, tmpdir, spool):
+        # jobs left in incoming/ by crashed processes are queued again
+        job = spool.put(make_src(tmpdir), {})
+        claimed = spool.claim(owner())
+        # crash while requeueing
+        tmp_dir = spool._job_dir('incoming', job.id)
+        os.rename(spool._job_dir(RUNNING, job.id), tmp_dir)
+        spool.requeue_expired()
+        assert os.path.isdir(tmp_dir)  # not stale yet
+        os.utime(tmp_dir, (0, 0))
+        spool.requeue_expired()
+        assert not os.path.exists(tmp_dir)
+        assert spool.get(job.id).state == QUEUED
+        assert spool.claim(owner()).id == claimed.id
+
+    def test_recover_incoming_incomplete(self, tmpdir, spool):
+        # incomplete jobs left in incoming/ are removed
+        tmp_dir = tmpdir / 'spool' / 'incoming' / ('0' * 32)
+        tmp_dir.mkdir().join('sample.txt').write('Hi there!')
+        os.utime(str(tmp_dir), (0, 0))
+        spool.requeue_expired()
+        assert not tmp_dir.exists()
+        assert spool.claim(owner()) is None
+
+    def test_claim_reads_job_once(self, tmpdir, spool, monkeypatch):
+        # job data of queued jobs is read only once
+        job1 = spool.put(make_src(tmpdir, "src1", "one"), {})
+        spool.put(make_src(tmpdir, "src2", "two"), {})
+        assert spool.pending() == 2
+        loaded = []
+        load = spool._load
+        monkeypatch.setattr(spool, '_load', lambda state, job_id: (
+            loaded.append((state, job_id)) or load(state, job_id)))
+        assert spool.claim(owner()).id == job1.id
+        assert loaded == [(RUNNING, job1.id)]
+        assert spool.pending() == 1
+
+    def test_max_attempts(self, tmpdir):
+        # jobs fail after too many attempts
+        spool = SpoolQueue(str(tmpdir / "spool"), lease_time=0,
+                           max_attempts=2)
+        job = spool.put(make_src(tmpdir), {})
+        for num in range(2):
+            spool.claim(owner())
+            spool.requeue_expired()
+        job = spool.get(job.id)
+        assert job.state == FAILED
+        assert job.error == 'too many attempts'
+
+    def test_max_finished(self, tmpdir):
+        # we keep only a limited number of finished jobs
+        spool = SpoolQueue(str(tmpdir / "spool"), max_finished=1)
+        job1 = spool.put(make_src(tmpdir, "src1"), {})
+        job2 = spool.put(make_src(tmpdir, "src2"), {})
+        spool.finish(spool.claim(owner()), cache_key='somekey_1_1')
+        os.utime(spool._job_dir(DONE, job1.id), (0, 0))
+        spool.finish(spool.claim(owner()), cache_key='somekey_1_1')
+        assert spool.get(job1.id) is None
+        assert spool.get(job2.id).state == DONE
+
+
+class TestJobManager(object):
+
+    def test_no_cache_dir(self):
+        # we need a cache dir
+        with pytest.raises(ValueError):
+            JobManager(None)
+
+    def test_submit(self, tmpdir, job_manager, fake_converter):
+        # we can submit jobs that are done in background
+        src = make_src(tmpdir)
+        job = job_manager.submit(src, {'foo': 'bar'})
+        assert not os.path.exists(os.path.dirname(src))
+        assert fake_converter.started.wait(5)
+        assert job_manager.get(job.id).state == RUNNING
+        fake_converter.release.set()
+        job = wait_for(job_manager, job.id)
+        assert job.state == DONE
+        assert job.cache_key == 'somekey_1_1'
+        assert fake_converter.calls == [
+            ('Hi there!', {'foo': 'bar'}, str(tmpdir / "cache"))]
+        # results were removed
+        assert not os.path.exists(fake_converter.result_path)
+
+    def test_admission(self, request, tmpdir, fake_converter):
+        # with admission control, jobs wait for free slots
+        admission = AdmissionControl(max_active=1, max_queue=0)
+        manager = JobManager(
+            str(tmpdir / "cache"), workers=1, admission=admission)
+        request.addfinalizer(manager.shutdown)
+        fake_converter.release.set()
+        with admission.admit():
+            job = manager.submit(make_src(tmpdir), {})
+            for x in range(500):
+                if admission.waiting:
+                    break
+                time.sleep(0.01)
+            # waiting as background work, not filling the queue
+            assert admission.waiting == 1
+            assert admission.queued == 0
+            assert admission._waiters[0].urgency == 7
+            assert manager.get(job.id).state == RUNNING
+            assert fake_converter.calls == []
+        assert wait_for(manager, job.id).state == DONE
+
+    def test_failed(self, tmpdir, job_manager, fake_converter):
+        # failed conversions result in failed jobs
+        fake_converter.result = False
+        fake_converter.release.set()
+        job = job_manager.submit(make_src(tmpdir), {})
+        job = wait_for(job_manager, job.id)
+        assert job.state == FAILED
+        assert job.error == 'Boom!'
+
+    def test_exception(self, tmpdir, job_manager, fake_converter):
+        # exceptions result in failed jobs
+        fake_converter.error = ValueError('Oops!')
+        fake_converter.release.set()
+        job = job_manager.submit(make_src(tmpdir), {})
+        job = wait_for(job_manager, job.id)
+        assert job.state == FAILED
+        assert job.error == 'Oops!'
+
+    def test_bounded(self, tmpdir, job_manager, fake_converter):
+        # only `workers` jobs run at the same time
+        job1 = job_manager.submit(make_src(tmpdir, "src1"), {})
+        job2 = job_manager.submit(make_src(tmpdir, "src2"), {})
+        assert fake_converter.started.wait(5)
+        assert job_manager.get(job1.id).state == RUNNING
+        assert job_manager.get(job2.id).state == QUEUED
+        fake_converter.release.set()
+        assert wait_for(job_manager, job2.id).state == DONE
+
+    def test_cancel_queued(self, tmpdir, job_manager, fake_converter):
+        # queued jobs can be cancelled
+        job1 = job_manager.submit(make_src(tmpdir, "src1"), {})
+        job2 = job_manager.submit(make_src(tmpdir, "src2"), {})
+        assert fake_converter.started.wait(5)
+        assert job_manager.cancel(job2.id) is True
+        assert job_manager.get(job2.id).state == CANCELLED
+        fake_converter.release.set()
+        wait_for(job_manager, job1.id)
+        job_manager.shutdown()
+        assert len(fake_converter.calls) == 1
+
+    def test_cancel_running(self, tmpdir, job_manager, fake_converter):
+        # running jobs are not interrupted, but results discarded
+        job = job_manager.submit(make_src(tmpdir), {})
+        assert fake_converter.started.wait(5)
+        assert job_manager.cancel(job.id) is True
+        fake_converter.release.set()
+        job_manager.shutdown()
+        job = job_manager.get(job.id)
+        assert job.state == CANCELLED
+        assert job.cache_key is None
+
+    def test_resume(self, tmpdir, fake_converter):
+        # jobs queued before a restart are run
+        spool = SpoolQueue(str(tmpdir / "cache" / ".jobs"))
+        job = spool.put(make_src(tmpdir), {})
+        fake_converter.release.set()
+        manager = JobManager(str(tmpdir / "cache"), poll_interval=0.01)
+        assert wait_for(manager, job.id).state == DONE
+        manager.shutdown()
+
+    def test_resume_running(self, tmpdir, fake_converter):
+        # jobs running in dead processes are run again
+        spool = SpoolQueue(str(tmpdir / "cache" / ".jobs"))
+        job = spool.put(make_src(tmpdir), {})
+        spool.claim(owner(pid=2 ** 22 + 1))
+        fake_converter.release.set()
+        manager = JobManager(str(tmpdir / "cache"), poll_interval=0.01)
+        job = wait_for(manager, job.id)
+        manager.shutdown()
+        assert job.state == DONE
+        assert job.attempts == 1
+
+    def test_keep_results(self, tmpdir, fake_converter):
+        # workers can keep results in spool
+        fake_converter.release.set()
+        manager = JobManager(
+            None, spool_dir=str(tmpdir / "spool"), keep_results=True)
+        job = manager.submit(make_src(tmpdir), {})
+        job = wait_for(manager, job.id)
+        manager.shutdown()
+        assert job.state == DONE
+        assert job.cache_key is None
+        assert open(job.result_path).read() == 'result'
+        assert not os.path.exists(fake_converter.result_path)
+
+    def test_get_stores_results(self, tmpdir, fake_converter):
+        # results kept in spool are stored in cache of job managers
+        fake_converter.release.set()
+        worker = JobManager(
+            None, spool_dir=str(tmpdir / "spool"), keep_results=True,
+            poll_interval=0.01)
+        manager = JobManager(
+            str(tmpdir / "cache"), workers=0, spool_dir=str(tmpdir / "spool"))
+        job = manager.submit(make_src(tmpdir), {})
+        worker.start()
+        job = wait_for(manager, job.id)
+        worker.shutdown()
+        assert job.state == DONE
+        cached = CacheManager(str(tmpdir / "cache")).get_cached_file(
+            job.cache_key)
+        assert open(cached).read() == 'result'
+        assert manager.get(job.id).cache_key == job.cache_key
+
+    def test_no_workers(self, tmpdir, fake_converter):
+        # job managers without workers only queue jobs
+        manager = JobManager(
+            None, workers=0, spool_dir=str(tmpdir / "spool"))
+        job = manager.submit(make_src(tmpdir), {})
+        manager.start()
+        time.sleep(0.05)
+        assert manager.get(job.id).state == QUEUED
+        assert fake_converter.calls == []
+
+
+class TestJobManagerConvert(object):
+
+    @pytest.fixture
+    def worker(self, request, tmpdir, fake_converter):
+        fake_converter.release.set()
+        worker = JobManager(
+            None, spool_dir=str(tmpdir / "spool"), keep_results=True,
+            poll_interval=0.01)
+        worker.start()
+        request.addfinalizer(worker.shutdown)
+        return worker
+
+    @pytest.fixture
+    def manager(self, tmpdir):
+        return JobManager(
+            None, workers=0, spool_dir=str(tmpdir / "spool"),
+            poll_interval=0.01)
+
+    def test_convert(self, tmpdir, worker, manager):
+        # we can let workers convert docs synchronously
+        src = make_src(tmpdir)
+        result_path, cache_key, metadata = manager.convert(
+            src, {'foo': 'bar'}, str(tmpdir / "cache"))
+        assert open(result_path).read() == 'result'
+        assert metadata == {'error': False}
+        assert os.path.exists(src)
+        cached = CacheManager(str(tmpdir / "cache")).get_cached_file(
+            cache_key)
+        assert open(cached).read() == 'result'
+        # jobs are forgotten afterwards
+        assert manager.queue.count(DONE) == 0
+
+    def test_convert_no_cache(self, tmpdir, worker, manager):
+        # without cache dir we get no cache key
+        result_path, cache_key, metadata = manager.convert(
+            make_src(tmpdir), {}, None)
+        assert open(result_path).read() == 'result'
+        assert cache_key is None
+
+    def test_convert_failed(self, tmpdir, fake_converter, worker, manager):
+        # we get the metadata of failed conversions
+        fake_converter.result = False
+        assert manager.convert(make_src(tmpdir), {}, None) == (
+            None, None, {'error': True, 'error-descr': 'Boom!'})
+
+    def test_convert_timeout(self, tmpdir, manager):
+        # jobs not done in time are cancelled
+        assert manager.convert(make_src(tmpdir), {}, None, timeout=0.1) == (
+            None, None, {'error': True, 'error-descr': 'conversion timed out'})
+        assert manager.queue.count(CANCELLED) == 1
+
+
+class TestMain(object):
+
+    def test_burst(self, tmpdir, fake_converter):
+        # we can process queued jobs and exit
+        fake_converter.release.set()
+        spool = SpoolQueue(str(tmpdir / "spool"))
+        job = spool.put(make_src(tmpdir), {'foo': 'bar'})
+        main([str(tmpdir / "spool"), '--burst', '--poll-interval', '0.01'])
+        job = spool.get(job.id)
+        assert job.state == DONE
+        assert open(job.result_path).read() == 'result'
+        assert fake_converter.calls == [('Hi there!', {'foo': 'bar'}, None)]
+
+    def test_help(self, capsys):
+        # we provide help
+        with pytest.raises(SystemExit):
+            main(['--help'])
+        out, err = capsys.readouterr()
+        assert out.startswith('usage: oooworker')
@@ -1,6 +1,8 @@
 # tests for oooctl module
+import json
 import pytest
-from ulif.openoffice.oooctl import get_options
+import sys
+from ulif.openoffice.oooctl import get_options, get_status, get_supervisor
 
 
 class TestOOOCtl(object):
@@ -10,6 +12,62 @@ class TestOOOCtl(object):
         assert cmd == "start"
         assert options.binarypath is not None
         assert options.pidfile == "/tmp/ooodaemon.pid"
+        assert options.port == 2002
+        assert options.instances == 1
+        assert options.statefile == "/tmp/ooodaemon.json"
+
+    def test_get_options_officepath(self):
+        # we can set the path to the office binary
+        cmd, options = get_options([
+            "fakeoooctl", "-b", sys.executable, "-o", sys.executable,
+            "start"])
+        assert options.officepath == sys.executable
+        with pytest.raises(SystemExit):
+            get_options([
+                "fakeoooctl", "-b", sys.executable, "-o", "/not/existing",
+                "start"])
+
+    def test_get_supervisor(self):
+        # we get a supervisor configured by options
+        cmd, options = get_options([
+            "fakeoooctl", "-b", sys.executable, "--instances=2", "--port=2010",
+            "--max-conversions=100", "--max-rss=512", "start"])
+        supervisor = get_supervisor(options)
+        assert supervisor.size == 2
+        assert supervisor.port == 2010
+        assert supervisor.policy.max_conversions == 100
+        assert supervisor.policy.max_rss == 512 * 1024
+        assert supervisor.policy.max_age is None
+        assert supervisor.profile_dir == "/tmp/ooodaemon-profiles"
+        assert len(supervisor.warmup) == 7
+
+    def test_get_options_warmup(self):
+        # we can set warm-up conversions
+        cmd, options = get_options([
+            "fakeoooctl", "-b", sys.executable, "--warmup=calc:pdf",
+            "start"])
+        assert options.warmup == [('calc', 'pdf')]
+        cmd, options = get_options([
+            "fakeoooctl", "-b", sys.executable, "--warmup=", "start"])
+        assert options.warmup == []
+        with pytest.raises(SystemExit):
+            get_options([
+                "fakeoooctl", "-b", sys.executable, "--warmup=foo:pdf",
+                "start"])
+
+    def test_get_status(self, tmpdir):
+        # we can tell which instances are ready
+        path = tmpdir / "state.json"
+        assert get_status(str(path)) == []
+        path.write(json.dumps(dict(pid=1, instances=[
+            dict(host='localhost', port=2002, pipe='ulif_openoffice_2002',
+                 pid=10, state='ready', conversions=3),
+            dict(host='localhost', port=2003, pipe=None, pid=11,
+                 state='warming', conversions=0)])))
+        assert get_status(str(path)) == [
+            'localhost:2002 ready (PID 10, 3 conversions), '
+            'pipe ulif_openoffice_2002',
+            'localhost:2003 warming (PID 11, 0 conversions)']
 
     def test_get_options_no_argv(self):
         with pytest.raises(SystemExit) as why:
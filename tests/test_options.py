@@ -4,7 +4,8 @@ import pytest
 from ulif.openoffice.helpers import string_to_stringtuple
 from ulif.openoffice.options import (
     dict_to_argtuple, Argument, ArgumentParserError,
-    ExceptionalArgumentParser, Options, )
+    ExceptionalArgumentParser, Options, get_default_parser,
+    get_default_values, )
 from ulif.openoffice.processor import DEFAULT_PROCORDER
 
 
@@ -21,6 +22,20 @@ class TestHelpers(object):
             {'y': '2', 'x': '1'}) == ('-x', '1', '-y', '2')
 
 
+    def test_get_default_values(self):
+        # we get a fresh copy of default values on each call
+        values = get_default_values()
+        assert values['oocp_output_format'] == 'html'
+        values['oocp_output_format'] = 'pdf'
+        assert get_default_values()['oocp_output_format'] == 'html'
+
+    def test_get_default_parser(self):
+        # the default parser is built only once
+        parser = get_default_parser()
+        assert isinstance(parser, ExceptionalArgumentParser)
+        assert parser is get_default_parser()
+
+
 class TestArgument(object):
     # tests for ulif.openoffice Argument class
     def test_regular(self):
@@ -76,8 +91,8 @@ class TestOptions(object):
         opts = Options()
         avail_procs = opts.avail_procs
         core_procs = [
-            'css_cleaner', 'error', 'html_cleaner', 'meta', 'oocp', 'tidy',
-            'unzip', 'zip',
+            'css_cleaner', 'error', 'html_cleaner', 'meta', 'oocp', 'probe',
+            'tidy', 'unzip', 'zip',
             ]
         for name in core_procs:
             assert name in avail_procs
@@ -106,6 +121,12 @@ class TestOptions(object):
         # default options can be overridden
         assert opts['oocp_pdf_version'] is True
 
+    def test_options_do_not_share_values(self):
+        # modifying options does not touch other options
+        opts1 = Options()
+        opts1['oocp_output_format'] = 'pdf'
+        assert Options()['oocp_output_format'] == 'html'
+
     def test_val_dict_overrides_string_dict(self):
         # val_dict values will override string_dict values
         opts = Options(
@@ -140,5 +161,7 @@ class TestOptions(object):
             'css-cleaner-min', 'css-cleaner-prettify',
             'html-cleaner-fix-head-nums', 'html-cleaner-fix-img-links',
             'html-cleaner-fix-sd-fields', 'meta-procord',
-            'oocp-host', 'oocp-out-fmt', 'oocp-pdf-tagged',
-            'oocp-pdf-version', 'oocp-port']
+            'oocp-host', 'oocp-native-txt', 'oocp-out-fmt',
+            'oocp-pdf-tagged', 'oocp-pdf-version', 'oocp-port',
+            'unzip-max-ratio', 'unzip-max-size', 'zip-level',
+            'zip-store-compressed', 'zip-threads']
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# tests for probe module
+from __future__ import unicode_literals
+import os
+import zipfile
+from ulif.openoffice.probe import (
+    probe, probe_document, estimate_cost, NS_DC, NS_EP, NS_S, OLE_MAGIC,
+    OLE_ENCRYPTED)
+
+
+def make_doc(path, parts):
+    """Create a ZIP file in `path` with `parts`, a dict name -> content.
+    """
+    with zipfile.ZipFile(str(path), 'w') as zf:
+        for name, content in parts.items():
+            zf.writestr(name, content.encode('utf-8'))
+    return str(path)
+
+
+def make_pdf(path, catalog=b'/Type /Catalog /Pages 2 0 R',
+             trailer=b'/Root 1 0 R /Info 3 0 R'):
+    """Create a (very) minimal PDF document in `path`.
+    """
+    objects = [
+        catalog,
+        b'/Type /Pages /Kids [] /Count 3',
+        b'/Title (A \\(nice\\) \\374ber doc) /Author <FEFF0041006E006E>',
+        ]
+    data = b'%PDF-1.4\n'
+    for num, obj in enumerate(objects):
+        data += ('%d 0 obj\n<< ' % (num + 1)).encode('ascii')
+        data += obj + b' >>\nendobj\n'
+    data += b'trailer\n<< /Size 4 ' + trailer + b' >>\n%%EOF\n'
+    path.write_binary(data)
+    return str(path)
+
+
+def path_of(filename):
+    return os.path.join(os.path.dirname(__file__), 'input', filename)
+
+
+class TestProbeDocument(object):
+
+    def test_odt(self):
+        # we can probe ODF docs
+        result = probe_document(path_of('image_sample.odt'))
+        assert result['format'] == 'odf'
+        assert result['author'] == 'Uli Fouquet'
+        assert result['encrypted'] is False
+        assert result['sheets'] is None
+
+    def test_odt_statistics(self):
+        # we get page and word counts of ODF docs
+        result = probe_document(path_of('sample-font-props.odt'))
+        assert result['pages'] == 1
+        assert result['words'] == 117
+
+    def test_docx(self, tmpdir):
+        # we can probe Word docs
+        path = make_doc(tmpdir / "sample.docx", {
+            '[Content_Types].xml': '<Types/>',
+            'docProps/core.xml': (
+                '<cp:coreProperties xmlns:cp="urn:x" xmlns:dc="%s">'
+                '<dc:title>Tütle</dc:title><dc:creator>Me</dc:creator>'
+                '</cp:coreProperties>') % NS_DC,
+            'docProps/app.xml': (
+                '<Properties xmlns="%s"><Pages>12</Pages>'
+                '<Words>1234</Words></Properties>') % NS_EP,
+            })
+        result = probe_document(path)
+        assert result['format'] == 'ooxml'
+        assert result['title'] == 'Tütle'
+        assert result['author'] == 'Me'
+        assert result['pages'] == 12
+        assert result['words'] == 1234
+
+    def test_xlsx(self, tmpdir):
+        # we get sheet names of workbooks
+        path = make_doc(tmpdir / "sample.xlsx", {
+            '[Content_Types].xml': '<Types/>',
+            'xl/workbook.xml': (
+                '<workbook xmlns="%s"><sheets><sheet name="One"/>'
+                '<sheet name="Two"/></sheets></workbook>') % NS_S,
+            })
+        result = probe_document(path)
+        assert result['sheets'] == ['One', 'Two']
+
+    def test_pptx(self, tmpdir):
+        # slides count as pages
+        path = make_doc(tmpdir / "sample.pptx", {
+            '[Content_Types].xml': '<Types/>',
+            'docProps/app.xml': (
+                '<Properties xmlns="%s"><Slides>7</Slides>'
+                '</Properties>') % NS_EP,
+            })
+        result = probe_document(path)
+        assert result['slides'] == 7
+        assert result['pages'] == 7
+
+    def test_pdf(self, tmpdir):
+        # we can probe PDF docs
+        result = probe_document(make_pdf(tmpdir / "sample.pdf"))
+        assert result['format'] == 'pdf'
+        assert result['pages'] == 3
+        assert result['title'] == 'A (nice) über doc'
+        assert result['author'] == 'Ann'
+        assert result['encrypted'] is False
+
+    def test_pdf_encrypted(self, tmpdir):
+        # we detect encrypted PDFs and do not read encrypted strings
+        result = probe_document(make_pdf(
+            tmpdir / "sample.pdf",
+            trailer=b'/Root 1 0 R /Info 3 0 R /Encrypt 4 0 R'))
+        assert result['encrypted'] is True
+        assert result['pages'] == 3
+        assert result['title'] is None
+
+    def test_pdf_broken(self, tmpdir):
+        # we cope with missing objects
+        result = probe_document(make_pdf(
+            tmpdir / "sample.pdf", catalog=b'/Type /Catalog'))
+        assert result['format'] == 'pdf'
+        assert result['pages'] is None
+
+    def test_ole(self, tmpdir):
+        # legacy MS Office docs are detected, but not inspected
+        result = probe_document(path_of('testdoc1.doc'))
+        assert result['format'] == 'ole'
+        assert result['encrypted'] is False
+
+    def test_ooxml_encrypted(self, tmpdir):
+        # encrypted OOXML docs are stored in OLE containers
+        tmpdir.join("sample.docx").write_binary(
+            OLE_MAGIC + b'\x00' * 100 + OLE_ENCRYPTED)
+        result = probe_document(str(tmpdir / "sample.docx"))
+        assert result['format'] == 'ooxml'
+        assert result['encrypted'] is True
+
+    def test_unknown(self, tmpdir):
+        # other docs are reported as unknown
+        tmpdir.join("sample.txt").write("Hi there!")
+        result = probe_document(str(tmpdir / "sample.txt"))
+        assert result['format'] == 'unknown'
+        assert result['size'] == 9
+        assert result['cost'] == 1.2
+
+    def test_broken_zip(self, tmpdir):
+        # broken docs give what we found so far
+        tmpdir.join("sample.odt").write_binary(b'PK\x03\x04broken')
+        result = probe_document(str(tmpdir / "sample.odt"))
+        assert result['format'] == 'unknown'
+
+    def test_corrupt_member(self, tmpdir):
+        # docs with corrupt members give what we found so far
+        path = str(tmpdir / "sample.odt")
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('mimetype', 'application/vnd.oasis.opendocument.text')
+            zf.writestr('meta.xml', '<office:document-meta/>' * 100)
+            info = zf.getinfo('meta.xml')
+        with open(path, 'r+b') as fd:
+            # overwrite start of the deflate data of meta.xml
+            fd.seek(info.header_offset + 30 + len('meta.xml'))
+            fd.write(b'\xff' * 8)
+        result = probe_document(path)
+        assert result['format'] == 'odf'
+        assert result['author'] is None
+        assert result['cost'] > 0
+
+
+class TestEstimateCost(object):
+
+    def test_pages(self):
+        # pages add to costs
+        assert estimate_cost(dict(size=0, pages=0)) == 1.0
+        assert estimate_cost(dict(size=0, pages=10)) == 3.0
+
+    def test_size(self):
+        # size adds to costs
+        assert estimate_cost(dict(size=1024 * 1024, pages=0)) == 2.0
+
+    def test_pages_unknown(self):
+        # we guess pages from size if unknown
+        assert estimate_cost(dict(size=100 * 1024, pages=None)) == 1.7
+
+
+class TestProbe(object):
+
+    def test_no_cache(self, tmpdir):
+        # without cache dir we just probe
+        tmpdir.join("sample.txt").write("Hi there!")
+        result = probe(str(tmpdir / "sample.txt"))
+        assert result['size'] == 9
+        assert not tmpdir.join(".probe").exists()
+
+    def test_cache(self, tmpdir):
+        # results are cached by doc contents
+        tmpdir.join("sample.txt").write("Hi there!")
+        tmpdir.join("other.txt").write("Hi there!")
+        cache_dir = tmpdir / "cache"
+        result1 = probe(str(tmpdir / "sample.txt"), str(cache_dir))
+        assert len(cache_dir.join(".probe").listdir()) == 1
+        cache_dir.join(".probe").listdir()[0].write(
+            '{"format": "cached"}')
+        result2 = probe(str(tmpdir / "other.txt"), str(cache_dir))
+        assert result1['format'] == 'unknown'
+        assert result2 == {'format': 'cached'}
@@ -24,13 +24,21 @@ import codecs
 import os
 import pytest
 import shutil
+import signal
 import tempfile
+import threading
+import time
 import zipfile
 from argparse import ArgumentParser
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from ulif.openoffice import convert
+from ulif.openoffice.endpoints import set_endpoints
 from ulif.openoffice.options import ArgumentParserError, Options
 from ulif.openoffice.processor import (
     BaseProcessor, MetaProcessor, OOConvProcessor, UnzipProcessor,
-    ZipProcessor, Tidy, CSSCleaner, HTMLCleaner, Error, processor_order)
+    ZipProcessor, Tidy, CSSCleaner, HTMLCleaner, Error, ProbeProcessor,
+    PostprocPool, processor_order, set_postproc_pool, get_postproc_pool)
 from ulif.openoffice.testing import (
     TestOOServerSetup, ConvertLogCatcher, envpath_wo_virtualenvs)
 
@@ -70,6 +78,140 @@ class TestProcessorHelpers(object):
             processor_order('unzip, invalid, zip')
 
 
+def kill_worker():
+    # let a pool worker die like killed by the OOM killer
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+class KillingProcessor(BaseProcessor):
+    # a CPU-bound processor killing its worker process
+    prefix = 'html_cleaner'
+    cpu_bound = True
+
+    def process(self, path, metadata):
+        kill_worker()
+
+
+class TestPostprocPool(object):
+
+    def test_run(self):
+        # we can run functions in worker processes
+        pool = PostprocPool(1)
+        try:
+            assert pool.run(os.getpid) != os.getpid()
+        finally:
+            pool.shutdown()
+
+    def test_run_max_tasks(self):
+        # workers are replaced after `max_tasks` tasks
+        pool = PostprocPool(1, max_tasks=2)
+        try:
+            pids = [pool.run(os.getpid) for num in range(4)]
+        finally:
+            pool.shutdown()
+        assert pids[0] == pids[1]
+        assert pids[2] == pids[3]
+        assert pids[1] != pids[2]
+
+    def test_run_worker_died(self):
+        # dying workers do not block us, the next task gets new ones
+        pool = PostprocPool(1)
+        try:
+            with pytest.raises(BrokenProcessPool):
+                pool.run(kill_worker)
+            assert pool.run(os.getpid) != os.getpid()
+        finally:
+            pool.shutdown()
+
+    def test_run_timeout(self):
+        # hanging workers are killed after `timeout` seconds
+        pool = PostprocPool(1, timeout=0.5)
+        try:
+            with pytest.raises(FutureTimeoutError):
+                pool.run(time.sleep, 30)
+            assert pool.run(os.getpid) != os.getpid()
+        finally:
+            pool.shutdown()
+
+    def test_run_concurrent(self):
+        # tasks submitted while the executor is renewed do not fail
+        pool = PostprocPool(1, max_tasks=1)
+        errors = []
+
+        def run():
+            try:
+                pool.run(os.getpid)
+            except Exception as exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=run) for num in range(8)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            pool.shutdown()
+        assert errors == []
+
+    def test_set_postproc_pool_keep(self):
+        # apps can share a pool instead of replacing it
+        try:
+            pool = set_postproc_pool(2)
+            assert set_postproc_pool(1, replace=False) is pool
+            assert set_postproc_pool(3, replace=False) is not pool
+            assert get_postproc_pool().size == 3
+        finally:
+            set_postproc_pool(0)
+
+    def test_process_worker_died(self, workdir, samples_dir, monkeypatch):
+        # processors killing their worker make processing fail
+        samples_dir.join("sample3.html").copy(workdir / "src" / "sample.html")
+        proc = MetaProcessor(options={'meta-procord': 'html_cleaner'})
+        monkeypatch.setattr(
+            MetaProcessor, 'avail_procs', dict(html_cleaner=KillingProcessor))
+        try:
+            set_postproc_pool(1)
+            resultpath, metadata = proc.process(
+                str(workdir / "src" / "sample.html"))
+        finally:
+            set_postproc_pool(0)
+        assert resultpath is None
+        assert metadata['error'] is True
+        assert metadata['error-descr'] == (
+            'worker process died while processing html_cleaner')
+
+    def test_set_postproc_pool(self):
+        # we can set up and disable a pool for CPU-bound processors
+        try:
+            pool = set_postproc_pool(1, max_tasks=2)
+            assert pool is not None
+            assert get_postproc_pool() is pool
+        finally:
+            assert set_postproc_pool(0) is None
+        assert get_postproc_pool() is None
+
+    def test_cpu_bound_processors(self):
+        # only pure-python processors are marked as CPU-bound
+        assert HTMLCleaner.cpu_bound is True
+        assert CSSCleaner.cpu_bound is True
+        assert OOConvProcessor.cpu_bound is False
+        assert BaseProcessor.cpu_bound is False
+
+    def test_process_in_pool(self, workdir, samples_dir):
+        # CPU-bound processors are run in the pool, if set
+        samples_dir.join("sample3.html").copy(workdir / "src" / "sample.html")
+        proc = MetaProcessor(options={'meta-procord': 'html_cleaner'})
+        try:
+            set_postproc_pool(1, max_tasks=1)
+            resultpath, metadata = proc.process(
+                str(workdir / "src" / "sample.html"))
+        finally:
+            set_postproc_pool(0)
+        assert metadata['error'] is False
+        contents = codecs.open(resultpath, 'r', 'utf-8').read()
+        assert u'<span class="u-o-headnum">1</span>Häding1' in contents
+
+
 class TestBaseProcessor(object):
 
     def test_process_raises_not_implemented(self):
@@ -119,10 +261,16 @@ class TestMetaProcessor(object):
             "meta_processor_order=('unzip', 'oocp', 'tidy', 'html_cleaner', "
             "'css_cleaner', 'zip')"
             "oocp_hostname=localhost"
+            "oocp_native_text=True"
             "oocp_output_format=html"
             "oocp_pdf_tagged=False"
             "oocp_pdf_version=False"
             "oocp_port=2002"
+            "unzip_max_ratio=100"
+            "unzip_max_size=512"
+            "zip_compression_level=6"
+            "zip_store_compressed=True"
+            "zip_threads=0"
         )
 
     def test_options_invalid(self):
@@ -389,6 +537,45 @@ class TestOOConvProcessor(TestOOServerSetup):
         assert self.result_path is None
         return
 
+    def test_process_txt_native(self):
+        # text from ODF docs is extracted without LibreOffice
+        proc = OOConvProcessor(options={'oocp-out-fmt': 'txt'})
+        sample_file = os.path.join(self.workdir, 'sample.odt')
+        shutil.copy(os.path.join(
+            os.path.dirname(__file__), 'input', 'sample-font-props.odt'),
+            sample_file)
+        with self.failing_unoconv_context():
+            self.result_path, meta = proc.process(sample_file, {})
+        assert meta['oocp_status'] == 0
+        assert self.result_path.endswith('sample.txt')
+        with codecs.open(self.result_path, 'r', encoding='utf-8') as fd:
+            assert 'Sample Font Characteristics\n' in fd.read()
+        dir_list = os.listdir(os.path.dirname(self.result_path))
+        assert 'sample.odt' not in dir_list
+
+    def test_process_txt_native_disabled(self):
+        # we can force text extraction via LibreOffice
+        proc = OOConvProcessor(options={
+            'oocp-out-fmt': 'txt', 'oocp-native-txt': 'no'})
+        sample_file = os.path.join(self.workdir, 'sample.odt')
+        shutil.copy(os.path.join(
+            os.path.dirname(__file__), 'input', 'sample-font-props.odt'),
+            sample_file)
+        with self.failing_unoconv_context():
+            self.result_path, meta = proc.process(sample_file, {})
+        assert meta['oocp_status'] == 1
+
+    def test_process_txt_fallback(self):
+        # legacy formats are converted by LibreOffice
+        proc = OOConvProcessor(options={'oocp-out-fmt': 'txt'})
+        sample_file = os.path.join(self.workdir, 'sample.doc')
+        shutil.copy(os.path.join(
+            os.path.dirname(__file__), 'input', 'simpledoc1.doc'),
+            sample_file)
+        with self.failing_unoconv_context():
+            self.result_path, meta = proc.process(sample_file, {})
+        assert meta['oocp_status'] == 1
+
     def test_pdf_props_wo_pdf_out(self):
         # PDF props are set only when pdf output format is required
         proc = OOConvProcessor(
@@ -432,18 +619,60 @@ class TestOOConvProcessor(TestOOServerSetup):
                           'oocp_pdf_tagged': False,
                           'oocp_hostname': 'localhost',
                           'oocp_port': 2002,
+                          'oocp_native_text': True,
                           }
         # explicitly set value (different from default)
         result = vars(parser.parse_args(['-oocp-out-fmt', 'pdf',
                                          '-oocp-pdf-version', '1',
                                          '-oocp-pdf-tagged', '1',
                                          '-oocp-host', 'example.com',
-                                         '-oocp-port', '1234', ]))
+                                         '-oocp-port', '1234',
+                                         '-oocp-native-txt', 'no', ]))
         assert result == {'oocp_output_format': 'pdf',
                           'oocp_pdf_version': True,
                           'oocp_pdf_tagged': True,
                           'oocp_hostname': 'example.com',
-                          'oocp_port': 1234}
+                          'oocp_port': 1234,
+                          'oocp_native_text': False}
+
+
+class TestOOConvProcessorEndpoints(object):
+    # tests for OOConvProcessor with a pool of office servers
+
+    @pytest.fixture(autouse=True)
+    def endpoints_reset(self, request):
+        request.addfinalizer(set_endpoints)
+
+    def test_process_in_pool(self, workdir, monkeypatch):
+        # with a pool set, conversions are done at its endpoints
+        urls = []
+
+        def fake_convert(url=None, path=None, out_dir=None, **kw):
+            urls.append(url)
+            result_path = os.path.splitext(path)[0] + '.html'
+            with open(result_path, 'w') as fd:
+                fd.write('Converted')
+            return 0, result_path
+        monkeypatch.setattr(convert, 'convert', fake_convert)
+        set_endpoints('office1:2003')
+        proc = OOConvProcessor()
+        result_path, meta = proc.process(
+            str(workdir / "src" / "sample.txt"), {})
+        assert meta['oocp_status'] == 0
+        assert urls == [
+            'socket,host=office1,port=2003;urp;StarOffice.ComponentContext']
+
+    def test_process_no_endpoint(self, workdir):
+        # without healthy endpoints we get an error
+        pool = set_endpoints('office1:2003')
+        pool.endpoints[0].open_until = time.time() + 60
+        proc = OOConvProcessor()
+        result_path, meta = proc.process(
+            str(workdir / "src" / "sample.txt"), {})
+        assert result_path is None
+        assert meta['error'] is True
+        assert meta['oocp_status'] is None
+        assert meta['error-descr'] == 'no office server available'
 
 
 class TestUnzipProcessor(object):
@@ -479,10 +708,49 @@ class TestUnzipProcessor(object):
                 arg.short_name, arg.long_name, **arg.keywords)
         result = vars(parser.parse_args([]))
         # defaults
-        assert result == {}
+        assert result == {'unzip_max_size': 512, 'unzip_max_ratio': 100}
         # explicitly set value (different from default)
-        result = vars(parser.parse_args([]))
-        assert result == {}
+        result = vars(parser.parse_args(
+            ['-unzip-max-size', '1', '-unzip-max-ratio', '0']))
+        assert result == {'unzip_max_size': 1, 'unzip_max_ratio': 0}
+
+    def test_one_file_only_not_extracted(self, workdir, samples_dir,
+                                         monkeypatch):
+        # ambiguous zip files are rejected before extraction
+        def fake_unzip(*args, **kw):
+            raise AssertionError('unzip() called')
+        monkeypatch.setattr('ulif.openoffice.processor.unzip', fake_unzip)
+        proc = UnzipProcessor()
+        result_path, metadata = proc.process(
+            str(samples_dir / "sample1.zip"), {'error': False})
+        assert metadata['error-descr'] == 'ambiguity problem: several files'
+        assert result_path is None
+
+    def test_max_size(self, workdir):
+        # zip files with too much content are rejected
+        zip_path = str(workdir / "sample.zip")
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('sample.txt', 'A' * (1024 * 1024 + 1))
+        proc = UnzipProcessor(options={
+            'unzip-max-size': '1', 'unzip-max-ratio': '0'})
+        result_path, metadata = proc.process(zip_path, {'error': False})
+        assert metadata['error'] is True
+        assert 'too big' in metadata['error-descr']
+        assert result_path is None
+
+    def test_max_ratio(self, workdir):
+        # zip files with suspicious compression ratios are rejected
+        zip_path = str(workdir / "sample.zip")
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('sample.txt', 'A' * 100000)
+        proc = UnzipProcessor()
+        result_path, metadata = proc.process(zip_path, {'error': False})
+        assert metadata['error'] is True
+        assert 'ratio' in metadata['error-descr']
+        # no limit, no problem
+        proc = UnzipProcessor(options={'unzip-max-ratio': '0'})
+        result_path, metadata = proc.process(zip_path, {'error': False})
+        assert result_path.endswith('sample.txt')
 
 
 class TestZipProcessor(object):
@@ -516,10 +784,40 @@ class TestZipProcessor(object):
                 arg.short_name, arg.long_name, **arg.keywords)
         result = vars(parser.parse_args([]))
         # defaults
-        assert result == {}
+        assert result == {
+            'zip_compression_level': 6, 'zip_store_compressed': True,
+            'zip_threads': 0}
         # explicitly set value (different from default)
-        result = vars(parser.parse_args([]))
-        assert result == {}
+        result = vars(parser.parse_args([
+            '-zip-level', '0', '-zip-store-compressed', 'no',
+            '-zip-threads', '2']))
+        assert result == {
+            'zip_compression_level': 0, 'zip_store_compressed': False,
+            'zip_threads': 2}
+
+    def test_store_images(self, workdir):
+        # images are stored uncompressed
+        sample_path = str(workdir / "src" / "sample.txt")
+        workdir.join("src").join("image.png").write(
+            b"\x89PNG\r\n\x1a\n" + b"\x00" * 1000, mode="wb")
+        proc = ZipProcessor()
+        result_path, metadata = proc.process(
+            sample_path, {'error': False})
+        zip_file = zipfile.ZipFile(result_path, 'r')
+        assert zip_file.getinfo(
+            'image.png').compress_type == zipfile.ZIP_STORED
+        assert zip_file.getinfo(
+            'sample.txt').compress_type == zipfile.ZIP_DEFLATED
+
+    def test_level_zero(self, workdir):
+        # with compression level 0 nothing is compressed
+        sample_path = str(workdir / "src" / "sample.txt")
+        proc = ZipProcessor(options={'zip-level': '0'})
+        result_path, metadata = proc.process(
+            sample_path, {'error': False})
+        zip_file = zipfile.ZipFile(result_path, 'r')
+        assert zip_file.getinfo(
+            'sample.txt').compress_type == zipfile.ZIP_STORED
 
 
 class TestTidyProcessor(object):
@@ -903,3 +1201,26 @@ class TestErrorProcessor(object):
         path, metadata = proc.process(None, {})
         assert path is None
         assert 'error-descr' in metadata.keys()
+
+
+class TestProbeProcessor(object):
+
+    def test_process(self, tmpdir):
+        # we get metadata and the doc unchanged
+        path = os.path.join(
+            os.path.dirname(__file__), 'input', 'sample-font-props.odt')
+        proc = ProbeProcessor()
+        result_path, metadata = proc.process(path, {})
+        assert result_path == path
+        assert metadata['probe']['format'] == 'odf'
+        assert metadata['probe']['pages'] == 1
+
+    def test_in_procord(self, tmpdir):
+        # the probe processor can be used in pipelines
+        tmpdir.join("sample.txt").write("Hi there!")
+        proc = MetaProcessor(options={'meta-procord': 'probe'})
+        result_path, metadata = proc.process(str(tmpdir / "sample.txt"))
+        assert metadata['error'] is False
+        assert metadata['probe']['format'] == 'unknown'
+        assert metadata['probe']['size'] == 9
+        shutil.rmtree(os.path.dirname(result_path))
@@ -0,0 +1,665 @@
+# tests for supervisor module
+import json
+import os
+import pytest
+import signal
+import socket
+import stat
+import sys
+import threading
+import time
+from ulif.openoffice import convert
+from ulif.openoffice import supervisor as supervisor_module
+from ulif.openoffice.endpoints import probe_endpoint
+from ulif.openoffice.supervisor import (
+    get_children, get_rss, get_connections, build_profile, copy_profile,
+    parse_warmup, warm_up, RecyclePolicy, Instance, Supervisor,
+    WARMUP_CONVERSIONS, STARTING, WARMING, READY, DRAINING, STOPPING)
+
+
+#: A fake office listener. Accepts connections on the port given with
+#: ``--port=NUM`` (like `unoconv`) or ``--accept=...`` and greets
+#: clients like office servers do. Also listens on pipes (below
+#: ``$FAKE_PIPE_DIR``). Creates profiles with ``--terminate_after_init``.
+FAKE_OFFICE = '''#!%s
+import os, re, socket, struct, sys, threading
+args = ' '.join(sys.argv)
+if '--terminate_after_init' in args:
+    path = re.search('UserInstallation=file://([^ ]+)', args).group(1)
+    os.makedirs(os.path.join(path, 'user'))
+    with open(os.path.join(path, 'user', 'registrymodifications.xcu'),
+              'w') as fd:
+        fd.write('<oor:items><item>Fake</item></oor:items>')
+    sys.exit(0)
+port = int(re.search('port=([0-9]+)', args).group(1))
+server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+server.bind(('127.0.0.1', port))
+server.listen(5)
+servers = [server]
+pipe = re.search('pipe,name=([^;]+)', args)
+if pipe is not None:
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(os.path.join(os.environ.get('FAKE_PIPE_DIR', '/tmp'),
+                'OSL_PIPE_%%s_%%s' %% (os.getuid(), pipe.group(1))))
+    server.listen(5)
+    servers.append(server)
+
+def serve(conn):
+    conn.sendall(struct.pack('>II', 20, 1))
+    while conn.recv(1024):
+        pass
+    conn.close()
+
+def accept(server):
+    while True:
+        conn, addr = server.accept()
+        thread = threading.Thread(target=serve, args=(conn, ))
+        thread.daemon = True
+        thread.start()
+
+for server in servers[1:]:
+    thread = threading.Thread(target=accept, args=(server, ))
+    thread.daemon = True
+    thread.start()
+accept(servers[0])
+''' % sys.executable
+
+needs_proc = pytest.mark.skipif(
+    "not os.path.exists('/proc/net/tcp')")
+
+
+def free_port():
+    # get a port nobody listens on
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def tick_until(supervisor, condition, timeout=10):
+    # tick `supervisor` until `condition()` is true
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        supervisor.tick()
+        if condition():
+            return
+        time.sleep(0.05)
+    raise AssertionError('condition not met')
+
+
+@pytest.fixture
+def fake_office(tmpdir):
+    # path to a fake office listener
+    path = tmpdir / "fake_office"
+    path.write(FAKE_OFFICE)
+    path.chmod(stat.S_IRWXU)
+    return str(path)
+
+
+@pytest.fixture
+def supervisor(request, tmpdir, fake_office):
+    # a supervisor running fake office instances
+    supervisor = Supervisor(
+        fake_office, port=free_port(),
+        state_file=str(tmpdir / "state.json"))
+    request.addfinalizer(supervisor.stop)
+    return supervisor
+
+
+@pytest.fixture
+def office_supervisor(supervisor, fake_office, tmpdir, pipe_tmpdir,
+                      monkeypatch):
+    # a supervisor starting fake office instances with profiles and
+    # pipes
+    supervisor.officepath = fake_office
+    supervisor.profile_dir = str(tmpdir / "profiles")
+    pipe_dir = str(pipe_tmpdir)
+    monkeypatch.setattr(convert, 'PIPE_DIRS', (pipe_dir, ))
+    monkeypatch.setenv('FAKE_PIPE_DIR', pipe_dir)
+    return supervisor
+
+
+def write_proc(root, pid, ppid, rss):
+    # create fake ``/proc`` entries for `pid`
+    proc_dir = root.mkdir(str(pid))
+    proc_dir.join('stat').write('%s (soffice bin) S %s 1 1' % (pid, ppid))
+    proc_dir.join('status').write(
+        'Name:\tsoffice\nVmRSS:\t  %s kB\nThreads:\t1\n' % rss)
+
+
+class TestHelpers(object):
+
+    def test_get_rss(self, tmpdir):
+        # we sum up memory of processes and their descendants
+        write_proc(tmpdir, 10, 1, 100)
+        write_proc(tmpdir, 11, 10, 200)
+        write_proc(tmpdir, 12, 11, 300)
+        write_proc(tmpdir, 13, 1, 400)
+        assert get_rss(10, proc=str(tmpdir)) == 600
+        assert get_rss(12, proc=str(tmpdir)) == 300
+
+    def test_get_rss_children(self, tmpdir):
+        # we can look up descendants in a given map of children
+        write_proc(tmpdir, 10, 1, 100)
+        write_proc(tmpdir, 11, 10, 200)
+        children = get_children(proc=str(tmpdir))
+        assert children == {1: [10], 10: [11]}
+        write_proc(tmpdir, 12, 11, 300)     # not in `children`
+        assert get_rss(10, proc=str(tmpdir), children=children) == 300
+
+    def test_get_rss_no_such_process(self, tmpdir):
+        # we get `None` for processes we cannot find
+        assert get_rss(10, proc=str(tmpdir)) is None
+
+    @needs_proc
+    def test_get_rss_real(self):
+        # we can get the memory used by real processes
+        assert get_rss(os.getpid()) > 0
+
+    def test_get_connections(self, tmpdir):
+        # we can get established connections from /proc/net/tcp
+        tmpdir.mkdir('net').join('tcp').write(
+            '  sl  local_address rem_address   st\n'
+            '   0: 0100007F:07D2 00000000:0000 0A\n'
+            '   1: 0100007F:07D2 0100007F:C350 01\n'
+            '   2: 0100007F:C350 0100007F:07D2 01\n')
+        assert get_connections(proc=str(tmpdir)) == {
+            2002: set(['0100007F:C350']), 50000: set(['0100007F:07D2'])}
+
+    def test_get_connections_unix(self, tmpdir):
+        # we can get connected Unix sockets from /proc/net/unix
+        tmpdir.mkdir('net').join('unix').write(
+            'Num       RefCount Protocol Flags    Type St Inode Path\n'
+            '0: 00000002 00000000 00010000 0001 01 100 /tmp/OSL_PIPE_0_x\n'
+            '0: 00000003 00000000 00000000 0001 03 101 /tmp/OSL_PIPE_0_x\n'
+            '0: 00000003 00000000 00000000 0001 03 102\n')
+        assert get_connections(proc=str(tmpdir)) == {
+            '/tmp/OSL_PIPE_0_x': set(['101'])}
+
+
+class TestWarmup(object):
+
+    def test_parse_warmup(self):
+        # we can parse lists of warm-up conversions
+        assert parse_warmup('writer:pdf, calc:html') == [
+            ('writer', 'pdf'), ('calc', 'html')]
+        assert parse_warmup('') == []
+        assert len(parse_warmup(WARMUP_CONVERSIONS)) == 7
+
+    def test_parse_warmup_invalid(self):
+        # unknown families and missing formats are rejected
+        with pytest.raises(ValueError):
+            parse_warmup('draw:pdf')
+        with pytest.raises(ValueError):
+            parse_warmup('writer')
+
+    def test_warm_up(self, monkeypatch):
+        # we convert copies of bundled docs and throw results away
+        calls = []
+
+        def fake_convert(url=None, out_format=None, path=None,
+                         out_dir=None, doctype=None, executable=None,
+                         no_launch=False):
+            calls.append((url, out_format, os.path.basename(path), doctype,
+                          executable, os.path.isfile(path), no_launch))
+            open(os.path.join(out_dir, 'result'), 'w').close()
+            return out_format == 'html' and 1 or 0, out_dir
+        monkeypatch.setattr(convert, 'convert', fake_convert)
+        failed = warm_up(
+            'URL', [('writer', 'pdf'), ('impress', 'html')], 'unoconv')
+        assert failed == 1
+        assert calls == [
+            ('URL', 'pdf', 'warmup.fodt', 'document', 'unoconv', True, True),
+            ('URL', 'html', 'warmup.fodp', 'presentation', 'unoconv', True,
+             True)]
+
+    def test_warmup_docs(self):
+        # warm-up documents are bundled
+        for name, doctype in supervisor_module.WARMUP_DOCS.values():
+            assert os.path.isfile(
+                os.path.join(supervisor_module.WARMUP_DIR, name))
+
+
+class TestProfiles(object):
+
+    def test_build_profile(self, fake_office, tmpdir):
+        # we can build profiles with first start wizards disabled
+        path = str(tmpdir / "profiles" / "template")
+        build_profile(fake_office, path)
+        content = (tmpdir / "profiles" / "template" / "user" /
+                   "registrymodifications.xcu").read()
+        assert content.startswith('<oor:items><item>Fake</item>')
+        assert (
+            '<item oor:path="/org.openoffice.Office.Common/Misc">'
+            '<prop oor:name="FirstRun" oor:op="fuse">'
+            '<value>false</value></prop></item>') in content
+        assert content.endswith('</oor:items>\n')
+        assert os.listdir(str(tmpdir / "profiles")) == ['template']
+
+    def test_build_profile_failed(self, tmpdir):
+        # failing builds leave nothing behind
+        with pytest.raises(RuntimeError):
+            build_profile('/bin/false', str(tmpdir / "template"))
+        assert tmpdir.listdir() == []
+
+    def test_copy_profile(self, tmpdir):
+        # we can copy profiles, including symlinks
+        src = tmpdir.mkdir("src")
+        src.mkdir("user").join("file").write("content")
+        src.join("link").mksymlinkto("user/file")
+        dst = tmpdir.mkdir("dst")
+        copy_profile(str(src), str(dst))
+        assert dst.join("user", "file").read() == "content"
+        assert dst.join("link").islink()
+
+    def test_profile_template(self, office_supervisor, monkeypatch):
+        # templates are built once
+        calls = []
+
+        def fake_build(officepath, path):
+            calls.append(path)
+            os.makedirs(path)
+        monkeypatch.setattr(supervisor_module, 'build_profile', fake_build)
+        path = office_supervisor.profile_template()
+        assert office_supervisor.profile_template() == path
+        assert calls == [path]
+        assert os.path.basename(path).startswith('template-')
+
+    @needs_proc
+    def test_instance_profiles(self, office_supervisor):
+        # each instance gets its own copy of the template
+        office_supervisor.size = 2
+        office_supervisor.start()
+        profiles = [x.profile for x in office_supervisor.instances]
+        assert profiles[0] != profiles[1]
+        for instance in office_supervisor.instances:
+            assert os.path.isfile(os.path.join(
+                instance.profile, 'user', 'registrymodifications.xcu'))
+            assert instance.command[-1] == (
+                '-env:UserInstallation=file://%s' % instance.profile)
+            assert instance.pipe == 'ulif_openoffice_%s' % instance.port
+        tick_until(office_supervisor, lambda: [
+            x.state for x in office_supervisor.instances] == [READY, READY])
+        # profiles are removed with their instances
+        office_supervisor.stop()
+        assert not [x for x in profiles if os.path.exists(x)]
+        assert len(os.listdir(office_supervisor.profile_dir)) == 1
+
+    def test_temporary_profiles(self, office_supervisor):
+        # without profile dir instances get temporary profiles
+        office_supervisor.profile_dir = None
+        office_supervisor.size = 2
+        office_supervisor.start()
+        profiles = [x.profile for x in office_supervisor.instances]
+        assert profiles[0] != profiles[1]
+        assert [x for x in profiles if os.path.isdir(x)] == profiles
+        assert office_supervisor.instances[0].command[-1] == (
+            '-env:UserInstallation=file://%s' % profiles[0])
+        office_supervisor.stop()
+        assert not [x for x in profiles if os.path.exists(x)]
+
+
+class TestRecyclePolicy(object):
+
+    def test_no_limits(self):
+        # without limits instances are never recycled
+        instance = Instance([], 2002)
+        instance.started = time.time() - 1000
+        instance.conversions = 1000
+        assert RecyclePolicy().reason(instance) is None
+
+    def test_max_conversions(self):
+        # instances can be recycled after some conversions
+        instance = Instance([], 2002)
+        instance.started = time.time()
+        instance.conversions = 10
+        policy = RecyclePolicy(max_conversions=10)
+        assert policy.reason(instance) == '10 conversions done'
+        instance.conversions = 9
+        assert policy.reason(instance) is None
+
+    def test_max_age(self):
+        # instances can be recycled after some time
+        instance = Instance([], 2002)
+        instance.started = 100
+        policy = RecyclePolicy(max_age=60)
+        assert policy.reason(instance, now=161) == 'running for 61 seconds'
+        assert policy.reason(instance, now=159) is None
+
+    def test_max_rss(self):
+        # instances can be recycled when they use too much memory
+        instance = Instance([], 2002)
+        instance.started = time.time()
+        assert RecyclePolicy(max_rss=1).reason(instance) is None
+        instance.rss = 2048
+        policy = RecyclePolicy(max_rss=1024)
+        assert policy.reason(instance) == 'using 2048 kB of memory'
+        assert RecyclePolicy(max_rss=10 ** 9).reason(instance) is None
+
+
+@needs_proc
+class TestSupervisor(object):
+
+    def test_probe_nonblocking(self, monkeypatch):
+        # instances not answering do not block us while probed
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        monkeypatch.setattr(
+            supervisor_module, 'probe_endpoint', lambda host, port: (
+                probe_endpoint(host, port, timeout=0.3)))
+        instance = Instance([], server.getsockname()[1], host='127.0.0.1')
+        start = time.time()
+        assert instance.probe() is None
+        assert instance.probe() is None
+        assert time.time() - start < 0.2
+        for num in range(100):
+            result = instance.probe()
+            if result is not None:
+                break
+            time.sleep(0.05)
+        server.close()
+        assert result is False
+
+    def test_start(self, supervisor):
+        # we can start instances, which get ready eventually
+        supervisor.start()
+        instance = supervisor.instances[0]
+        assert instance.state == STARTING
+        tick_until(supervisor, lambda: instance.state == READY)
+        with open(supervisor.state_file) as fd:
+            state = json.load(fd)
+        assert state['instances'] == [dict(
+            host='localhost', port=supervisor.port, pid=instance.pid,
+            pipe=None, state='ready', started=instance.started,
+            conversions=0)]
+
+    def test_stop(self, supervisor):
+        # we can stop all instances
+        supervisor.start()
+        process = supervisor.instances[0].process
+        supervisor.stop()
+        assert process.poll() is not None
+        assert supervisor.instances == []
+        assert not os.path.exists(supervisor.state_file)
+
+    def test_restart(self, supervisor):
+        # dead instances are restarted
+        supervisor.start()
+        instance = supervisor.instances[0]
+        tick_until(supervisor, lambda: instance.state == READY)
+        instance.process.kill()
+        instance.process.wait()
+        supervisor.tick()
+        assert supervisor.instances == []
+        tick_until(supervisor, lambda: len(supervisor.instances) == 1)
+        new = supervisor.instances[0]
+        assert new is not instance
+        assert new.port == instance.port
+        tick_until(supervisor, lambda: new.state == READY)
+
+    def test_restart_backoff(self, supervisor):
+        # instances crashing early are restarted with growing delays
+        instance = Instance([], 2002)
+        instance.started = 100
+        for num in range(3):
+            supervisor._lost(instance, 101)
+        assert supervisor.restarts == [101.1, 101.2, 101.4]
+        supervisor.crashes = 100
+        supervisor._lost(instance, 101)
+        assert supervisor.restarts[-1] == 131
+        # stable instances are restarted at once
+        supervisor._lost(instance, 1000)
+        assert supervisor.restarts[-1] == 1000
+        assert supervisor.crashes == 0
+
+    def test_spawn_failed(self, supervisor, tmpdir):
+        # instances failing to start are started later
+        supervisor.command = lambda port, profile: [str(tmpdir / 'missing')]
+        supervisor.start()
+        assert supervisor.instances == []
+        assert len(supervisor.restarts) == 1
+        supervisor.tick(now=supervisor.restarts[0])
+        assert supervisor.instances == []
+        assert supervisor.crashes == 2
+        del supervisor.command
+        supervisor.tick(now=supervisor.restarts[0])
+        assert len(supervisor.instances) == 1
+        assert supervisor.restarts == []
+
+    def test_spawn_failed_profile(self, office_supervisor, monkeypatch):
+        # failing to build profile templates does not stop us
+        def fake_build(officepath, path):
+            raise RuntimeError('building office profile failed (1)')
+        monkeypatch.setattr(supervisor_module, 'build_profile', fake_build)
+        office_supervisor.start()
+        assert office_supervisor.instances == []
+        assert len(office_supervisor.restarts) == 1
+
+    def test_spawn_failed_recycle(self, supervisor, tmpdir):
+        # replacements failing to start are started later
+        supervisor.policy = RecyclePolicy(max_conversions=1)
+        supervisor.start()
+        old = supervisor.instances[0]
+        tick_until(supervisor, lambda: old.state == READY)
+        old.conversions = 1
+        supervisor.command = lambda port, profile: [str(tmpdir / 'missing')]
+        supervisor.tick()
+        assert supervisor.instances == [old]
+        assert old.recycle_at > 0
+        assert supervisor.restarts == []
+
+    def test_start_timeout(self, supervisor, monkeypatch):
+        # instances not getting ready are restarted
+        monkeypatch.setattr(supervisor_module, 'START_TIMEOUT', 0)
+        supervisor.command = lambda port, profile: ['sleep', '30']
+        supervisor.start()
+        instance = supervisor.instances[0]
+        supervisor.tick()
+        assert instance.state == STOPPING
+        assert len(supervisor.restarts) == 1
+
+    def test_warmup(self, supervisor, monkeypatch):
+        # instances run warm-up conversions before they get ready
+        calls = []
+        event = threading.Event()
+
+        def fake_warm_up(url, conversions, executable):
+            calls.append((url, conversions, executable))
+            event.wait(10)
+        monkeypatch.setattr(supervisor_module, 'warm_up', fake_warm_up)
+        supervisor.warmup = [('writer', 'pdf')]
+        supervisor.start()
+        instance = supervisor.instances[0]
+        tick_until(supervisor, lambda: instance.state == WARMING)
+        with open(supervisor.state_file) as fd:
+            assert json.load(fd)['instances'][0]['state'] == 'warming'
+        # warm-ups take some time
+        conn = socket.create_connection(('127.0.0.1', instance.port))
+        supervisor.tick()
+        assert instance.state == WARMING
+        event.set()
+        tick_until(supervisor, lambda: instance.state == READY)
+        conn.close()
+        assert calls == [(
+            convert.get_url('localhost', instance.port), [('writer', 'pdf')],
+            supervisor.binarypath)]
+        # warm-ups are no conversions
+        assert instance.conversions == 0
+
+    def test_warmup_timeout(self, supervisor, monkeypatch):
+        # instances not warming up in time are restarted
+        event = threading.Event()
+        monkeypatch.setattr(supervisor_module, 'WARMUP_TIMEOUT', 0)
+        monkeypatch.setattr(
+            supervisor_module, 'warm_up', lambda *args: event.wait(10))
+        supervisor.warmup = [('writer', 'pdf')]
+        supervisor.start()
+        instance = supervisor.instances[0]
+        tick_until(supervisor, lambda: instance.state == STOPPING)
+        event.set()
+        assert len(supervisor.restarts) == 1
+
+    def test_command(self, supervisor):
+        # we start office instances directly, if we know the path
+        assert supervisor.command(2003)[1:] == [
+            '--listener', '--server=localhost', '--port=2003']
+        supervisor.officepath = '/path/to/soffice'
+        command = supervisor.command(2003)
+        assert command[0] == '/path/to/soffice'
+        assert '--headless' in command
+        assert command[-2:] == [
+            '--accept=socket,host=localhost,port=2003;urp;'
+            'StarOffice.ComponentContext',
+            '--accept=pipe,name=ulif_openoffice_2003;urp;'
+            'StarOffice.ComponentContext']
+
+    def test_count_pipe_conversions(self, office_supervisor):
+        # we count connections to the pipes of instances
+        office_supervisor.start()
+        instance = office_supervisor.instances[0]
+        tick_until(office_supervisor, lambda: instance.state == READY)
+        pipe_path = convert.get_pipe_path(instance.pipe)
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(pipe_path)
+        tick_until(office_supervisor, lambda: instance.conversions == 1)
+        conn.close()
+        # pipes left behind are removed
+        office_supervisor.stop()
+        assert not os.path.exists(pipe_path)
+
+    def test_run(self, supervisor):
+        # crashed instances are noticed at once
+        supervisor.interval = 10    # no periodic checks
+        result = []
+
+        def crash():
+            deadline = time.time() + 10
+            while time.time() < deadline:
+                ready = [x for x in supervisor.instances if x.state == READY]
+                if ready:
+                    break
+                time.sleep(0.01)
+            old = ready[0]
+            start = time.time()
+            old.process.kill()
+            while time.time() < start + 10:
+                if [x for x in supervisor.instances if (
+                        x is not old and x.state == READY)]:
+                    result.append(time.time() - start)
+                    break
+                time.sleep(0.01)
+            supervisor.stopping = True
+            os.kill(os.getpid(), signal.SIGCHLD)    # wake up
+        thread = threading.Thread(target=crash)
+        thread.start()
+        supervisor.run()
+        thread.join()
+        assert result and result[0] < 1.0
+        assert supervisor.instances == []
+
+    def test_count_conversions(self, supervisor):
+        # we count connections to instances
+        supervisor.start()
+        instance = supervisor.instances[0]
+        tick_until(supervisor, lambda: instance.state == READY)
+        for num in range(2):
+            conn = socket.create_connection(('127.0.0.1', instance.port))
+            tick_until(supervisor, lambda: instance.conversions == num + 1)
+            conn.close()
+
+    def test_measure_rss(self, supervisor, monkeypatch):
+        # the memory of instances is measured every few seconds, with
+        # one look at all processes
+        supervisor.size = 2
+        supervisor.policy = RecyclePolicy(max_rss=10 ** 9)
+        supervisor.start()
+        tick_until(supervisor, lambda: [
+            x.state for x in supervisor.instances] == [READY, READY])
+        calls = []
+
+        def fake_get_children(proc='/proc'):
+            calls.append(proc)
+            return get_children(proc)
+        monkeypatch.setattr(
+            supervisor_module, 'get_children', fake_get_children)
+        supervisor.rss_checked = 0
+        now = time.time()
+        supervisor.tick(now)
+        assert len(calls) == 1
+        assert [x.rss > 0 for x in supervisor.instances] == [True, True]
+        supervisor.tick(now + 1)
+        assert len(calls) == 1
+        supervisor.tick(now + supervisor_module.RSS_INTERVAL)
+        assert len(calls) == 2
+
+    def test_recycle(self, supervisor):
+        # instances are replaced, drained and stopped
+        supervisor.policy = RecyclePolicy(max_conversions=1)
+        supervisor.start()
+        old = supervisor.instances[0]
+        tick_until(supervisor, lambda: old.state == READY)
+        conn = socket.create_connection(('127.0.0.1', old.port))
+        tick_until(supervisor, lambda: len(supervisor.instances) == 2)
+        new = supervisor.instances[1]
+        assert new.replaces is old
+        assert new.port == old.port + 1
+        # the old instance keeps running until the new one is ready
+        tick_until(supervisor, lambda: new.state == READY)
+        assert old.state == DRAINING
+        with open(supervisor.state_file) as fd:
+            states = [x['state'] for x in json.load(fd)['instances']]
+        assert states == ['draining', 'ready']
+        # open connections are not dropped
+        supervisor.tick()
+        assert old.state == DRAINING
+        conn.close()
+        tick_until(supervisor, lambda: old.state == STOPPING)
+        tick_until(supervisor, lambda: supervisor.instances == [new])
+
+    def test_recycle_replacement_lost(self, supervisor):
+        # replacements dying are replaced, but only once
+        supervisor.policy = RecyclePolicy(max_conversions=1)
+        supervisor.start()
+        old = supervisor.instances[0]
+        tick_until(supervisor, lambda: old.state == READY)
+        conn = socket.create_connection(('127.0.0.1', old.port))
+        tick_until(supervisor, lambda: len(supervisor.instances) == 2)
+        new = supervisor.instances[1]
+        new.process.kill()
+        new.process.wait()
+        supervisor.tick()
+        assert supervisor.restarts == []
+        assert old.recycle_at > 0
+        tick_until(supervisor, lambda: [
+            x for x in supervisor.instances if (
+                x is not old and x.state == READY)])
+        conn.close()
+        tick_until(supervisor, lambda: old not in supervisor.instances)
+        assert len(supervisor.instances) == 1
+
+    def test_shrink(self, supervisor):
+        # instances beyond `size` are drained
+        supervisor.size = 2
+        supervisor.start()
+        tick_until(supervisor, lambda: [
+            x.state for x in supervisor.instances] == [READY, READY])
+        supervisor.size = 1
+        supervisor.tick()
+        assert [x.state for x in supervisor.instances] == [READY, DRAINING]
+        tick_until(supervisor, lambda: len(supervisor.instances) == 1)
+        assert supervisor.instances[0].port == supervisor.port
+
+    def test_drain_timeout(self, supervisor):
+        # draining instances are stopped after some time
+        supervisor.drain_timeout = 0
+        supervisor.policy = RecyclePolicy(max_conversions=1)
+        supervisor.start()
+        old = supervisor.instances[0]
+        tick_until(supervisor, lambda: old.state == READY)
+        conn = socket.create_connection(('127.0.0.1', old.port))
+        tick_until(supervisor, lambda: old.state in (DRAINING, STOPPING))
+        tick_until(supervisor, lambda: old not in supervisor.instances)
+        conn.close()
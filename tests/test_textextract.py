@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# tests for textextract module
+from __future__ import unicode_literals
+import codecs
+import os
+import pytest
+import zipfile
+from ulif.openoffice.textextract import (
+    extract_text, TextExtractionError, NS_TEXT, NS_TABLE, NS_OFFICE, NS_W,
+    NS_S, NS_A, NS_P, NS_R, NS_PR)
+
+
+def make_doc(path, parts):
+    """Create a ZIP file in `path` with `parts`, a dict name -> content.
+    """
+    with zipfile.ZipFile(str(path), 'w') as zf:
+        for name, content in parts.items():
+            zf.writestr(name, content.encode('utf-8'))
+    return str(path)
+
+
+def read_text(path):
+    with codecs.open(str(path), 'r', encoding='utf-8') as fd:
+        return fd.read()
+
+
+def rels(targets):
+    return '<Relationships xmlns="%s">%s</Relationships>' % (NS_PR, ''.join([
+        '<Relationship Id="%s" Target="%s" Type="x"/>' % (rel_id, target)
+        for rel_id, target in targets]))
+
+
+ODT_CONTENT = (
+    '<office:document-content xmlns:office="%s" xmlns:text="%s" '
+    'xmlns:table="%s"><office:body><office:text>'
+    '<text:h>Heading</text:h>'
+    '<text:p>Some <text:span>spanned</text:span> text.<text:s text:c="2"/>'
+    'Spaces<text:tab/>Tab<text:line-break/>Umlauts: äöü</text:p>'
+    '<text:tracked-changes><text:changed-region><text:deletion>'
+    '<text:p>Deleted</text:p></text:deletion></text:changed-region>'
+    '</text:tracked-changes>'
+    '<text:p>Before<office:annotation><text:p>Comment</text:p>'
+    '</office:annotation> after</text:p>'
+    '<table:table><table:table-row>'
+    '<table:table-cell><text:p>A1</text:p></table:table-cell>'
+    '<table:table-cell><text:p>B1</text:p></table:table-cell>'
+    '<table:table-cell table:number-columns-repeated="1000"/>'
+    '</table:table-row>'
+    '<table:table-row table:number-rows-repeated="1000">'
+    '<table:table-cell table:number-columns-repeated="1000"/>'
+    '</table:table-row></table:table>'
+    '</office:text></office:body></office:document-content>') % (
+        NS_OFFICE, NS_TEXT, NS_TABLE)
+
+
+class TestExtractText(object):
+
+    def test_odt(self, tmpdir):
+        # we can extract text from ODF docs
+        path = make_doc(tmpdir / "sample.odt", {'content.xml': ODT_CONTENT})
+        extract_text(path, str(tmpdir / "sample.txt"))
+        assert read_text(tmpdir / "sample.txt") == (
+            'Heading\n'
+            'Some spanned text.  Spaces\tTab\nUmlauts: äöü\n'
+            'Before after\n'
+            'A1\tB1\n')
+
+    def test_odt_nested_tables(self, tmpdir):
+        # nested tables are not supported
+        content = ODT_CONTENT.replace(
+            '<text:p>A1</text:p>',
+            '<table:table><table:table-row><table:table-cell>'
+            '<text:p>Inner</text:p></table:table-cell></table:table-row>'
+            '</table:table>')
+        path = make_doc(tmpdir / "sample.odt", {'content.xml': content})
+        with pytest.raises(TextExtractionError):
+            extract_text(path, str(tmpdir / "sample.txt"))
+        assert not (tmpdir / "sample.txt").exists()
+
+    def test_real_odt(self, tmpdir):
+        # we can handle real-world docs
+        path = os.path.join(
+            os.path.dirname(__file__), 'input', 'sample-font-props.odt')
+        extract_text(path, str(tmpdir / "sample.txt"))
+        assert read_text(tmpdir / "sample.txt").startswith(
+            'Sample Font Characteristics\nEffects\n')
+
+    def test_docx(self, tmpdir):
+        # we can extract text from Word docs
+        content = (
+            '<w:document xmlns:w="%s" xmlns:mc="http://schemas.'
+            'openxmlformats.org/markup-compatibility/2006"><w:body>'
+            '<w:p><w:r><w:t>Hello</w:t></w:r><w:r><w:tab/>'
+            '<w:t xml:space="preserve"> wörld</w:t><w:br/></w:r>'
+            '<w:r><w:delText>deleted</w:delText></w:r>'
+            '<w:r><w:instrText>PAGE</w:instrText></w:r></w:p>'
+            '<w:p><w:r><mc:AlternateContent><mc:Choice>'
+            '<w:t>Choice</w:t></mc:Choice><mc:Fallback><w:t>Fallback</w:t>'
+            '</mc:Fallback></mc:AlternateContent></w:r></w:p>'
+            '<w:tbl><w:tr><w:tc><w:p><w:r><w:t>A1</w:t></w:r></w:p></w:tc>'
+            '<w:tc><w:p/></w:tc><w:tc><w:p><w:r><w:t>C1</w:t></w:r></w:p>'
+            '</w:tc></w:tr></w:tbl>'
+            '</w:body></w:document>') % NS_W
+        path = make_doc(
+            tmpdir / "sample.docx", {'word/document.xml': content})
+        extract_text(path, str(tmpdir / "sample.txt"))
+        assert read_text(tmpdir / "sample.txt") == (
+            'Hello\t wörld\n\nChoice\nA1\t\tC1\n')
+
+    def test_xlsx(self, tmpdir):
+        # we can extract text from Excel workbooks
+        path = make_doc(tmpdir / "sample.xlsx", {
+            'xl/workbook.xml': (
+                '<workbook xmlns="%s" xmlns:r="%s"><sheets>'
+                '<sheet name="Two" sheetId="2" r:id="rId2"/>'
+                '<sheet name="One" sheetId="1" r:id="rId1"/>'
+                '</sheets></workbook>') % (NS_S, NS_R),
+            'xl/_rels/workbook.xml.rels': rels([
+                ('rId1', 'worksheets/sheet1.xml'),
+                ('rId2', '/xl/worksheets/sheet2.xml')]),
+            'xl/sharedStrings.xml': (
+                '<sst xmlns="%s"><si><t>Shared</t></si>'
+                '<si><r><t>Rich</t></r><r><t> text</t></r>'
+                '<rPh><t>phonetic</t></rPh></si></sst>') % NS_S,
+            'xl/worksheets/sheet1.xml': (
+                '<worksheet xmlns="%s"><sheetData>'
+                '<row><c t="s"><v>0</v></c><c><v>1.5</v></c>'
+                '<c t="inlineStr"><is><t>Inline</t></is></c></row>'
+                '<row><c/></row>'
+                '</sheetData></worksheet>') % NS_S,
+            'xl/worksheets/sheet2.xml': (
+                '<worksheet xmlns="%s"><sheetData>'
+                '<row><c t="s"><v>1</v></c></row>'
+                '</sheetData></worksheet>') % NS_S,
+            })
+        extract_text(path, str(tmpdir / "sample.txt"))
+        assert read_text(tmpdir / "sample.txt") == (
+            'Rich text\n\nShared\t1.5\tInline\n')
+
+    def test_pptx(self, tmpdir):
+        # we can extract text from presentations
+        slide = (
+            '<p:sld xmlns:p="%s" xmlns:a="%s"><p:cSld><p:spTree><p:sp>'
+            '<p:txBody><a:p><a:r><a:t>%s</a:t></a:r><a:br/>'
+            '<a:r><a:t>Line</a:t></a:r></a:p></p:txBody>'
+            '</p:sp></p:spTree></p:cSld></p:sld>')
+        path = make_doc(tmpdir / "sample.pptx", {
+            'ppt/presentation.xml': (
+                '<p:presentation xmlns:p="%s" xmlns:r="%s"><p:sldIdLst>'
+                '<p:sldId id="256" r:id="rId7"/>'
+                '<p:sldId id="257" r:id="rId3"/>'
+                '</p:sldIdLst></p:presentation>') % (NS_P, NS_R),
+            'ppt/_rels/presentation.xml.rels': rels([
+                ('rId3', 'slides/slide2.xml'),
+                ('rId7', 'slides/slide1.xml')]),
+            'ppt/slides/slide1.xml': slide % (NS_P, NS_A, 'First'),
+            'ppt/slides/slide2.xml': slide % (NS_P, NS_A, 'Second'),
+            })
+        extract_text(path, str(tmpdir / "sample.txt"))
+        assert read_text(tmpdir / "sample.txt") == (
+            'First\nLine\n\nSecond\nLine\n')
+
+    def test_unsupported_type(self, tmpdir):
+        # we do not handle legacy formats
+        path = os.path.join(
+            os.path.dirname(__file__), 'input', 'simpledoc1.doc')
+        with pytest.raises(TextExtractionError):
+            extract_text(path, str(tmpdir / "sample.txt"))
+        assert not (tmpdir / "sample.txt").exists()
+
+    def test_broken_doc(self, tmpdir):
+        # broken or encrypted docs raise TextExtractionError
+        path = make_doc(tmpdir / "sample.docx", {
+            'word/document.xml': '<w:document><w:body>'})
+        with pytest.raises(TextExtractionError):
+            extract_text(path, str(tmpdir / "sample.txt"))
+        assert not (tmpdir / "sample.txt").exists()
+        (tmpdir / "sample.odt").write("Not a zip file")
+        with pytest.raises(TextExtractionError):
+            extract_text(
+                str(tmpdir / "sample.odt"), str(tmpdir / "sample.txt"))
+
+    def test_bad_references(self, tmpdir):
+        # invalid values inside docs raise TextExtractionError
+        path = make_doc(tmpdir / "sample.odt", {'content.xml': (
+            '<office:document-content xmlns:office="%s" xmlns:text="%s">'
+            '<office:body><office:text><text:p>Partial</text:p>'
+            '<text:p>A<text:s text:c="many"/>B</text:p>'
+            '</office:text></office:body></office:document-content>') % (
+                NS_OFFICE, NS_TEXT)})
+        with pytest.raises(TextExtractionError):
+            extract_text(path, str(tmpdir / "sample.txt"))
+        assert not (tmpdir / "sample.txt").exists()
+        path = make_doc(tmpdir / "sample.xlsx", {
+            'xl/workbook.xml': (
+                '<workbook xmlns="%s" xmlns:r="%s"><sheets>'
+                '<sheet name="One" sheetId="1" r:id="rId1"/>'
+                '</sheets></workbook>') % (NS_S, NS_R),
+            'xl/_rels/workbook.xml.rels': rels([
+                ('rId1', 'worksheets/sheet1.xml')]),
+            'xl/worksheets/sheet1.xml': (
+                '<worksheet xmlns="%s"><sheetData>'
+                '<row><c t="s"><v>7</v></c></row>'
+                '</sheetData></worksheet>') % NS_S,
+            })
+        with pytest.raises(TextExtractionError):
+            extract_text(path, str(tmpdir / "sample.txt"))
+        assert not (tmpdir / "sample.txt").exists()
+
+    def test_unsupported_member(self, tmpdir, monkeypatch):
+        # encrypted or unsupported ZIP members raise TextExtractionError
+        path = make_doc(tmpdir / "sample.odt", {'content.xml': ODT_CONTENT})
+
+        def fake_open(*args, **kw):
+            raise RuntimeError('File is encrypted, password required')
+        monkeypatch.setattr(zipfile.ZipFile, 'open', fake_open)
+        with pytest.raises(TextExtractionError):
+            extract_text(path, str(tmpdir / "sample.txt"))
+        assert not (tmpdir / "sample.txt").exists()
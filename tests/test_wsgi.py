@@ -17,14 +17,22 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 #
+import json
+import os
 import pytest
+import time
 import zipfile
 from paste.deploy import loadapp
 from webob import Request
+from ulif.openoffice import jobs, wsgi
 from ulif.openoffice.cachemanager import get_marker
+from ulif.openoffice.endpoints import get_endpoint_pool, set_endpoints
 from ulif.openoffice.wsgi import (
-    RESTfulDocConverter, FileIterator, FileIterable, get_mimetype
+    RESTfulDocConverter, FileIterator, FileIterable, ZipIterable,
+    get_mimetype, get_etag, get_request_urgency, make_response,
+    make_zip_response
     )
+from wsgiref.util import FileWrapper
 
 pytestmark = pytest.mark.wsgi
 
@@ -50,6 +58,34 @@ def is_zipfile_with_file(workdir, content, filename="sample.html"):
     return filename in zipfile.ZipFile(str(content_file), "r").namelist()
 
 
+class TestGetRequestUrgency(object):
+    # tests for get_request_urgency()
+
+    def test_default(self):
+        # without priority set we get the default
+        assert get_request_urgency(Request.blank('/docs')) == 3
+
+    def test_param(self):
+        # we can set urgency as param
+        req = Request.blank('/docs', POST=dict(priority='1'))
+        assert get_request_urgency(req) == 1
+
+    def test_header(self):
+        # we can set urgency with HTTP Priority header
+        req = Request.blank('/docs', headers={'Priority': 'i, u=0'})
+        assert get_request_urgency(req) == 0
+        req = Request.blank('/docs', headers={'Priority': 'u=9'})
+        assert get_request_urgency(req) == 7
+        req = Request.blank('/docs', headers={'Priority': 'i'})
+        assert get_request_urgency(req) == 3
+
+    def test_param_first(self):
+        # params override headers
+        req = Request.blank(
+            '/docs?priority=6', headers={'Priority': 'u=1'})
+        assert get_request_urgency(req) == 6
+
+
 class TestGetMimetype(object):
     # tests for get_mimetype()
     def test_nofilename(self):
@@ -71,6 +107,99 @@ class TestGetMimetype(object):
         assert get_mimetype('unknown.type') == 'application/octet-stream'
 
 
+class TestGetEtag(object):
+
+    def test_etag(self, tmpdir):
+        # without cache key, etags depend on path, size and mtime
+        path = tmpdir.join("sample.txt")
+        path.write("Hi there!")
+        os.utime(str(path), (1000000000.0, 1000000000.0))
+        # the same in all processes, no matter what `hash()` gives
+        assert get_etag(str(path)) == get_etag(str(path))
+        etag = get_etag(str(path))
+        assert len(etag) == 32
+        os.utime(str(path), (1000000001.0, 1000000001.0))
+        assert get_etag(str(path)) != etag
+
+    def test_etag_cache_key(self, tmpdir):
+        # if a cache key is given, we use it instead of the path
+        tmpdir.join("sample1.txt").write("Hi there!")
+        tmpdir.join("sample2.txt").write("Hi there!")
+        for name in ("sample1.txt", "sample2.txt"):
+            os.utime(str(tmpdir / name), (1000000000.0, 1000000000.0))
+        assert get_etag(str(tmpdir / "sample1.txt")) != get_etag(
+            str(tmpdir / "sample2.txt"))
+        assert get_etag(str(tmpdir / "sample1.txt"), "a_1_1") == get_etag(
+            str(tmpdir / "sample2.txt"), "a_1_1")
+
+    def test_etag_cache_key_mtime(self, tmpdir):
+        # with a cache key, mtimes do not matter (other nodes, restored
+        # caches), but sizes do
+        path = tmpdir.join("sample.txt")
+        path.write("Hi there!")
+        etag = get_etag(str(path), "a_1_1")
+        os.utime(str(path), (1000000000.0, 1000000000.0))
+        assert get_etag(str(path), "a_1_1") == etag
+        path.write("Hi there, again!")
+        assert get_etag(str(path), "a_1_1") != etag
+
+    def test_etag_zip_response(self, tmpdir):
+        # zipped directories get other etags with other zip settings
+        tmpdir.mkdir("dir1").join("sample.txt").write("Hi there!")
+        path = str(tmpdir / "dir1")
+        etag = make_zip_response(path, cache_key="a_1_1").etag
+        assert make_zip_response(path, cache_key="a_1_1").etag == etag
+        assert make_zip_response(
+            path, cache_key="a_1_1", level=1).etag != etag
+
+    def test_etag_cache_key_dir(self, tmpdir):
+        # directories are tagged by the sizes of files in them
+        tmpdir.mkdir("dir1").join("sample.txt").write("Hi there!")
+        tmpdir.mkdir("dir2").mkdir("sub").join("other.txt").write(
+            "Hi again!")
+        assert get_etag(str(tmpdir / "dir1"), "a_1_1") == get_etag(
+            str(tmpdir / "dir2"), "a_1_1")
+        tmpdir.join("dir2", "more.txt").write("More")
+        assert get_etag(str(tmpdir / "dir1"), "a_1_1") != get_etag(
+            str(tmpdir / "dir2"), "a_1_1")
+
+    def test_make_response_conditional(self, tmpdir):
+        # responses answer conditional requests
+        tmpdir.join("sample.txt").write("Hi there!")
+        resp = make_response(str(tmpdir / "sample.txt"))
+        req = Request.blank(
+            '/', headers={'If-None-Match': '"%s"' % resp.etag})
+        assert req.get_response(resp).status == "304 Not Modified"
+        req = Request.blank('/', headers={'If-None-Match': '"other"'})
+        assert req.get_response(resp).status == "200 OK"
+
+
+class TestMakeResponse(object):
+
+    def test_file_wrapper(self, iter_path):
+        # we use wsgi.file_wrapper if available
+        req = Request.blank('/', environ={'wsgi.file_wrapper': FileWrapper})
+        resp = make_response(iter_path, environ=req.environ)
+        assert isinstance(resp.app_iter, FileWrapper)
+        assert req.get_response(resp).body == b"0123456789"
+
+    def test_file_wrapper_range(self, iter_path):
+        # ranges are delivered by ourselves
+        req = Request.blank(
+            '/', environ={'wsgi.file_wrapper': FileWrapper},
+            headers={'Range': 'bytes=2-4'})
+        resp = make_response(iter_path, environ=req.environ)
+        assert isinstance(resp.app_iter, FileIterable)
+        resp = req.get_response(resp)
+        assert resp.status == "206 Partial Content"
+        assert resp.body == b"234"
+
+    def test_no_file_wrapper(self, iter_path):
+        # without file_wrapper we deliver files ourselves
+        resp = make_response(iter_path, environ=Request.blank('/').environ)
+        assert isinstance(resp.app_iter, FileIterable)
+
+
 class TestFileIterator(object):
 
     def test_empty_file(self, tmpdir):
@@ -126,6 +255,24 @@ class TestFileIterable(object):
         assert [b'67'] == list(fi.app_iter_range(6, 8))
 
 
+class TestZipIterable(object):
+
+    def test_iter(self, tmpdir):
+        # we get a zipfile of the given dir
+        tmpdir.join("src").mkdir().join("sample.html").write("Hi!")
+        zi = ZipIterable(str(tmpdir / "src"))
+        assert is_zipfile_with_file(tmpdir, b"".join(zi))
+
+    def test_close_remove(self, tmpdir):
+        # we can remove paths after delivery
+        tmpdir.join("src").mkdir().join("sample.html").write("Hi!")
+        zi = ZipIterable(str(tmpdir / "src"), remove=str(tmpdir / "src"))
+        b"".join(zi)
+        assert tmpdir.join("src").exists()
+        zi.close()
+        assert not tmpdir.join("src").exists()
+
+
 class TestDocConverterFunctional(object):
 
     def test_restful_doc_converter(self):
@@ -215,6 +362,95 @@ class TestDocConverterFunctional(object):
         assert is_zipfile_with_file(
             conv_env, resp.body, filename="sample.pdf")
 
+    def test_create_stream_zip(self, conv_env):
+        # with `stream_zip` set, results are zipped on the fly
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"), stream_zip='true')
+        req = Request.blank(
+            'http://localhost/docs',
+            POST=dict(doc=('sample.txt', 'Hi there!'),
+                      CREATE='Send',
+                      )
+            )
+        resp = app(req)
+        assert resp.status == "201 Created"
+        assert resp.headers['Location'] == (
+            'http://localhost:80/docs/396199333edbf40ad43e62a1c1397793_1_1')
+        assert resp.headers['Content-Type'] == 'application/zip'
+        assert is_zipfile_with_file(conv_env, resp.body)
+        # the cache contains the unzipped result
+        cached = app.cache_manager.get_cached_file(
+            '396199333edbf40ad43e62a1c1397793_1_1')
+        assert cached.endswith('/sample')
+        assert conv_env.join(cached[len(str(conv_env)):]).join(
+            "sample.html").isfile()
+        # cached results are delivered as zip file
+        resp = app(Request.blank(resp.headers['Location']))
+        assert resp.status == "200 OK"
+        assert resp.headers['Content-Type'] == 'application/zip'
+        assert is_zipfile_with_file(conv_env, resp.body)
+
+    def test_create_stream_zip_cached(self, conv_env, monkeypatch):
+        # streamed results are taken from cache if possible
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"), stream_zip='true')
+
+        def post():
+            return app(Request.blank(
+                'http://localhost/docs',
+                POST=dict(doc=('sample.txt', 'Hi there!'), CREATE='Send')))
+        location = post().headers['Location']
+
+        def fail(*args, **kw):
+            raise AssertionError('converted again')
+        monkeypatch.setattr(app, '_convert', fail)
+        resp = post()
+        assert resp.status == "201 Created"
+        assert resp.headers['Location'] == location
+        assert is_zipfile_with_file(conv_env, resp.body)
+
+    def test_create_stream_zip_cached_zipfile(self, conv_env):
+        # ZIP files cached by non-streamed requests are delivered as is
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"), stream_zip='true')
+        conv_env.join("src.txt").write("Hi there!")
+        conv_env.join("sample.html.zip").write("Fake result.")
+        app.cache_manager.register_doc(
+            str(conv_env / "src.txt"), str(conv_env / "sample.html.zip"),
+            repr_key=get_marker({}))
+        resp = app(Request.blank(
+            'http://localhost/docs',
+            POST=dict(doc=('sample.txt', 'Hi there!'), CREATE='Send')))
+        assert resp.status == "201 Created"
+        assert resp.body == b"Fake result."
+
+    def test_create_stream_zip_options(self, conv_env):
+        # streamed ZIP files respect the zip options
+        app = RESTfulDocConverter(cache_dir=None, stream_zip=True)
+        req = Request.blank(
+            'http://localhost/docs',
+            POST={'doc': ('sample.txt', 'Hi there!'), 'CREATE': 'Send',
+                  'zip-level': '0'})
+        resp = app(req)
+        (conv_env / "result.zip").write_binary(resp.body)
+        zf = zipfile.ZipFile(str(conv_env / "result.zip"))
+        assert set([x.compress_type for x in zf.infolist()]) == set([
+            zipfile.ZIP_STORED])
+
+    def test_create_stream_zip_without_cache(self, conv_env):
+        # we can stream zip files without cache
+        app = RESTfulDocConverter(cache_dir=None, stream_zip=True)
+        req = Request.blank(
+            'http://localhost/docs',
+            POST=dict(doc=('sample.txt', 'Hi there!'),
+                      CREATE='Send',
+                      )
+            )
+        resp = app(req)
+        assert "Location" not in resp.headers
+        assert resp.status.lower() == "200 ok"
+        assert is_zipfile_with_file(conv_env, resp.body)
+
     def test_show_yet_uncached_doc(self, conv_env):
         # a yet uncached doc results in 404
         app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
@@ -238,3 +474,362 @@ class TestDocConverterFunctional(object):
         resp = app(req)
         assert resp.status == "200 OK"
         assert resp.content_type == "application/pdf"
+        # cached docs are immutable
+        assert resp.headers['Cache-Control'] == (
+            'public, max-age=31536000, immutable')
+        assert resp.etag == get_etag(resp.app_iter.filename, doc_id)
+
+    def test_show_conditional(self, conv_env):
+        # we answer conditional requests for cached docs
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        conv_env.join("sample_in.txt").write("Fake source.")
+        conv_env.join("sample_out.pdf").write("Fake result.")
+        doc_id = app.cache_manager.register_doc(
+            source_path=str(conv_env.join("sample_in.txt")),
+            to_cache=str(conv_env.join("sample_out.pdf")))
+        url = 'http://localhost/docs/%s' % doc_id
+        resp = Request.blank(url).get_response(app)
+        etag, last_modified = resp.etag, resp.headers['Last-Modified']
+        req = Request.blank(url, headers={'If-None-Match': '"%s"' % etag})
+        resp = req.get_response(app)
+        assert resp.status == "304 Not Modified"
+        assert resp.body == b""
+        req = Request.blank(
+            url, headers={'If-Modified-Since': last_modified})
+        assert req.get_response(app).status == "304 Not Modified"
+        # HEAD requests are supported
+        resp = Request.blank(url, method='HEAD').get_response(app)
+        assert resp.status == "200 OK"
+        assert resp.etag == etag
+
+    def test_show_conditional_zip(self, conv_env):
+        # we answer conditional requests for cached dirs
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        conv_env.join("sample_in.txt").write("Fake source.")
+        conv_env.mkdir("result").join("sample.html").write("<p>Hi</p>")
+        doc_id = app.cache_manager.register_doc(
+            source_path=str(conv_env.join("sample_in.txt")),
+            to_cache=str(conv_env / "result"))
+        url = 'http://localhost/docs/%s' % doc_id
+        resp = Request.blank(url).get_response(app)
+        assert resp.content_type == "application/zip"
+        req = Request.blank(
+            url, headers={'If-None-Match': '"%s"' % resp.etag})
+        assert req.get_response(app).status == "304 Not Modified"
+
+    def test_lookup_by_digest(self, conv_env):
+        # we can get cached docs by source digest without upload
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        conv_env.join("sample_in.txt").write("Fake source.")
+        conv_env.join("sample_out.pdf").write("Fake result.")
+        options = {'oocp-out-fmt': 'pdf', 'meta-procord': 'oocp'}
+        doc_id = app.cache_manager.register_doc(
+            source_path=str(conv_env.join("sample_in.txt")),
+            to_cache=str(conv_env.join("sample_out.pdf")),
+            repr_key=get_marker(options))
+        url = ('http://localhost/docs?source_digest=%s&'
+               'oocp-out-fmt=pdf&meta-procord=oocp') % doc_id.split('_')[0]
+        resp = app(Request.blank(url))
+        assert resp.status == "200 OK"
+        assert resp.content_type == "application/pdf"
+        assert resp.body == b"Fake result."
+        assert resp.location == 'http://localhost:80/docs/%s' % doc_id
+        # HEAD requests are supported as well
+        resp = Request.blank(url, method='HEAD').get_response(app)
+        assert resp.status == "200 OK"
+        assert resp.body == b""
+        assert resp.location == 'http://localhost:80/docs/%s' % doc_id
+
+    def test_lookup_by_digest_uncached(self, conv_env):
+        # unknown digests or options result in 404
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        conv_env.join("sample_in.txt").write("Fake source.")
+        conv_env.join("sample_out.pdf").write("Fake result.")
+        doc_id = app.cache_manager.register_doc(
+            source_path=str(conv_env.join("sample_in.txt")),
+            to_cache=str(conv_env.join("sample_out.pdf")),
+            repr_key=get_marker({'oocp-out-fmt': 'pdf'}))
+        digest = doc_id.split('_')[0]
+        url = 'http://localhost/docs?source_digest=%s' % digest
+        assert app(Request.blank(url)).status == "404 Not Found"
+        url = 'http://localhost/docs?source_digest=%s' % ('0' * 32)
+        assert app(Request.blank(url)).status == "404 Not Found"
+        # without cache we cannot find anything
+        app = RESTfulDocConverter()
+        url = 'http://localhost/docs?source_digest=%s&oocp-out-fmt=pdf' % (
+            digest)
+        assert app(Request.blank(url)).status == "404 Not Found"
+
+    def test_show_x_sendfile(self, conv_env):
+        # we can let proxies deliver cached files via X-Sendfile
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"), sendfile_header='X-Sendfile')
+        conv_env.join("sample_in.txt").write("Fake source.")
+        conv_env.join("sample_out.pdf").write("Fake result.")
+        doc_id = app.cache_manager.register_doc(
+            source_path=str(conv_env.join("sample_in.txt")),
+            to_cache=str(conv_env.join("sample_out.pdf")))
+        url = 'http://localhost/docs/%s' % doc_id
+        resp = Request.blank(url).get_response(app)
+        assert resp.status == "200 OK"
+        assert resp.body == b""
+        assert resp.content_type == "application/pdf"
+        assert resp.headers['X-Sendfile'] == (
+            app.cache_manager.get_cached_file(doc_id))
+        # ranges are left to the proxy
+        req = Request.blank(url, headers={'Range': 'bytes=2-4'})
+        resp = req.get_response(app)
+        assert resp.status == "200 OK"
+        assert 'X-Sendfile' in resp.headers
+        # conditional requests are still handled by us
+        req = Request.blank(
+            url, headers={'If-None-Match': '"%s"' % resp.etag})
+        assert req.get_response(app).status == "304 Not Modified"
+
+    def test_show_x_accel_redirect(self, conv_env):
+        # we can let nginx deliver cached files via X-Accel-Redirect
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"),
+            sendfile_header='X-Accel-Redirect', sendfile_prefix='/cached/')
+        conv_env.join("sample_in.txt").write("Fake source.")
+        conv_env.join("sample out.pdf").write("Fake result.")
+        doc_id = app.cache_manager.register_doc(
+            source_path=str(conv_env.join("sample_in.txt")),
+            to_cache=str(conv_env.join("sample out.pdf")))
+        url = 'http://localhost/docs/%s' % doc_id
+        resp = Request.blank(url).get_response(app)
+        assert resp.body == b""
+        assert resp.headers['X-Accel-Redirect'] == (
+            '/cached/3f/3fe6f0d4c5e62ff9a1deca0a8a65fe8d/repr/1/1/'
+            'sample%20out.pdf')
+
+    def test_invalid_sendfile_header(self, conv_env):
+        # only some sendfile headers are supported
+        with pytest.raises(ValueError):
+            RESTfulDocConverter(sendfile_header='X-Foo')
+
+    def test_probe(self, conv_env):
+        # we can get metadata of docs without converting them
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        req = Request.blank(
+            'http://localhost/docs/probe',
+            POST=dict(doc=('sample.txt', 'Hi there!')))
+        resp = app(req)
+        assert resp.status == "200 OK"
+        assert resp.content_type == "application/json"
+        result = json.loads(resp.body.decode('utf-8'))
+        assert result['format'] == 'unknown'
+        assert result['size'] == 9
+        assert conv_env.join("cache", ".probe").listdir() != []
+        # the probe result is not a cached doc
+        assert list(app.cache_manager.keys()) == []
+
+
+class TestAsyncJobs(object):
+    # tests for asynchronous conversions
+
+    def async_app(self, conv_env, monkeypatch, result=True):
+        def fake_convert(src_path, options, cache_dir):
+            if not result:
+                return None, None, {'error': True, 'error-descr': 'Boom!'}
+            return None, '396199333edbf40ad43e62a1c1397793_1_1', {}
+        monkeypatch.setattr(jobs, 'convert_doc', fake_convert)
+        return RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"), async_workers=1)
+
+    def create_job(self, app):
+        req = Request.blank(
+            'http://localhost/docs', POST=dict(doc=('sample.txt', 'Hi!')),
+            headers={'Prefer': 'respond-async'})
+        return req.get_response(app)
+
+    def wait_for(self, app, job_id):
+        for x in range(500):
+            job = app.job_manager.get(job_id)
+            if job.state in jobs.FINISHED_STATES:
+                break
+            time.sleep(0.01)
+        app.job_manager.shutdown()
+        return job
+
+    def test_create_async(self, conv_env, monkeypatch):
+        # we get a job url instead of a result
+        app = self.async_app(conv_env, monkeypatch)
+        resp = self.create_job(app)
+        assert resp.status == "202 Accepted"
+        assert resp.headers['Preference-Applied'] == 'respond-async'
+        job_id = json.loads(resp.body.decode('utf-8'))['id']
+        assert resp.location == 'http://localhost:80/jobs/%s' % job_id
+
+    def test_show_job_done(self, conv_env, monkeypatch):
+        # finished jobs redirect to results
+        app = self.async_app(conv_env, monkeypatch)
+        resp = self.create_job(app)
+        job_id = json.loads(resp.body.decode('utf-8'))['id']
+        self.wait_for(app, job_id)
+        resp = Request.blank(resp.location).get_response(app)
+        assert resp.status == "303 See Other"
+        assert resp.location == (
+            'http://localhost:80/docs/396199333edbf40ad43e62a1c1397793_1_1')
+        data = json.loads(resp.body.decode('utf-8'))
+        assert data['state'] == 'done'
+        assert data['location'] == resp.location
+
+    def test_show_job_failed(self, conv_env, monkeypatch):
+        # failed jobs tell what went wrong
+        app = self.async_app(conv_env, monkeypatch, result=False)
+        resp = self.create_job(app)
+        job_id = json.loads(resp.body.decode('utf-8'))['id']
+        self.wait_for(app, job_id)
+        resp = Request.blank(resp.location).get_response(app)
+        assert resp.status == "200 OK"
+        data = json.loads(resp.body.decode('utf-8'))
+        assert data['state'] == 'failed'
+        assert data['error'] == 'Boom!'
+
+    def test_show_job_unknown(self, conv_env, monkeypatch):
+        # unknown jobs result in 404
+        app = self.async_app(conv_env, monkeypatch)
+        resp = Request.blank('http://localhost/jobs/foo').get_response(app)
+        assert resp.status == "404 Not Found"
+        app = RESTfulDocConverter()
+        resp = Request.blank('http://localhost/jobs/foo').get_response(app)
+        assert resp.status == "404 Not Found"
+
+    def test_delete_job(self, conv_env, monkeypatch):
+        # we can cancel jobs
+        app = self.async_app(conv_env, monkeypatch)
+        resp = self.create_job(app)
+        job_id = json.loads(resp.body.decode('utf-8'))['id']
+        self.wait_for(app, job_id)
+        req = Request.blank(resp.location, method='DELETE')
+        assert req.get_response(app).status == "204 No Content"
+        assert req.get_response(app).status == "404 Not Found"
+
+    def test_async_disabled(self, conv_env):
+        # without async workers the `Prefer` header is ignored
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        assert app.job_manager is None
+
+
+class TestSpoolMode(object):
+    # tests for conversions done by workers serving a spool
+
+    @pytest.fixture
+    def worker(self, request, conv_env, monkeypatch):
+        def fake_convert(src_path, options, cache_dir):
+            result_path = os.path.join(str(conv_env.mkdtemp()), 'out.txt')
+            with open(result_path, 'w') as fd:
+                fd.write('Converted')
+            return result_path, None, {'error': False}
+        monkeypatch.setattr(jobs, 'convert_doc', fake_convert)
+        worker = jobs.JobManager(
+            None, spool_dir=str(conv_env / "spool"), keep_results=True,
+            poll_interval=0.01)
+        worker.start()
+        request.addfinalizer(worker.shutdown)
+        return worker
+
+    def test_create(self, conv_env, worker):
+        # conversions are done by workers
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"),
+            spool_dir=str(conv_env / "spool"))
+        req = Request.blank(
+            'http://localhost/docs', POST=dict(doc=('sample.txt', 'Hi!')))
+        resp = req.get_response(app)
+        assert resp.status == "201 Created"
+        assert resp.body == b'Converted'
+        doc_id = resp.location.split('/')[-1]
+        assert app.cache_manager.get_cached_file(doc_id) is not None
+
+    def test_create_async(self, conv_env, worker):
+        # async conversions are done by workers as well
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"),
+            spool_dir=str(conv_env / "spool"))
+        req = Request.blank(
+            'http://localhost/docs', POST=dict(doc=('sample.txt', 'Hi!')),
+            headers={'Prefer': 'respond-async'})
+        resp = req.get_response(app)
+        assert resp.status == "202 Accepted"
+        for x in range(500):
+            job_resp = Request.blank(resp.location).get_response(app)
+            if job_resp.status != "200 OK":
+                break
+            time.sleep(0.01)
+        assert job_resp.status == "303 See Other"
+        resp = Request.blank(job_resp.location).get_response(app)
+        assert resp.body == b'Converted'
+
+    def test_no_async_without_cache(self, conv_env, worker):
+        # without cache we cannot deliver results of async jobs
+        app = RESTfulDocConverter(spool_dir=str(conv_env / "spool"))
+        req = Request.blank(
+            'http://localhost/docs', POST=dict(doc=('sample.txt', 'Hi!')),
+            headers={'Prefer': 'respond-async'})
+        resp = req.get_response(app)
+        assert resp.status == "200 OK"
+        assert resp.body == b'Converted'
+
+
+class TestAdmission(object):
+    # tests for limits of concurrent conversions
+
+    def test_overloaded(self, conv_env):
+        # too many conversions result in 503
+        app = RESTfulDocConverter(max_conversions=1, max_queue=0)
+        req = Request.blank(
+            'http://localhost/docs', POST=dict(doc=('sample.txt', 'Hi!')))
+        with app.admission.admit():
+            resp = req.get_response(app)
+        assert resp.status == "503 Service Unavailable"
+        assert resp.headers['Retry-After'] == '5'
+
+    def test_async_queue_full(self, conv_env, monkeypatch):
+        # too many queued jobs result in 503
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"),
+            spool_dir=str(conv_env / "spool"), max_queue='1')
+        req = Request.blank(
+            'http://localhost/docs', POST=dict(doc=('sample.txt', 'Hi!')),
+            headers={'Prefer': 'respond-async'})
+        assert req.get_response(app).status == "202 Accepted"
+        req = Request.blank(
+            'http://localhost/docs', POST=dict(doc=('sample.txt', 'Hi!')),
+            headers={'Prefer': 'respond-async'})
+        resp = req.get_response(app)
+        assert resp.status == "503 Service Unavailable"
+        assert resp.headers['Retry-After'] == '10'
+
+    def test_office_endpoints(self, conv_env):
+        # we can set a pool of office servers
+        try:
+            RESTfulDocConverter(office_endpoints='office1:2003 office2')
+            pool = get_endpoint_pool()
+            assert [(ep.host, ep.port) for ep in pool.endpoints] == [
+                ('office1', 2003), ('office2', 2002)]
+        finally:
+            set_endpoints()
+
+    def test_priority(self, conv_env, monkeypatch):
+        # admission depends on cost and urgency of conversions
+        urgencies = []
+
+        def fake_convert(src_path, options, cache_dir):
+            urgencies.append(options)
+            return src_path, None, {'error': False}
+        monkeypatch.setattr(wsgi, 'convert_doc', fake_convert)
+        app = RESTfulDocConverter(max_conversions=1)
+        admit = app.admission.admit
+
+        def fake_admit(cost, urgency):
+            urgencies.append((cost, urgency))
+            return admit(cost, urgency)
+        monkeypatch.setattr(app.admission, 'admit', fake_admit)
+        req = Request.blank(
+            'http://localhost/docs?priority=1',
+            POST=dict(doc=('sample.txt', 'Hi!')))
+        assert req.get_response(app).body == b'Hi!'
+        # priority is not a conversion option
+        assert urgencies == [(1.2, 1), {}]
@@ -1,14 +1,17 @@
 # tests for xmlrpc module
 import filecmp
 import os
+import pytest
 import shutil
 import tempfile
 import unittest
 from paste.deploy import loadapp
 from webob import Request
+from ulif.openoffice import jobs
 from ulif.openoffice.cachemanager import CacheManager
+from ulif.openoffice.endpoints import get_endpoint_pool, set_endpoints
 from ulif.openoffice.testing import WSGIXMLRPCAppTransport
-from ulif.openoffice.xmlrpc import WSGIXMLRPCApplication
+from ulif.openoffice.xmlrpc import WSGIXMLRPCApplication, FAULT_OVERLOADED
 try:
     import xmlrpclib                            # Python 2.x
 except ImportError:                             # pragma: no cover
@@ -82,6 +85,55 @@ class ServerTests(ServerTestsSetup):
         self.result_dir = os.path.dirname(result_path)   # for cleanup
         assert metadata['error'] is False
 
+    def test_convert_spool(self):
+        # we can let workers convert files
+        def fake_convert(src_path, options, cache_dir):
+            result_path = os.path.join(tempfile.mkdtemp(), 'out.txt')
+            with open(result_path, 'w') as fd:
+                fd.write('Converted')
+            return result_path, None, {'error': False}
+        orig_convert, jobs.convert_doc = jobs.convert_doc, fake_convert
+        spool_dir = os.path.join(self.src_dir, 'spool')
+        worker = jobs.JobManager(
+            None, spool_dir=spool_dir, keep_results=True, poll_interval=0.01)
+        worker.start()
+        try:
+            app = WSGIXMLRPCApplication(
+                cache_dir=self.cachedir, spool_dir=spool_dir)
+            req = self.xmlrpc_request(
+                'convert_locally', (self.src_path, {}))
+            resp = req.get_response(app)
+        finally:
+            worker.shutdown()
+            jobs.convert_doc = orig_convert
+        result_path, cache_key, metadata = xmlrpclib.loads(resp.body)[0][0]
+        self.result_dir = os.path.dirname(result_path)   # for cleanup
+        assert metadata['error'] is False
+        assert open(result_path).read() == 'Converted'
+        assert CacheManager(self.cachedir).get_cached_file(
+            cache_key) is not None
+
+    def test_convert_overloaded(self):
+        # too many conversions result in a fault
+        app = WSGIXMLRPCApplication(max_conversions=1, max_queue=0)
+        req = self.xmlrpc_request(
+            'convert_locally', (self.src_path, {}))
+        with app.admission.admit():
+            resp = req.get_response(app)
+        with pytest.raises(xmlrpclib.Fault) as exc_info:
+            xmlrpclib.loads(resp.body)
+        assert exc_info.value.faultCode == FAULT_OVERLOADED
+        assert exc_info.value.faultString == (
+            'queue full, retry after 5 seconds')
+
+    def test_office_endpoints(self):
+        # we can set a pool of office servers
+        try:
+            WSGIXMLRPCApplication(office_endpoints='office1:2003')
+            assert get_endpoint_pool() is not None
+        finally:
+            set_endpoints()
+
     def test_paste_deploy_loader(self):
         # we can find the xmlrpcapp via paste.deploy plugin
         app = loadapp('config:%s' % self.paste_conf1)
@@ -132,3 +184,12 @@ class ServerProxyTests(ServerTestsSetup):
         assert result_path is not None
         assert result_path != fake_result_path
         assert filecmp.cmp(result_path, fake_result_path, shallow=False)
+
+    def test_probe_locally(self):
+        # we can get metadata of local docs
+        result = self.proxy.probe_locally(self.src_path)
+        assert result['format'] == 'unknown'
+        assert result['size'] == 10
+        assert result['pages'] is None
+        # results are cached
+        assert len(os.listdir(os.path.join(self.cachedir, '.probe'))) == 1